@@ -0,0 +1,235 @@
+import threading
+from collections import OrderedDict, deque
+import perf
+import codec
+
+
+class TitleMatcher:
+    """記事タイトルのAho-Corasickオートマトン
+
+    本文を1回走査するだけで、含まれているすべてのタイトルを見つける。
+    """
+
+    def __init__(self, titles):
+        self.titles = frozenset(t for t in titles if t)
+        self._goto = [{}]
+        self._fail = [0]
+        self._terminal = [None]  # この状態で終わるタイトル
+        self._dict_link = [0]    # 失敗リンクをたどって最初に見つかる終端状態
+
+        for title in self.titles:
+            state = 0
+            for ch in title:
+                next_state = self._goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][ch] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._terminal.append(None)
+                    self._dict_link.append(0)
+                state = next_state
+            self._terminal[state] = title
+
+        # 幅優先で失敗リンクを計算
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(ch, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                link = self._fail[next_state]
+                self._dict_link[next_state] = link if self._terminal[link] else self._dict_link[link]
+
+    def find(self, text, exclude=None):
+        """最左最長一致で重ならない (開始位置, 終了位置, タイトル) のリストを返す"""
+        longest = {}  # 開始位置 → その位置から始まる最長のタイトル
+        goto, fail, terminal, dict_link = self._goto, self._fail, self._terminal, self._dict_link
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            match = state if terminal[state] else dict_link[state]
+            while match:
+                title = terminal[match]
+                if title != exclude:
+                    start = i - len(title) + 1
+                    if len(title) > len(longest.get(start, "")):
+                        longest[start] = title
+                match = dict_link[match]
+
+        matches = []
+        position = 0
+        for start in sorted(longest):
+            if start >= position:
+                title = longest[start]
+                position = start + len(title)
+                matches.append((start, position, title))
+        return matches
+
+
+_matcher_cache = OrderedDict()
+_matcher_cache_lock = threading.Lock()  # 保存スレッドや複数のセッションから同時に使われる
+_MATCHER_CACHE_SIZE = 16
+
+
+# タイトル集合に対応するオートマトンを取得（タイトルが変わったときだけ再構築）
+@perf.timed("links.get_title_matcher")
+def get_title_matcher(titles, key=None):
+    """keyを渡すとタイトル集合の代わりにキャッシュのキーにする（同じキーなら同じタイトル集合であること）"""
+    if key is None:
+        key = titles = frozenset(titles)
+    with _matcher_cache_lock:
+        matcher = _matcher_cache.get(key)
+        if matcher is not None:
+            _matcher_cache.move_to_end(key)
+            return matcher
+    # 構築には時間がかかるのでロックの外で行う（同時に構築した場合は先に登録されたものを使う）
+    matcher = TitleMatcher(titles)
+    with _matcher_cache_lock:
+        matcher = _matcher_cache.setdefault(key, matcher)
+        _matcher_cache.move_to_end(key)
+        while len(_matcher_cache) > _MATCHER_CACHE_SIZE:
+            _matcher_cache.popitem(last=False)
+    return matcher
+
+
+# 記事内容のハイライトと言及されている記事の検出を1回の走査で行う
+@perf.timed("links.link_article")
+def link_article(content, all_titles, current_title, key=None):
+    """(ハイライト済みのMarkdown, 言及されている記事タイトルのリスト) を返す（keyはget_title_matcherに渡す）"""
+    matches = get_title_matcher(all_titles, key).find(content, exclude=current_title)
+
+    parts = []
+    mentioned = {}  # 出現順を保った重複なしの集合
+    position = 0
+    for start, end, title in matches:
+        parts.append(content[position:start])
+        # タイトルを太字でハイライト
+        parts.append(f"**{title}**")
+        position = end
+        mentioned.setdefault(title)
+    parts.append(content[position:])
+
+    # 改行を<br>タグに変換してMarkdownで正しく表示
+    linked_content = "".join(parts).replace('\n', '  \n')
+    return linked_content, list(mentioned)
+
+
+# 記事内容から他の記事タイトルを検出してリンク化
+def create_article_links(content, all_titles, current_title):
+    """記事内容に含まれる他の記事タイトルをハイライト（改行を保持）"""
+    return link_article(content, all_titles, current_title)[0]
+
+
+class LinkGraph:
+    """記事間のリンク（本文中での言及）のグラフ
+
+    記事ごとの言及先（outgoing）と言及元（incoming）を保持し、保存時の差分で更新する。
+    """
+
+    def __init__(self, outgoing=None, version=0):
+        self.version = version  # 反映済みのコミット番号
+        self.outgoing = {title: set(targets) for title, targets in (outgoing or {}).items()}
+        self.incoming = {title: set() for title in self.outgoing}
+        for source, targets in self.outgoing.items():
+            for target in targets:
+                self.incoming[target].add(source)
+
+    @classmethod
+    def build(cls, encyclopedia, context=None):
+        graph = cls({title: () for title in encyclopedia})
+        matcher = get_title_matcher(encyclopedia.keys())
+        for title, article in encyclopedia.items():
+            graph._set_links(title, article, matcher)
+        return graph
+
+    @classmethod
+    def load(cls, path):
+        data = codec.load_file(path)
+        if "titles" in data:
+            # バイナリ形式では言及先をタイトルの番号のバイト列で保存している
+            titles = data["titles"]
+            title_at = titles.__getitem__
+            return cls({title: map(title_at, codec.unpack_ints(targets))
+                        for title, targets in zip(titles, data["outgoing"])}, data["version"])
+        return cls(data["outgoing"], data["version"])
+
+    def save(self, path):
+        if codec.binary_enabled():
+            titles = list(self.outgoing)
+            title_ids = {title: i for i, title in enumerate(titles)}
+            data = codec.dumps({"version": self.version, "titles": titles,
+                                "outgoing": [codec.pack_ints(sorted(map(title_ids.__getitem__, targets)))
+                                             for targets in self.outgoing.values()]})
+        else:
+            data = codec.dumps({"version": self.version,
+                                "outgoing": {title: sorted(targets) for title, targets in self.outgoing.items()}})
+        codec.replace_file(path, lambda f: f.write(data))
+
+    def _set_links(self, title, article, matcher):
+        for target in self.outgoing.get(title, ()):
+            self.incoming[target].discard(title)
+        targets = {target for _, _, target in matcher.find(article.get("content", ""), exclude=title)}
+        self.outgoing[title] = targets
+        for target in targets:
+            self.incoming[target].add(title)
+
+    @perf.timed("links.apply_changes")
+    def apply_changes(self, updated, deleted, context):
+        """保存時の差分を反映する
+
+        再走査するのは、更新された記事と、追加・削除されたタイトルを含む記事だけ。
+        """
+        rescan = set(updated)
+        for title in deleted:
+            if title not in self.outgoing:
+                continue
+            # 削除された記事に言及していた記事は、より短いタイトルに一致するようになる場合がある
+            for source in self.incoming.pop(title):
+                self.outgoing[source].discard(title)
+                rescan.add(source)
+            for target in self.outgoing.pop(title):
+                self.incoming[target].discard(title)
+
+        new_titles = [title for title in updated if title not in self.outgoing]
+        for title in new_titles:
+            self.outgoing[title] = set()
+            self.incoming[title] = set()
+        if new_titles:
+            search_index = context.index("search")
+            for title in new_titles:
+                if len(rescan) >= len(self.outgoing):
+                    break  # 一括登録などで、すでにすべての記事を再走査することになっている
+                # 新しいタイトルを本文に含む記事を全文検索インデックスで絞り込む
+                candidates = search_index.containing(title)
+                rescan.update(self.outgoing if candidates is None else candidates)
+
+        matcher = get_title_matcher(self.outgoing.keys())
+        for title in rescan:
+            if title not in self.outgoing:
+                continue
+            article = updated[title] if title in updated else context.article(title)
+            if article is not None:
+                self._set_links(title, article, matcher)
+
+    def backlinks(self, title):
+        """titleに言及している記事のタイトル"""
+        return sorted(self.incoming.get(title, ()))
+
+    def links(self, title):
+        """titleの本文で言及されている記事のタイトル"""
+        return sorted(self.outgoing.get(title, ()))
+
+    def orphans(self):
+        """どの記事からも言及されていない記事"""
+        return sorted(title for title, sources in self.incoming.items() if not sources)
+
+    def dead_ends(self):
+        """他の記事に一切言及していない記事"""
+        return sorted(title for title, targets in self.outgoing.items() if not targets)
@@ -0,0 +1,301 @@
+import numpy as np
+import pandas as pd
+import perf
+import codec
+from bodystore import content_length, image_count
+from categories import normalize_categories
+
+# 列を確保するときの最小の行数（足りなくなったら倍に増やす）
+MIN_CAPACITY = 1024
+
+# 数値の列と型（created・updatedは秒単位の日時。日時がない記事はNaT）
+COLUMNS = {
+    "length": np.dtype("<i8"),
+    "images": np.dtype("<i4"),
+    "image_bytes": np.dtype("<i8"),
+    "created": np.dtype("<M8[s]"),
+    "updated": np.dtype("<M8[s]"),
+}
+
+_NAT = np.datetime64("NaT", "s")
+
+
+# "YYYY-mm-dd HH:MM:SS" 形式の日時をdatetime64にする（読めなければNaT）
+def parse_time(value):
+    if not isinstance(value, str) or not value:
+        return _NAT
+    try:
+        return np.datetime64(value.strip().replace(" ", "T"), "s")
+    except ValueError:
+        return _NAT
+
+
+class ArticleStats:
+    """統計情報用に記事の一覧用の項目を列ごとのnumpy配列で持つ索引
+
+    記事の保存のたびに変わった行だけを書き換え、記事数や総文字数などの合計も差分で更新する。
+    削除した記事の行は空きとして再利用する。カテゴリーは (行番号, カテゴリー番号) の組の配列で持ち、
+    カテゴリーの組み合わせやカテゴリー別の集計をまとめて計算できるようにする。
+    """
+
+    def __init__(self, version=0):
+        self.version = version   # 反映済みのコミット番号
+        self.rows = {}           # タイトル → 行番号
+        self.titles = []         # 行番号 → タイトル（空きの行はNone）
+        self.free = []           # 空きの行番号
+        self.live = np.zeros(0, bool)
+        self.columns = {name: np.zeros(0, dtype) for name, dtype in COLUMNS.items()}
+        self.category_names = []  # カテゴリー番号 → カテゴリー名
+        self.category_ids = {}
+        self.pair_row = np.zeros(0, np.int32)   # 削除した組は-1
+        self.pair_cat = np.zeros(0, np.int32)
+        self.pair_count = 0
+        self.dead_pairs = 0
+        self.totals = {"articles": 0, "chars": 0, "images": 0, "with_images": 0, "image_bytes": 0}
+
+    @classmethod
+    def build(cls, encyclopedia, context=None):
+        stats = cls()
+        for title, article in encyclopedia.items():
+            stats._insert(title, article, context)
+        return stats
+
+    @classmethod
+    def load(cls, path):
+        data = codec.load_file(path)
+        stats = cls(data["version"])
+        stats.category_names = data["categories"]
+        stats.category_ids = {name: i for i, name in enumerate(stats.category_names)}
+        titles = data["titles"]
+        count = len(titles)
+        stats._grow(count)
+        stats.titles = list(titles)
+        stats.rows = {title: row for row, title in enumerate(titles)}
+        stats.live[:count] = True
+        for name, dtype in COLUMNS.items():
+            stats.columns[name][:count] = _decode(data[name], dtype)
+        pair_row = _decode(data["pair_row"], np.dtype("<i4"))
+        pair_cat = _decode(data["pair_cat"], np.dtype("<i4"))
+        stats._grow_pairs(len(pair_row))
+        stats.pair_row[:len(pair_row)] = pair_row
+        stats.pair_cat[:len(pair_cat)] = pair_cat
+        stats.pair_count = len(pair_row)
+        stats._recount()
+        return stats
+
+    def save(self, path):
+        # 空きの行を詰めて保存する（組の行番号も詰めた後の番号に付け替える）
+        rows = np.flatnonzero(self.live)
+        renumber = np.full(len(self.live), -1, np.int32)
+        renumber[rows] = np.arange(len(rows), dtype=np.int32)
+        pairs = self._live_pairs()
+        data = {"version": self.version, "categories": self.category_names,
+                "titles": [self.titles[row] for row in rows],
+                "pair_row": _encode(renumber[self.pair_row[pairs]].astype("<i4")),
+                "pair_cat": _encode(self.pair_cat[pairs].astype("<i4"))}
+        for name, dtype in COLUMNS.items():
+            data[name] = _encode(self.columns[name][rows].astype(dtype))
+        codec.replace_file(path, lambda f: f.write(codec.dumps(data)))
+
+    def _grow(self, needed):
+        capacity = len(self.live)
+        if needed <= capacity:
+            return
+        capacity = max(MIN_CAPACITY, capacity * 2, needed)
+        self.live = np.concatenate([self.live, np.zeros(capacity - len(self.live), bool)])
+        for name, column in self.columns.items():
+            grown = np.zeros(capacity, column.dtype)
+            if column.dtype.kind == "M":
+                grown[:] = _NAT
+            grown[:len(column)] = column
+            self.columns[name] = grown
+
+    def _grow_pairs(self, needed):
+        capacity = len(self.pair_row)
+        if needed <= capacity:
+            return
+        capacity = max(MIN_CAPACITY, capacity * 2, needed)
+        for name in ("pair_row", "pair_cat"):
+            grown = np.full(capacity, -1, np.int32)
+            grown[:self.pair_count] = getattr(self, name)[:self.pair_count]
+            setattr(self, name, grown)
+
+    def _live_pairs(self):
+        return np.flatnonzero(self.pair_row[:self.pair_count] >= 0)
+
+    def _compact_pairs(self):
+        """削除した組を取り除いて詰める"""
+        pairs = self._live_pairs()
+        count = len(pairs)
+        self.pair_row[:count] = self.pair_row[pairs]
+        self.pair_cat[:count] = self.pair_cat[pairs]
+        self.pair_row[count:] = -1
+        self.pair_count = count
+        self.dead_pairs = 0
+
+    def _recount(self):
+        live = self.live
+        images = self.columns["images"][live]
+        self.totals = {"articles": int(live.sum()), "chars": int(self.columns["length"][live].sum()),
+                       "images": int(images.sum()), "with_images": int(np.count_nonzero(images)),
+                       "image_bytes": int(self.columns["image_bytes"][live].sum())}
+
+    def _adjust_totals(self, row, sign):
+        images = int(self.columns["images"][row])
+        self.totals["articles"] += sign
+        self.totals["chars"] += sign * int(self.columns["length"][row])
+        self.totals["images"] += sign * images
+        self.totals["with_images"] += sign * (images > 0)
+        self.totals["image_bytes"] += sign * int(self.columns["image_bytes"][row])
+
+    def add(self, title, article, context=None):
+        self._release([title])
+        self._insert(title, article, context)
+
+    def remove(self, title):
+        self._release([title])
+
+    def _insert(self, title, article, context):
+        if self.free:
+            row = self.free.pop()
+            self.titles[row] = title
+        else:
+            row = len(self.titles)
+            self._grow(row + 1)
+            self.titles.append(title)
+        self.rows[title] = row
+        self.live[row] = True
+        count = image_count(article)
+        # 画像の参照は本文と一緒に保存されているので、画像がある記事だけ本文を読む
+        image_bytes = sum(context.blob_size(ref) for ref in article.get("images", [])) if count and context else 0
+        self.columns["length"][row] = content_length(article)
+        self.columns["images"][row] = count
+        self.columns["image_bytes"][row] = image_bytes
+        self.columns["created"][row] = parse_time(article.get("created"))
+        self.columns["updated"][row] = parse_time(article.get("updated") or article.get("created"))
+        self._adjust_totals(row, 1)
+
+        categories = dict.fromkeys(normalize_categories(article.get("category")))
+        if self.pair_count + len(categories) > len(self.pair_row) and self.dead_pairs * 2 > self.pair_count:
+            self._compact_pairs()
+        self._grow_pairs(self.pair_count + len(categories))
+        for cat in categories:
+            cat_id = self.category_ids.get(cat)
+            if cat_id is None:
+                cat_id = self.category_ids[cat] = len(self.category_names)
+                self.category_names.append(cat)
+            self.pair_row[self.pair_count] = row
+            self.pair_cat[self.pair_count] = cat_id
+            self.pair_count += 1
+
+    def _release(self, titles):
+        """記事の行を空きにし、カテゴリーの組をまとめて削除済みにする"""
+        rows = [self.rows.pop(title) for title in titles if title in self.rows]
+        if not rows:
+            return
+        for row in rows:
+            self._adjust_totals(row, -1)
+            self.live[row] = False
+            self.titles[row] = None
+            self.free.append(row)
+        pair_row = self.pair_row[:self.pair_count]
+        dead = pair_row == rows[0] if len(rows) == 1 else np.isin(pair_row, rows)
+        self.dead_pairs += int(np.count_nonzero(dead))
+        pair_row[dead] = -1
+
+    def apply_changes(self, updated, deleted, context=None):
+        """保存時の差分を反映する（変わった記事の行と合計だけを書き換える）"""
+        self._release(list(deleted) + list(updated))
+        for title, article in updated.items():
+            self._insert(title, article, context)
+
+    # 以下はすべて生きている行をまとめて計算する（記事ごとのPythonのループはない）
+
+    @perf.timed("stats.frame")
+    def frame(self):
+        """記事ごとの項目のDataFrame（列: title, length, images, image_bytes, created, updated）"""
+        rows = np.flatnonzero(self.live)
+        data = {"title": [self.titles[row] for row in rows]}
+        data.update({name: column[rows] for name, column in self.columns.items()})
+        return pd.DataFrame(data)
+
+    @perf.timed("stats.length_histogram")
+    def length_histogram(self, bins=12):
+        """本文の文字数の分布（区間を対数で区切る）。(区間の下限の配列, 記事数の配列) を返す"""
+        lengths = self.columns["length"][self.live]
+        if not len(lengths):
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+        edges = np.unique(np.geomspace(1, max(int(lengths.max()), 1) + 1, bins + 1).astype(np.int64))
+        edges = np.concatenate([[0], edges])
+        counts, edges = np.histogram(lengths, edges)
+        return edges[:-1], counts
+
+    @perf.timed("stats.articles_over_time")
+    def articles_over_time(self, unit="M"):
+        """期間（既定は月）ごとの作成数・更新数と累計の記事数のDataFrame"""
+        values = {}
+        for name in ("created", "updated"):
+            periods = self.columns[name][self.live].astype(f"M8[{unit}]")
+            values[name] = periods[~np.isnat(periods)].astype(np.int64)
+        known = [v for v in values.values() if len(v)]
+        first = min(int(v.min()) for v in known) if known else 0
+        last = max(int(v.max()) for v in known) if known else -1
+        # 期間の番号から最初の期間を引いて数えるので、並べ替えずに1回で数えられる（記事のない期間も0件として並ぶ）
+        counts = {name: np.bincount(v - first, minlength=last - first + 1) for name, v in values.items()}
+        periods = np.arange(first, last + 1).astype(f"M8[{unit}]").astype("M8[s]")
+        frame = pd.DataFrame(counts, index=pd.DatetimeIndex(periods, name="period"))
+        frame["total"] = frame["created"].cumsum()
+        return frame
+
+    def _top_categories(self, top):
+        pairs = self._live_pairs()
+        cats = self.pair_cat[pairs]
+        counts = np.bincount(cats, minlength=len(self.category_names))
+        order = np.argsort(-counts, kind="stable")[:top]
+        return order[counts[order] > 0], pairs
+
+    @perf.timed("stats.category_cooccurrence")
+    def category_cooccurrence(self, top=10):
+        """記事数の多い上位topカテゴリーの組み合わせごとの記事数（対角成分は各カテゴリーの記事数）"""
+        ids, pairs = self._top_categories(top)
+        column_of = np.full(len(self.category_names), -1, np.int64)
+        column_of[ids] = np.arange(len(ids))
+        columns = column_of[self.pair_cat[pairs]]
+        selected = columns >= 0
+        # 行列の積はfloat32で計算する（整数の積はBLASを使わないので遅い）
+        membership = np.zeros((len(self.live), len(ids)), np.float32)
+        membership[self.pair_row[pairs][selected], columns[selected]] = 1
+        names = [self.category_names[i] for i in ids]
+        return pd.DataFrame((membership.T @ membership).round().astype(np.int64), index=names, columns=names)
+
+    @perf.timed("stats.category_totals")
+    def category_totals(self, top=20):
+        """上位topカテゴリーの記事数・総文字数・画像の合計サイズのDataFrame（記事数の多い順）"""
+        ids, pairs = self._top_categories(top)
+        rows = self.pair_row[pairs]
+        cats = self.pair_cat[pairs]
+        size = len(self.category_names)
+        frame = pd.DataFrame({
+            "articles": np.bincount(cats, minlength=size)[ids],
+            "chars": np.bincount(cats, weights=self.columns["length"][rows], minlength=size)[ids].astype(np.int64),
+            "image_bytes": np.bincount(cats, weights=self.columns["image_bytes"][rows],
+                                       minlength=size)[ids].astype(np.int64),
+        }, index=[self.category_names[i] for i in ids])
+        return frame
+
+
+def _encode(array):
+    # バイナリ形式では配列のバイト列のまま、JSON形式では数値のリストで保存する
+    if codec.binary_enabled():
+        return array.tobytes()
+    if array.dtype.kind == "M":
+        return array.astype("<i8").tolist()
+    return array.tolist()
+
+
+def _decode(value, dtype):
+    if isinstance(value, bytes):
+        return np.frombuffer(value, dtype)
+    if dtype.kind == "M":
+        return np.array(value, "<i8").astype(dtype)
+    return np.array(value, dtype)
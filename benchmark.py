@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from io import BytesIO
+from datetime import datetime, timedelta
+
+# 計測する記事数（1k / 10k / 100k）
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+_HIRAGANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん"
+_KATAKANA = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン"
+_KANJI = "日本語言語技術歴史科学文化情報記事世界計算機関数理論音楽地域料理自然社会経済生物物理化学"
+_JAPANESE_CHARS = _HIRAGANA * 3 + _KATAKANA + _KANJI * 2
+_ENGLISH_WORDS = ("system", "language", "history", "science", "network", "music", "river", "city",
+                  "theory", "engine", "protocol", "garden", "market", "library", "planet", "signal")
+
+
+class CorpusConfig:
+    """合成する百科事典のデータの設定"""
+
+    def __init__(self, articles=1000, users=1, japanese_ratio=0.7, content_chars=(200, 1500),
+                 categories=50, categories_per_article=(1, 3), mentions_per_article=(0, 5),
+                 image_ratio=0.05, seed=0):
+        self.articles = articles                      # ユーザーごとの記事数
+        self.users = users
+        self.japanese_ratio = japanese_ratio          # 日本語の記事の割合（残りは英語）
+        self.content_chars = content_chars            # 本文の文字数の範囲
+        self.categories = categories                  # カテゴリーの種類の数
+        self.categories_per_article = categories_per_article
+        self.mentions_per_article = mentions_per_article  # 本文中で他の記事のタイトルに触れる回数
+        self.image_ratio = image_ratio                # 画像付きの記事の割合
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+def _japanese_text(rng, length):
+    # ひらがなを多めに、カタカナと漢字を混ぜる（句点もときどき入れる）
+    chars = rng.choices(_JAPANESE_CHARS, k=length)
+    for i in range(rng.randrange(40), length, 40):
+        chars[i] = "。"
+    return "".join(chars)
+
+
+def _english_text(rng, length):
+    return " ".join(rng.choices(_ENGLISH_WORDS, k=length // 6 + 1))[:length]
+
+
+def _make_titles(rng, config):
+    titles = set()
+    while len(titles) < config.articles:
+        if rng.random() < config.japanese_ratio:
+            titles.add(_japanese_text(rng, rng.randint(2, 8)))
+        else:
+            titles.add(" ".join(rng.choice(_ENGLISH_WORDS).capitalize() for _ in range(rng.randint(1, 3)))
+                       + f" {rng.randint(1, 9999)}")
+    return sorted(titles)
+
+
+# 画像のテスト用データ（ノイズを含むJPEG）を作成
+def make_test_image(rng, size=(1600, 1200)):
+    from PIL import Image
+    img = Image.effect_noise(size, rng.randint(20, 80)).convert("RGB")
+    buffered = BytesIO()
+    img.save(buffered, format="JPEG", quality=90)
+    return buffered.getvalue()
+
+
+# 合成した百科事典のデータを作成
+def generate_corpus(config, image_refs=()):
+    """ユーザー名 → {タイトル: 記事} の辞書を返す
+
+    image_refsを渡すと、画像付きの記事にはその中からランダムに画像の参照を付ける。
+    """
+    rng = random.Random(config.seed)
+    category_names = [f"カテゴリー{i}" if i % 2 == 0 else f"category-{i}" for i in range(config.categories)]
+    corpus = {}
+    for user_index in range(config.users):
+        titles = _make_titles(rng, config)
+        created = datetime(2024, 1, 1)
+        articles = {}
+        for title in titles:
+            length = rng.randint(*config.content_chars)
+            japanese = rng.random() < config.japanese_ratio
+            text = _japanese_text(rng, length) if japanese else _english_text(rng, length)
+            # 他の記事のタイトルを本文のランダムな位置に埋め込む
+            for _ in range(rng.randint(*config.mentions_per_article)):
+                position = rng.randint(0, len(text))
+                text = text[:position] + rng.choice(titles) + text[position:]
+            images = []
+            if image_refs and rng.random() < config.image_ratio:
+                images = rng.sample(list(image_refs), min(len(image_refs), rng.randint(1, 3)))
+            created += timedelta(minutes=rng.randint(1, 600))
+            articles[title] = {
+                "category": rng.sample(category_names, min(config.categories, rng.randint(*config.categories_per_article))),
+                "content": text,
+                "images": images,
+                "created": created.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+        corpus[f"user{user_index}"] = articles
+    return corpus
+
+
+# 関数の実行時間を計測
+def measure(func, repeat=5):
+    """ミリ秒単位の統計を返す（1回目も含めて計測する）"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return {"repeat": repeat, "min_ms": min(times), "median_ms": statistics.median(times),
+            "mean_ms": statistics.fmean(times), "max_ms": max(times)}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class _UploadedImage(BytesIO):
+    """Streamlitのアップロードファイルの代わり"""
+
+
+# 1つの記事数で各処理を計測
+def run_size(config, repeat=5, image_count=4):
+    """計測結果の辞書を返す（一時ディレクトリにデータを作成して計測する）"""
+    import storage
+    from storage import (load_users, create_user, get_user_encyclopedia, save_user_encyclopedia,
+                         get_blob_store, get_thumbnail_cache, search_articles, suggest_titles,
+                         related_articles)
+    from article_links import create_article_links
+    from images import encode_image, decode_image
+
+    rng = random.Random(config.seed)
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="encyclopedia-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)  # storageのデータディレクトリは作業ディレクトリからの相対パス
+    try:
+        # storageはユーザー名でキャッシュするので、記事数ごとに別のユーザー名にする
+        usernames = [f"bench{config.articles}-user{i}" for i in range(config.users)]
+        for username in usernames:
+            create_user(username, "x" * 64, "2024-01-01 00:00:00")
+
+        # 画像の変換と読み込み
+        store = get_blob_store(usernames[0])
+        thumbnails = get_thumbnail_cache(usernames[0])
+        photos = [make_test_image(rng) for _ in range(image_count)]
+        refs = [encode_image(_UploadedImage(photo), store, thumbnails) for photo in photos]
+        results["encode_image"] = measure(lambda: encode_image(_UploadedImage(rng.choice(photos)), store), repeat)
+        results["decode_image"] = measure(lambda: decode_image(rng.choice(refs), store), repeat)
+
+        corpus = dict(zip(usernames, generate_corpus(config, refs).values()))
+        username = usernames[0]
+
+        def bulk_save():
+            # 記事の取り込みと同じく、インデックスの作り直しとコンパクションは最後に1回だけ行う
+            for name in usernames:
+                with storage.bulk_changes(name):
+                    encyclopedia = get_user_encyclopedia(name)
+                    for title, article in corpus[name].items():
+                        encyclopedia[title] = article
+                    save_user_encyclopedia(name, encyclopedia)
+        results["save_user_encyclopedia_bulk"] = measure(bulk_save, 1)
+
+        results["load_users"] = measure(load_users, repeat)
+
+        def cold_load():
+            storage._shared.clear()  # プロセス内で共有しているデータを捨てて、ディスクから読み込む
+            return get_user_encyclopedia(username)
+        results["get_user_encyclopedia_cold"] = measure(cold_load, repeat)
+        results["get_user_encyclopedia_warm"] = measure(lambda: get_user_encyclopedia(username), repeat)
+
+        encyclopedia = get_user_encyclopedia(username)
+        titles = list(corpus[username])
+
+        def edit_and_save():
+            title = rng.choice(titles)
+            article = dict(encyclopedia[title])
+            article["content"] = article["content"] + "。"
+            encyclopedia[title] = article
+            save_user_encyclopedia(username, encyclopedia, check_user=False)
+        results["save_user_encyclopedia_single"] = measure(edit_and_save, repeat)
+
+        def link_articles():
+            for title in rng.sample(titles, min(20, len(titles))):
+                create_article_links(encyclopedia[title]["content"], titles, title)
+        results["create_article_links_x20"] = measure(link_articles, repeat)
+
+        queries = [rng.choice(titles)[:4] for _ in range(repeat)]
+        query_iter = iter(queries * 2)
+        results["search_articles"] = measure(lambda: search_articles(username, next(query_iter), 30), repeat)
+
+        # 入力候補（前方一致と、1文字変えた誤字を含む検索語）
+        suggest_queries = [rng.choice(titles)[:6] for _ in range(repeat)]
+        suggest_queries += [query[:2] + "x" + query[3:] for query in suggest_queries]
+        suggest_iter = iter(suggest_queries * 2)
+        storage.get_index(username, "titles")  # 索引の作成は計測に含めない
+        results["suggest_titles"] = measure(lambda: suggest_titles(username, next(suggest_iter), 10), repeat * 2)
+
+        # 記事を開いたときの関連記事（一覧は保存済みなので、索引の作成は計測に含めない）
+        storage.get_index(username, "related")
+        results["related_articles"] = measure(lambda: related_articles(username, rng.choice(titles), 10), repeat)
+
+        category_names = encyclopedia.categories.names()
+        results["category_filter"] = measure(
+            lambda: sorted(encyclopedia.categories.titles(rng.choice(category_names))), repeat)
+
+        # 統計情報の画面と同じ集計（索引の作成は計測に含めない）
+        stats = storage.get_article_stats(username)
+
+        def stats_aggregation():
+            return (len(encyclopedia), len(encyclopedia.categories), dict(stats.totals), encyclopedia.categories.counts(),
+                    stats.length_histogram(), stats.articles_over_time(), stats.category_cooccurrence(10),
+                    stats.category_totals(20))
+        results["stats_aggregation"] = measure(stats_aggregation, repeat)
+        results["title_page"] = measure(lambda: encyclopedia.titles[len(encyclopedia) // 2:len(encyclopedia) // 2 + 50],
+                                        repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+# すべての記事数で計測して結果をまとめる
+def run(sizes=DEFAULT_SIZES, repeat=5, **config_options):
+    report = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "results": {},
+    }
+    for size in sizes:
+        config = CorpusConfig(articles=size, **config_options)
+        report.setdefault("config", {k: v for k, v in config.to_dict().items() if k != "articles"})
+        started = time.perf_counter()
+        report["results"][str(size)] = run_size(config, repeat)
+        print(f"{size}記事: {time.perf_counter() - started:.1f}秒", file=sys.stderr)
+    return report
+
+
+if __name__ == "__main__":
+    # ベンチマーク: python benchmark.py [--sizes 1000 10000 100000] [-o bench.json]
+    parser = argparse.ArgumentParser(description="百科事典アプリの主要な処理の実行時間を計測する")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="ユーザーごとの記事数")
+    parser.add_argument("--users", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--japanese-ratio", type=float, default=0.7)
+    parser.add_argument("--content-chars", type=int, nargs=2, default=(200, 1500), metavar=("MIN", "MAX"))
+    parser.add_argument("--categories", type=int, default=50)
+    parser.add_argument("--mentions", type=int, nargs=2, default=(0, 5), metavar=("MIN", "MAX"))
+    parser.add_argument("--image-ratio", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="結果を書き込むJSONファイル（省略時は標準出力）")
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.repeat, users=args.users, japanese_ratio=args.japanese_ratio,
+                 content_chars=tuple(args.content_chars), categories=args.categories,
+                 mentions_per_article=tuple(args.mentions), image_ratio=args.image_ratio, seed=args.seed)
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,156 @@
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import perf
+import codec
+from bodystore import image_refs
+
+_REF_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+# 画像データが参照（SHA-256ハッシュ）かどうかを判定（旧形式はBase64文字列）
+def is_blob_ref(value):
+    return isinstance(value, str) and _REF_PATTERN.match(value) is not None
+
+
+# mtimeがgrace_seconds以上前のファイルを削除する
+def _remove_unless_recent(path, cutoff):
+    try:
+        if os.path.getmtime(path) > cutoff:
+            return False
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+class BlobStore:
+    """内容ハッシュをキーに画像の生バイトをディスクに保存するストア"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, ref):
+        return os.path.join(self.root, ref[:2], ref)
+
+    def exists(self, ref):
+        return os.path.exists(self.path(ref))
+
+    def put(self, data):
+        """バイト列を保存して参照を返す（同じ内容は1つだけ保存される）"""
+        ref = hashlib.sha256(data).hexdigest()
+        path = self.path(ref)
+        if not os.path.exists(path):
+            codec.replace_file(path, lambda f: f.write(data))
+        return ref
+
+    def read(self, ref):
+        with open(self.path(ref), "rb") as f:
+            return f.read()
+
+    def refs(self):
+        if not os.path.isdir(self.root):
+            return
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if is_blob_ref(name):
+                    yield name
+
+    def gc(self, live_refs, grace_seconds=600):
+        """参照されていないblobを削除する
+
+        保存前の別セッションがアップロードしたばかりのblobを消さないよう、
+        grace_seconds以内に作成されたものは残す。
+        """
+        live_refs = set(live_refs)
+        cutoff = time.time() - grace_seconds
+        removed = 0
+        for ref in list(self.refs()):
+            if ref not in live_refs and _remove_unless_recent(self.path(ref), cutoff):
+                removed += 1
+        return removed
+
+
+class ThumbnailCache:
+    """元画像の参照をキーにサムネイルを保存するキャッシュ
+
+    ディスクに保存したサムネイルを、プロセス全体で共有するLRUでメモリにも保持する。
+    キーが内容ハッシュなので、キャッシュが古くなることはない。
+    """
+
+    max_memory_items = 512
+    _memory = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, ref):
+        return os.path.join(self.root, ref[:2], ref + ".jpg")
+
+    def exists(self, ref):
+        return os.path.exists(self.path(ref))
+
+    def get(self, ref):
+        """サムネイルのバイト列を返す（未作成ならNone）"""
+        path = self.path(ref)
+        with self._lock:
+            if path in self._memory:
+                self._memory.move_to_end(path)
+                perf.count("thumbnails.cache.hit")
+                return self._memory[path]
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            perf.count("thumbnails.missing")
+            return None
+        perf.count("thumbnails.cache.miss")
+        self._remember(path, data)
+        return data
+
+    def put(self, ref, data):
+        path = self.path(ref)
+        codec.replace_file(path, lambda f: f.write(data))
+        self._remember(path, data)
+
+    def _remember(self, path, data):
+        with self._lock:
+            self._memory[path] = data
+            self._memory.move_to_end(path)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+
+    def gc(self, live_refs, grace_seconds=600):
+        """元画像が参照されなくなったサムネイルを削除する"""
+        if not os.path.isdir(self.root):
+            return 0
+        live_refs = set(live_refs)
+        cutoff = time.time() - grace_seconds
+        removed = 0
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                ref = name[:-len(".jpg")]
+                if name.endswith(".jpg") and ref not in live_refs \
+                        and _remove_unless_recent(os.path.join(prefix_dir, name), cutoff):
+                    removed += 1
+        return removed
+
+
+# 記事データから参照されているblobの一覧（本文ファイルに保存済みの記事は本文を読み込まない）
+def referenced_blobs(encyclopedia):
+    refs = set()
+    for article in encyclopedia.values():
+        for image in image_refs(article):
+            if is_blob_ref(image):
+                refs.add(image)
+    return refs
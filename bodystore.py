@@ -0,0 +1,153 @@
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from collections.abc import Mapping
+import perf
+import codec
+
+# 一覧には不要で、記事を開いたときだけ読み込む項目
+BODY_FIELDS = ("content", "images")
+
+
+class BodyStore:
+    """記事の本文と画像の参照を1件ずつ追記するファイル
+
+    書き込んだ位置は変わらないので、スナップショットに保存した (位置, 長さ) から
+    ファイル全体を読まずに1件だけ取り出せる。
+    """
+
+    # 開いている記事は再実行のたびに何度も参照されるので、最近読んだ本文をプロセス全体で保持する
+    max_memory_items = 64
+    _memory = OrderedDict()
+    _memory_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def pin(self):
+        """ファイルを開いたままにし、コンパクションで削除された後もこの世代の本文を読めるようにする
+
+        ファイルが既にない場合はFileNotFoundErrorになる。開いたファイルはこのオブジェクトと一緒に閉じる。
+        """
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            weakref.finalize(self, os.close, self._fd)
+        return self
+
+    def size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def append(self, bodies):
+        """本文のリストを追記し、それぞれの (位置, 長さ) を返す（fsyncは1回だけ）"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        refs = []
+        with open(self.path, "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            chunks = []
+            for body in bodies:
+                # 1件ずつJSONの行かmsgpackで書く（読み込むときに1件ごとに形式を判定する）
+                data = codec.dump_record(body)
+                refs.append((offset, len(data)))
+                chunks.append(data)
+                offset += len(data)
+            f.write(b"".join(chunks))
+            f.flush()
+            os.fsync(f.fileno())
+        return refs
+
+    def read_raw(self, offset, length):
+        if self._fd is not None and hasattr(os, "pread"):
+            return os.pread(self._fd, length, offset)
+        # Windowsでは開いているファイルは削除されないので、パスから開き直せる
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def read(self, offset, length):
+        key = (self.path, offset)
+        with self._memory_lock:
+            body = self._memory.get(key)
+            if body is not None:
+                self._memory.move_to_end(key)
+        if body is not None:
+            perf.count("bodystore.cache.hit")
+            return body
+        perf.count("bodystore.cache.miss")
+        with perf.span("bodystore.read"):
+            body = codec.load_record(self.read_raw(offset, length))
+        with self._memory_lock:
+            self._memory[key] = body
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+        return body
+
+
+class LazyArticle(Mapping):
+    """本文と画像を必要になったときにBodyStoreから読み込む記事
+
+    タイトル一覧やカテゴリー、日付、文字数などは読み込み時に持っている情報だけで返せる。
+    """
+
+    __slots__ = ("meta", "store", "ref")
+
+    def __init__(self, meta, store, ref):
+        self.meta = meta    # 本文と画像以外の項目
+        self.store = store
+        self.ref = ref      # [位置, 長さ, 本文の文字数, 画像の数, 画像のblobの参照のリスト（画像があるときだけ）]
+
+    def body(self):
+        return self.store.read(self.ref[0], self.ref[1])
+
+    def __getitem__(self, key):
+        if key in BODY_FIELDS:
+            return self.body()[key]
+        return self.meta[key]
+
+    def __contains__(self, key):
+        if key in BODY_FIELDS:
+            return key in self.body()
+        return key in self.meta
+
+    def __iter__(self):
+        yield from self.meta
+        yield from self.body()
+
+    def __len__(self):
+        return len(self.meta) + len(self.body())
+
+    def __repr__(self):
+        return f"LazyArticle({self.meta!r}, {self.store.path!r}, {self.ref!r})"
+
+
+# 記事を一覧用の項目と本文に分ける
+def split_article(article):
+    meta = {key: value for key, value in article.items() if key not in BODY_FIELDS}
+    body = {key: article[key] for key in BODY_FIELDS if key in article}
+    return meta, body
+
+
+# 本文の文字数（LazyArticleなら本文を読み込まずに返す）
+def content_length(article):
+    if isinstance(article, LazyArticle):
+        return article.ref[2]
+    return len(article.get("content", ""))
+
+
+# 画像の数（LazyArticleなら本文を読み込まずに返す）
+def image_count(article):
+    if isinstance(article, LazyArticle):
+        return article.ref[3]
+    return len(article.get("images", []))
+
+
+# 画像の参照のリスト（LazyArticleならスナップショットに保存したblobの参照を返し、本文を読み込まない）
+def image_refs(article):
+    if isinstance(article, LazyArticle):
+        if not article.ref[3]:
+            return []
+        if len(article.ref) > 4:
+            return article.ref[4]
+        # 画像の参照を持たない古いスナップショットは本文から読む
+    return article.get("images", [])
@@ -0,0 +1,157 @@
+from title_index import SortedTitles
+
+UNCATEGORIZED = "未分類"
+
+
+# カテゴリーをリスト形式にそろえる（旧形式の文字列や未設定にも対応）
+def normalize_categories(value):
+    if isinstance(value, str):
+        value = [value]
+    categories = [cat for cat in (value or []) if cat]
+    return categories or [UNCATEGORIZED]
+
+
+class CategoryIndex:
+    """カテゴリー → 記事タイトルの索引
+
+    記事の追加・削除のたびに更新するので、カテゴリーの一覧や件数を
+    記事数ではなくカテゴリー数に比例する時間で求められる。
+    """
+
+    def __init__(self):
+        self._titles = {}  # カテゴリー → タイトルの集合
+        self._sorted = {}  # カテゴリー → ソート済みのタイトルのリスト（一覧の表示で求めたものを取っておく）
+
+    @classmethod
+    def build(cls, encyclopedia):
+        index = cls()
+        for title, article in encyclopedia.items():
+            index.add(title, article)
+        return index
+
+    def copy(self):
+        index = CategoryIndex()
+        index._titles = {cat: set(titles) for cat, titles in self._titles.items()}
+        return index
+
+    def add(self, title, article):
+        for cat in normalize_categories(article.get("category")):
+            self._titles.setdefault(cat, set()).add(title)
+            self._sorted.pop(cat, None)
+
+    def remove(self, title, article):
+        for cat in normalize_categories(article.get("category")):
+            self._sorted.pop(cat, None)
+            titles = self._titles.get(cat)
+            if titles is not None:
+                titles.discard(title)
+                if not titles:
+                    del self._titles[cat]
+
+    def names(self):
+        """カテゴリー名の一覧（名前順）"""
+        return sorted(self._titles)
+
+    def counts(self):
+        """[(カテゴリー名, 記事数)] を記事数の多い順に返す"""
+        return sorted(((cat, len(titles)) for cat, titles in self._titles.items()),
+                      key=lambda item: item[1], reverse=True)
+
+    def titles(self, category):
+        """カテゴリーに属する記事のタイトルの集合"""
+        return self._titles.get(category, set())
+
+    def sorted_titles(self, category):
+        """カテゴリーに属する記事のタイトルのソート済みリスト（並べ替えるのはカテゴリーが変わった後の1回だけ）"""
+        titles = self._sorted.get(category)
+        if titles is None:
+            titles = self._sorted[category] = sorted(self.titles(category))
+        return titles
+
+    def __len__(self):
+        return len(self._titles)
+
+
+class CategoryOverlay:
+    """共有のCategoryIndexにセッション内の変更を重ねた索引
+
+    共有の索引は書き換えず、追加・削除されたタイトルだけを持つので、
+    変更した記事数とカテゴリー数に比例する時間で一覧や件数を求められる。
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self._added = {}    # カテゴリー → 追加されたタイトルの集合
+        self._removed = {}  # カテゴリー → 取り除かれたタイトルの集合
+
+    @classmethod
+    def over(cls, index):
+        """CategoryIndexか、それに重ねたCategoryOverlayの上に変更を重ねる（重ねは1段にする）"""
+        return index.copy() if isinstance(index, cls) else cls(index)
+
+    def copy(self):
+        """共有の索引はそのまま使い、変更分だけをコピーする"""
+        overlay = CategoryOverlay(self.base)
+        overlay._added = {cat: set(titles) for cat, titles in self._added.items()}
+        overlay._removed = {cat: set(titles) for cat, titles in self._removed.items()}
+        return overlay
+
+    def flatten(self):
+        """変更を反映したCategoryIndexを作る（カテゴリーごとの記事数に比例する時間がかかる）"""
+        index = CategoryIndex()
+        index._titles = {cat: set(self.titles(cat)) for cat in self._counts()}
+        return index
+
+    def add(self, title, article):
+        for cat in normalize_categories(article.get("category")):
+            self._removed.get(cat, set()).discard(title)
+            if title not in self.base.titles(cat):
+                self._added.setdefault(cat, set()).add(title)
+
+    def remove(self, title, article):
+        for cat in normalize_categories(article.get("category")):
+            self._added.get(cat, set()).discard(title)
+            if title in self.base.titles(cat):
+                self._removed.setdefault(cat, set()).add(title)
+
+    def _counts(self):
+        counts = {cat: len(titles) for cat, titles in self.base._titles.items()}
+        for cat, titles in self._added.items():
+            counts[cat] = counts.get(cat, 0) + len(titles)
+        for cat, titles in self._removed.items():
+            counts[cat] -= len(titles)
+        return {cat: count for cat, count in counts.items() if count > 0}
+
+    def names(self):
+        """カテゴリー名の一覧（名前順）"""
+        return sorted(self._counts())
+
+    def counts(self):
+        """[(カテゴリー名, 記事数)] を記事数の多い順に返す"""
+        return sorted(self._counts().items(), key=lambda item: item[1], reverse=True)
+
+    def titles(self, category):
+        """カテゴリーに属する記事のタイトルの集合"""
+        titles = self.base.titles(category)
+        added = self._added.get(category)
+        removed = self._removed.get(category)
+        if removed:
+            titles = titles - removed
+        if added:
+            titles = titles | added
+        return titles
+
+    def sorted_titles(self, category):
+        """カテゴリーに属する記事のタイトルをタイトル順に並べたSortedTitles
+
+        共有の索引のソート済みリストに、このカテゴリーで追加・削除されたタイトルだけを重ねる。
+        """
+        titles = SortedTitles(self.base.sorted_titles(category))
+        for title in self._removed.get(category, ()):
+            titles.remove(title)
+        for title in self._added.get(category, ()):
+            titles.add(title)
+        return titles
+
+    def __len__(self):
+        return len(self._counts())
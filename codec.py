@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import zlib
+import tempfile
+import threading
+from array import array
+
+try:
+    import msgpack
+except ImportError:  # msgpackがなければJSONで保存する
+    msgpack = None
+try:
+    import zstandard
+except ImportError:  # zstandardがなければzlib（gzipと同じDeflate）で圧縮する
+    zstandard = None
+
+# 保存形式（"binary": msgpack＋圧縮、"json": 従来のJSON）。読み込みはどちらの形式でも自動で判定する
+STORAGE_FORMAT = os.environ.get("ENCYCLOPEDIA_STORAGE_FORMAT", "binary")
+
+# バイナリ形式のファイルの先頭に付ける識別子と形式のバージョン
+MAGIC = b"ENCB"
+FORMAT_VERSION = 1
+
+# 圧縮方式の番号（ファイルの見出しと記事の本文に記録する）
+COMPRESS_NONE = 0
+COMPRESS_ZLIB = 1
+COMPRESS_ZSTD = 2
+
+# これより短い本文は圧縮しない（圧縮しても小さくならず、展開の手間だけかかる）
+COMPRESS_MIN_BYTES = 256
+
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 6
+
+
+_local = threading.local()  # zstdの圧縮・展開器はスレッドごとに使い回す
+
+
+def binary_enabled():
+    return STORAGE_FORMAT == "binary" and msgpack is not None
+
+
+def _compress(data):
+    """(圧縮方式, 圧縮したバイト列) を返す"""
+    if zstandard is not None:
+        if not hasattr(_local, "compressor"):
+            _local.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        return COMPRESS_ZSTD, _local.compressor.compress(data)
+    return COMPRESS_ZLIB, zlib.compress(data, ZLIB_LEVEL)
+
+
+def _decompress(method, data):
+    if method == COMPRESS_NONE:
+        return data
+    if method == COMPRESS_ZLIB:
+        return zlib.decompress(data)
+    if method == COMPRESS_ZSTD:
+        if zstandard is None:
+            raise ValueError("zstdで圧縮されたデータを読み込むにはzstandardが必要です")
+        if not hasattr(_local, "decompressor"):
+            _local.decompressor = zstandard.ZstdDecompressor()
+        return _local.decompressor.decompress(data)
+    raise ValueError(f"不明な圧縮方式です: {method}")
+
+
+def _unpack(data):
+    if msgpack is None:
+        raise ValueError("バイナリ形式のデータを読み込むにはmsgpackが必要です")
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+# ファイル全体をエンコード（スナップショットやインデックス）
+def dumps(obj):
+    """バイナリ形式では 識別子＋バージョン＋圧縮方式＋圧縮したmsgpack のバイト列を返す"""
+    if not binary_enabled():
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    method, payload = _compress(msgpack.packb(obj, use_bin_type=True))
+    return MAGIC + bytes((FORMAT_VERSION, method)) + payload
+
+
+# ファイル全体をデコード（形式は先頭のバイト列で判定する）
+def loads(data):
+    if not data.startswith(MAGIC):
+        return json.loads(data)
+    version, method = data[len(MAGIC)], data[len(MAGIC) + 1]
+    if version > FORMAT_VERSION:
+        raise ValueError(f"新しい形式（バージョン{version}）のデータは読み込めません")
+    return _unpack(_decompress(method, data[len(MAGIC) + 2:]))
+
+
+def load_file(path):
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+# ファイルを一時ファイル経由で保存（fsyncしてからリネームするので途中の状態は見えない）
+def replace_file(path, write):
+    """write(f)で一時ファイルに書き込んでから、pathを置き換える
+
+    一時ファイルは同じディレクトリにmkstempで作るので、他のプロセスの書き込みとも重ならない。
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# 本文ファイルの1件分をエンコード
+def dump_record(body):
+    """バイナリ形式では本文だけを圧縮したmsgpackのマップにする（JSON形式では1行のJSON）"""
+    if not binary_enabled():
+        return json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+    content = body.get("content")
+    if isinstance(content, str):
+        encoded = content.encode("utf-8")
+        if len(encoded) >= COMPRESS_MIN_BYTES:
+            method, compressed = _compress(encoded)
+            if len(compressed) < len(encoded):
+                body = dict(body, content=compressed, compression=method)
+    return msgpack.packb(body, use_bin_type=True)
+
+
+# 本文ファイルの1件分をデコード（JSONの行はそのまま読み込む）
+def load_record(data):
+    if data[:1] == b"{":
+        return json.loads(data)
+    body = _unpack(data)
+    method = body.pop("compression", COMPRESS_NONE)
+    if method != COMPRESS_NONE:
+        body["content"] = _decompress(method, body["content"]).decode("utf-8")
+    return body
+
+
+# 整数のリストを4バイトのリトルエンディアンのバイト列にする（インデックスを列ごとに保存する用）
+def pack_ints(values):
+    packed = array("I", values)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_ints(data):
+    values = array("I")
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
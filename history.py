@@ -0,0 +1,289 @@
+import os
+import json
+import glob
+import time
+import uuid
+import difflib
+import hashlib
+import threading
+import wal
+import perf
+import codec
+from bodystore import BodyStore
+
+# この数の差分ごとに1回、記事全体のコピーを保存する（1つの版の復元で読む件数の上限）
+FULL_INTERVAL = 10
+
+# 保持する期間の既定値（コンパクション時に、これを超えた古い版を捨てる。Noneなら無制限）
+MAX_REVISIONS = 50     # 記事ごとの版の数
+MAX_AGE_DAYS = 365     # 日数
+
+# 書き直した後、古い差分ファイルを読んでいるプロセスのために残しておく時間（秒）
+GRACE_SECONDS = 600
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+# 記事の内容のハッシュ（差分を当てる前に、元にする版が正しいか確かめる用）
+def article_hash(article):
+    data = json.dumps(dict(article), ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+# 本文の行ごとの差分（newの行を置き換えてoldにする [[開始行, 終了行, 置き換える行のリスト]]）
+def text_delta(new, old):
+    new_lines, old_lines = new.splitlines(keepends=True), old.splitlines(keepends=True)
+    matcher = difflib.SequenceMatcher(None, new_lines, old_lines)
+    return [[i1, i2, old_lines[j1:j2]] for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+
+
+def apply_text_delta(text, delta):
+    lines = text.splitlines(keepends=True)
+    for start, end, replacement in reversed(delta):
+        lines[start:end] = replacement
+    return "".join(lines)
+
+
+# 新しい版から古い版を作る差分
+def article_delta(new, old):
+    """本文は行ごとの差分、画像の参照のリストやカテゴリーなどの項目は変わった値をそのまま持つ"""
+    delta = {"base": article_hash(new), "fields": {}, "removed": [key for key in new if key not in old]}
+    for key, value in old.items():
+        if key == "content" and isinstance(value, str) and isinstance(new.get(key), str):
+            if value != new[key]:
+                delta["content"] = text_delta(new[key], value)
+        elif key not in new or new[key] != value:
+            delta["fields"][key] = value
+    return delta
+
+
+def apply_delta(article, delta):
+    if delta["base"] != article_hash(article):
+        # 履歴の記録が途中で失われていると、差分を当てる版が食い違う
+        raise ValueError("変更履歴が途切れているため、この版は復元できません")
+    result = {key: value for key, value in article.items() if key not in delta["removed"]}
+    if "content" in delta:
+        result["content"] = apply_text_delta(article.get("content", ""), delta["content"])
+    result.update(delta["fields"])
+    return result
+
+
+class RevisionHistory:
+    """記事の過去の版
+
+    コミットで置き換えられる前の版を、新しい版からの逆向きの差分として差分ファイルに追記する。
+    一定数ごとに記事全体のコピーを保存するので、どの版も今の記事（または直近のコピー）から
+    FULL_INTERVAL件以内の差分を当てて復元できる。各版の一覧（メタデータ）はhistory.jsonlに追記し、
+    差分そのものは版を開いたときだけ読み込む。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.log_path = os.path.join(directory, "history.jsonl")
+        self.store = None
+        self._lock = threading.RLock()
+        self._entries = {}    # タイトル → 版のメタデータのリスト（古い順）
+        self._offset = 0      # 読み込み済みのログの位置
+        self._inode = None    # 読み込んだログのファイル（書き直されたら読み直す）
+
+    def refresh(self):
+        """他のプロセスが追記した版を読み込む"""
+        with self._lock:
+            try:
+                inode = os.stat(self.log_path).st_ino
+            except FileNotFoundError:
+                inode = None
+            if inode != self._inode:
+                self._entries, self._offset, self._inode, self.store = {}, 0, inode, None
+            if inode is None:
+                return
+            for entry, offset in wal.read_entries(self.log_path, self._offset):
+                if "data" in entry:
+                    self.store = BodyStore(os.path.join(self.directory, entry["data"]))
+                else:
+                    self._add(entry)
+                self._offset = offset
+
+    def _add(self, entry):
+        if "renamed_from" in entry:
+            # 名前を変えた記事はそれまでの履歴を引き継ぐ
+            self._entries[entry["title"]] = self._entries.pop(entry["renamed_from"], [])
+        self._entries.setdefault(entry["title"], []).append(entry)
+
+    def _deltas_since_full(self, title):
+        count = 0
+        for entry in reversed(self._entries.get(title, [])):
+            if entry["kind"] != "delta":
+                break
+            count += 1
+        return count
+
+    @perf.timed("history.record")
+    def record(self, version, ops, previous):
+        """versionのコミットの操作で置き換えられる版を保存する
+
+        previousはコミット前の記事を返す関数（タイトル → 記事。なければNone）。
+        """
+        with self._lock:
+            self.refresh()
+            now = time.strftime(TIME_FORMAT)
+            states = {}    # このコミットの中で先に変更した記事
+            runs = {}      # タイトル → 直近の全体のコピーの後の差分の数
+            pending = []   # (メタデータ, 保存する内容)
+            for op in ops:
+                source = op["from"] if op["op"] == "rename" else op["title"]
+                title = op["to"] if op["op"] == "rename" else op["title"]
+                old = states[source] if source in states else previous(source)
+                new = op.get("article")
+                run = runs.pop(source) if source in runs else self._deltas_since_full(source)
+                states[source] = None
+                states[title] = new
+                if old is None:
+                    continue  # 新しく作った記事にはそれより前の版がない
+                entry = {"title": title, "version": version, "time": now,
+                         "saved": old.get("updated") or old.get("created", "")}
+                if source != title:
+                    entry["renamed_from"] = source
+                if new is None:
+                    entry["kind"], body = "deleted", dict(old)
+                elif run + 1 >= FULL_INTERVAL:
+                    entry["kind"], body = "full", dict(old)
+                else:
+                    entry["kind"], body = "delta", article_delta(new, old)
+                images = body.get("images") if entry["kind"] != "delta" else body["fields"].get("images")
+                if images:
+                    entry["images"] = list(images)
+                runs[title] = run + 1 if entry["kind"] == "delta" else 0
+                pending.append((entry, body))
+            if not pending:
+                return
+            if self.store is None:
+                self._start_log()
+            # 差分を書き込んでから一覧に追記する（一覧にある版の差分は必ず読める）
+            for (entry, _), (offset, length) in zip(pending, self.store.append([body for _, body in pending])):
+                entry["offset"], entry["length"] = offset, length
+            lines = b"".join(json.dumps(entry, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+                             for entry, _ in pending)
+            with open(self.log_path, "a+b") as f:
+                # 書き込み途中でクラッシュした行があれば、つながらないように切り詰めてから追記する
+                wal.truncate_torn_tail(f)
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            for entry, _ in pending:
+                self._add(entry)
+            self._offset = os.path.getsize(self.log_path)
+
+    def _start_log(self):
+        name = f"history-{uuid.uuid4().hex[:8]}.dat"
+        header = json.dumps({"data": name}).encode("utf-8") + b"\n"
+        codec.replace_file(self.log_path, lambda f: f.write(header))
+        self._entries, self._offset, self._inode = {}, len(header), os.stat(self.log_path).st_ino
+        self.store = BodyStore(os.path.join(self.directory, name))
+
+    def revisions(self, title):
+        """記事の過去の版のメタデータを新しい順に返す（内容は読み込まない）"""
+        with self._lock:
+            self.refresh()
+            return [dict(entry) for entry in reversed(self._entries.get(title, []))]
+
+    @perf.timed("history.revision")
+    def revision(self, title, version, current):
+        """versionのコミットで置き換えられる前の版を復元する（なければNone）
+
+        currentは今の記事（削除されていればNone）。直近の全体のコピーか今の記事から、
+        古い方へ差分を当てていく。履歴が途切れていて復元できなければValueErrorになる。
+        """
+        with self._lock:
+            self.refresh()
+            chain = self._entries.get(title, [])
+            index = max((i for i, entry in enumerate(chain) if entry["version"] == version), default=None)
+            if index is None:
+                return None
+            start = next((i for i in range(index, len(chain)) if chain[i]["kind"] != "delta"), len(chain))
+            if start < len(chain):
+                article = dict(self._read(chain[start]))
+            elif current is not None:
+                article = dict(current)
+            else:
+                raise ValueError("変更履歴が途切れているため、この版は復元できません")
+            for entry in reversed(chain[index:start]):
+                article = apply_delta(article, self._read(entry))
+            return article
+
+    def _read(self, entry):
+        return self.store.read(entry["offset"], entry["length"])
+
+    def titles(self):
+        """履歴のある記事のタイトル（削除した記事も含む）"""
+        with self._lock:
+            self.refresh()
+            return list(self._entries)
+
+    def referenced_blobs(self):
+        """保存している版が参照する画像（コンパクションで画像を削除しないようにする）"""
+        with self._lock:
+            self.refresh()
+            return {ref for chain in self._entries.values() for entry in chain for ref in entry.get("images", ())}
+
+    @perf.timed("history.compact")
+    def compact(self, max_revisions=MAX_REVISIONS, max_age_days=MAX_AGE_DAYS):
+        """保持する期間を過ぎた古い版を捨て、残った版だけの差分ファイルと一覧に書き直す
+
+        古い版は新しい版からの差分を持つので、古い方から捨てても残った版は復元できる。
+        記録と同時に実行しないよう、呼び出し側で書き込みのロックを取っておく。
+        捨てた版があればTrueを返す。
+        """
+        with self._lock:
+            self.refresh()
+            cutoff = None
+            if max_age_days is not None:
+                cutoff = time.strftime(TIME_FORMAT, time.localtime(time.time() - max_age_days * 86400))
+            kept = []
+            dropped = 0
+            for chain in self._entries.values():
+                start = 0
+                if max_revisions is not None:
+                    start = max(0, len(chain) - max_revisions)
+                while cutoff is not None and start < len(chain) and chain[start]["time"] < cutoff:
+                    start += 1
+                kept.extend(chain[start:])
+                dropped += start
+            live = sum(entry["length"] for entry in kept)
+            if self.store is None or (not dropped and self.store.size() <= live):
+                self._remove_old_data()
+                return False
+            # 名前の変更を同じ順に読み込めるよう、追記した順（差分ファイル上の位置の順）に書き直す
+            kept.sort(key=lambda entry: entry["offset"])
+            name = f"history-{uuid.uuid4().hex[:8]}.dat"
+            lines = [json.dumps({"data": name}).encode("utf-8") + b"\n"]
+
+            def copy(f):
+                position = 0
+                with open(self.store.path, "rb") as src:
+                    for entry in kept:
+                        src.seek(entry["offset"])
+                        f.write(src.read(entry["length"]))
+                        lines.append(json.dumps(dict(entry, offset=position), ensure_ascii=False,
+                                                separators=(",", ":")).encode("utf-8") + b"\n")
+                        position += entry["length"]
+
+            codec.replace_file(os.path.join(self.directory, name), copy)
+            codec.replace_file(self.log_path, lambda f: f.write(b"".join(lines)))
+            self._inode = None  # 書き直したログを次に読み込む
+            self.refresh()
+            self._remove_old_data()
+            return bool(dropped)
+
+    def _remove_old_data(self):
+        cutoff = time.time() - GRACE_SECONDS
+        current = os.path.basename(self.store.path) if self.store is not None else None
+        for path in glob.glob(os.path.join(self.directory, "history-*.dat")):
+            if os.path.basename(path) == current:
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                # 他のプロセスが先に削除したか、Windowsで開いているセッションがあるので、次のコンパクションで削除する
+                pass
@@ -0,0 +1,255 @@
+import os
+import math
+import base64
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps, ImageSequence, ExifTags
+from blobstore import is_blob_ref
+import perf
+from storage import load_users, get_user_encyclopedia, get_blob_store, get_thumbnail_cache
+
+# サムネイルの最大サイズ（表示幅150pxの2倍で高解像度ディスプレイにも対応）
+THUMBNAIL_SIZE = (300, 300)
+
+# 保存する画像の最大幅（px）
+MAX_WIDTH = 800
+
+# 1枚あたりの保存サイズの目安（バイト）。超える場合は品質を下げて収める
+IMAGE_BYTE_BUDGET = 300 * 1024
+
+# WebPで保存するときに試す品質（高い順）
+WEBP_QUALITIES = (90, 80, 70, 60, 50, 40)
+
+# PNGは縮小不要で目安のサイズに収まっていれば、再圧縮せずそのまま保存する（劣化なし）
+PNG_PASSTHROUGH = True
+
+# 画像の変換を並列に行うスレッド数（PILの縮小・圧縮処理は並列に動く）
+ENCODE_WORKERS = min(4, os.cpu_count() or 1)
+
+
+# 一覧表示用の小さなサムネイルを作成
+@perf.timed("images.make_thumbnail")
+def make_thumbnail(img):
+    """画像を縮小したJPEGのバイト列を返す"""
+    thumb = img.copy()
+    thumb.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+    if thumb.mode != "RGB":
+        # 透過部分は白背景で塗りつぶす
+        rgba = thumb.convert("RGBA")
+        thumb = Image.new("RGB", rgba.size, (255, 255, 255))
+        thumb.paste(rgba, mask=rgba.split()[-1])
+    buffered = BytesIO()
+    thumb.save(buffered, format="JPEG", quality=80, optimize=True)
+    return buffered.getvalue()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode-image")
+        return _executor
+
+
+# 開いた画像の向きを補正し、保存用の幅に縮小する
+def _prepare_for_encoding(img):
+    """(画像, 元の形式, 縮小や回転をしたかどうか) を返す"""
+    source_format = img.format
+    orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+    # 90度回転している写真は、補正後の幅が元の高さになる
+    width = img.height if orientation in (5, 6, 7, 8) else img.width
+    if source_format == "JPEG" and width > MAX_WIDTH:
+        # 大きなJPEGはデコード時に1/2〜1/8に縮小して読み込み、変換の手間を減らす
+        scale = MAX_WIDTH / width
+        img.draft("RGB", (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+    img = ImageOps.exif_transpose(img)
+    resized = img.width > MAX_WIDTH
+    if resized:
+        new_height = int(img.height * MAX_WIDTH / img.width)
+        img = img.resize((MAX_WIDTH, new_height), Image.Resampling.LANCZOS)
+    return img, source_format, resized or orientation != 1
+
+
+# 目安のサイズに収まる最も高い品質でWebPに変換
+def _encode_webp(img, budget=IMAGE_BYTE_BUDGET):
+    if img.mode not in ("RGB", "RGBA"):
+        has_alpha = img.mode in ("LA", "PA") or "transparency" in img.info
+        img = img.convert("RGBA" if has_alpha else "RGB")
+
+    def save(quality):
+        buffered = BytesIO()
+        img.save(buffered, format="WEBP", quality=quality, method=4)
+        return buffered.getvalue()
+
+    return _fit_budget(save, budget)
+
+
+# アニメーション（GIF・WebP・APNG）をすべてのコマの入ったWebPに変換
+def _encode_animated_webp(img, budget=IMAGE_BYTE_BUDGET):
+    frames, durations = [], []
+    for frame in ImageSequence.Iterator(img):
+        durations.append(frame.info.get("duration", 100))
+        frame = frame.convert("RGBA")
+        if frame.width > MAX_WIDTH:
+            frame = frame.resize((MAX_WIDTH, int(frame.height * MAX_WIDTH / frame.width)), Image.Resampling.LANCZOS)
+        frames.append(frame)
+
+    def save(quality):
+        buffered = BytesIO()
+        frames[0].save(buffered, format="WEBP", save_all=True, append_images=frames[1:], duration=durations,
+                       loop=img.info.get("loop", 0), quality=quality, method=4)
+        return buffered.getvalue()
+
+    return _fit_budget(save, budget)
+
+
+# save(品質)の結果のうち、目安のサイズに収まる最も高い品質のものを返す
+def _fit_budget(save, budget):
+    best = save(WEBP_QUALITIES[0])
+    if len(best) <= budget:
+        return best
+    # 収まらない場合は品質を二分探索する（最低品質でも収まらなければその結果を使う）
+    low, high = 1, len(WEBP_QUALITIES) - 1
+    fallback = None
+    while low <= high:
+        mid = (low + high) // 2
+        data = save(WEBP_QUALITIES[mid])
+        if len(data) <= budget:
+            best, high = data, mid - 1
+        else:
+            fallback, low = data, mid + 1
+    return best if len(best) <= budget else fallback
+
+
+# 1枚の画像を変換して保存（スレッドプールから呼ばれる）
+@perf.timed("images.encode_bytes")
+def _encode_bytes(data, store, thumbnails=None, keep_webp=False):
+    """画像として読み込めないデータはValueErrorにする（保存時のOSErrorはそのまま送出する）"""
+    try:
+        img = Image.open(BytesIO(data))
+        if getattr(img, "is_animated", False):
+            # 1コマ目だけにならないよう、小さければそのまま、大きければアニメーションのWebPにする
+            img.load()
+            if img.width <= MAX_WIDTH and len(data) <= IMAGE_BYTE_BUDGET:
+                encoded = data
+            else:
+                encoded = _encode_animated_webp(img)
+            img.seek(0)
+        else:
+            img, source_format, changed = _prepare_for_encoding(img)
+            # 途中で切れたファイルなどは、保存を始める前にここでデコードに失敗させる
+            img.load()
+            passthrough = (source_format == "PNG" and PNG_PASSTHROUGH) or (source_format == "WEBP" and keep_webp)
+            if passthrough and not changed and len(data) <= IMAGE_BYTE_BUDGET:
+                encoded = data
+            else:
+                encoded = _encode_webp(img)
+    except (OSError, SyntaxError, EOFError) as e:
+        raise ValueError(f"画像として読み込めません: {e}") from e
+    # 同じ画像は同じ参照になるため重複して保存されない
+    ref = store.put(encoded)
+    if thumbnails is not None and not thumbnails.exists(ref):
+        thumbnails.put(ref, make_thumbnail(img))
+    return ref
+
+
+# 画像をエンコードしてblobストアに保存
+def encode_image(image_file, store, thumbnails=None):
+    """アップロードされた画像を変換して保存し、内容ハッシュの参照を返す
+
+    幅800pxまでに縮小してWebPで保存する。thumbnailsを渡すと一覧表示用のサムネイルも同時に作成する。
+    """
+    if image_file is None:
+        return None
+    image_file.seek(0)
+    return _encode_bytes(image_file.read(), store, thumbnails)
+
+
+# 複数の画像をまとめてエンコード
+@perf.timed("images.encode_images")
+def encode_images(image_files, store, thumbnails=None):
+    """アップロードされた画像を並列に変換して保存し、参照のリストを元の順番で返す"""
+    if not image_files:
+        return []
+    contents = []
+    for image_file in image_files:
+        # アップロードされたファイルの読み込みは呼び出し元のスレッドで行う
+        image_file.seek(0)
+        contents.append(image_file.read())
+    return encode_image_data(contents, store, thumbnails)
+
+
+# 読み込み済みの画像のバイト列をまとめてエンコード
+def encode_image_data(contents, store, thumbnails=None, keep_webp=False):
+    """並列に変換して保存し、参照のリストを元の順番で返す
+
+    keep_webpを指定すると、変換済みのWebP（書き出したアーカイブの画像など）は再圧縮せずに保存する。
+    """
+    if len(contents) == 1:
+        return [_encode_bytes(contents[0], store, thumbnails, keep_webp)]
+    futures = [_get_executor().submit(_encode_bytes, data, store, thumbnails, keep_webp) for data in contents]
+    return [future.result() for future in futures]
+
+
+# 参照から画像を読み込む
+@perf.timed("images.decode_image")
+def decode_image(image_ref, store):
+    """blobストアの画像を読み込んで開く（旧形式のBase64文字列にも対応）"""
+    if not image_ref:
+        return None
+    if not is_blob_ref(image_ref):
+        return Image.open(BytesIO(base64.b64decode(image_ref)))
+    if not store.exists(image_ref):
+        return None
+    return Image.open(BytesIO(store.read(image_ref)))
+
+
+# 一覧表示用のサムネイルを取得
+@perf.timed("images.load_thumbnail")
+def load_thumbnail(image_ref, store, thumbnails):
+    """サムネイルのバイト列を返す（未作成の場合は元画像から作成してキャッシュする）"""
+    if not image_ref:
+        return None
+    if not is_blob_ref(image_ref):
+        img = decode_image(image_ref, store)
+        return make_thumbnail(img) if img else None
+    data = thumbnails.get(image_ref)
+    if data is None:
+        img = decode_image(image_ref, store)
+        if img is None:
+            return None
+        data = make_thumbnail(img)
+        thumbnails.put(image_ref, data)
+    return data
+
+
+# 既存の記事の画像にサムネイルをまとめて作成
+def backfill_thumbnails(usernames=None):
+    """サムネイルが未作成の画像を処理し、作成した枚数を返す"""
+    if usernames is None:
+        usernames = list(load_users().keys())
+    created = 0
+    for username in usernames:
+        store = get_blob_store(username)
+        thumbnails = get_thumbnail_cache(username)
+        for article in get_user_encyclopedia(username).values():
+            for image_ref in article.get("images", []):
+                if not is_blob_ref(image_ref) or thumbnails.exists(image_ref):
+                    continue
+                img = decode_image(image_ref, store)
+                if img is not None:
+                    thumbnails.put(image_ref, make_thumbnail(img))
+                    created += 1
+    return created
+
+
+if __name__ == "__main__":
+    # サムネイルの一括作成: python images.py [ユーザー名 ...]
+    import sys
+    count = backfill_thumbnails(sys.argv[1:] or None)
+    print(f"{count}枚のサムネイルを作成しました")
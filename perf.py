@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from functools import wraps
+
+# 環境変数で計測を有効にする（管理者画面からも切り替えられる）
+_enabled = os.environ.get("ENCYCLOPEDIA_PERF", "").lower() in ("1", "true", "yes")
+
+# 保持する再実行の記録の数
+RECENT_RERUNS = 100
+
+# 再実行ごとの記録をJSONの1行として出力するロガー
+logger = logging.getLogger("encyclopedia.perf")
+if os.environ.get("ENCYCLOPEDIA_PERF_LOG"):
+    _handler = logging.FileHandler(os.environ["ENCYCLOPEDIA_PERF_LOG"], encoding="utf-8")
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+
+_lock = threading.Lock()
+_totals = {}     # 名前 → [呼び出し回数, 合計秒数, 最大秒数]（プロセス全体）
+_counters = {}   # 名前 → 回数（キャッシュのヒットなど）
+_reruns = deque(maxlen=RECENT_RERUNS)
+_open_reruns = {}  # セッションのキー → 実行中の再実行の記録
+_local = threading.local()
+
+
+def enabled():
+    return _enabled
+
+
+def set_enabled(value):
+    global _enabled
+    _enabled = bool(value)
+
+
+class _Rerun:
+    """1回の再実行（スクリプトの実行）の間の計測結果"""
+
+    def __init__(self, key, label):
+        self.key = key
+        self.label = label
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.last = self.start        # 最後に計測が記録された時刻
+        self.timings = {}             # 名前 → [呼び出し回数, 合計秒数]
+        self.counters = {}
+        self.phase = None             # (区間の名前, 開始時刻)
+
+    def add(self, name, elapsed):
+        entry = self.timings.get(name)
+        if entry is None:
+            self.timings[name] = [1, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+        self.last = time.perf_counter()
+
+    def to_dict(self, end, interrupted):
+        return {
+            "type": "rerun",
+            "session": self.key,
+            "label": self.label,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "total_ms": round((end - self.start) * 1000, 3),
+            "interrupted": interrupted,
+            "timings": {name: {"calls": calls, "total_ms": round(total * 1000, 3)}
+                        for name, (calls, total) in self.timings.items()},
+            "counters": dict(self.counters),
+        }
+
+
+def _record(name, elapsed, rerun=None):
+    """rerunを省略すると、このスレッドで実行中の再実行に記録する"""
+    with _lock:
+        stat = _totals.get(name)
+        if stat is None:
+            _totals[name] = [1, elapsed, elapsed]
+        else:
+            stat[0] += 1
+            stat[1] += elapsed
+            if elapsed > stat[2]:
+                stat[2] = elapsed
+    if rerun is None:
+        rerun = getattr(_local, "rerun", None)
+    if rerun is not None:
+        rerun.add(name, elapsed)
+
+
+# 関数の実行時間を計測するデコレーター
+def timed(name):
+    """無効なときはフラグを1回確認するだけで元の関数を呼ぶ"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+# with文で囲んだ処理の実行時間を計測
+def span(name):
+    return _Span(name) if _enabled else _NULL_SPAN
+
+
+# 回数を数える（キャッシュのヒット・ミスなど）
+def count(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+    rerun = getattr(_local, "rerun", None)
+    if rerun is not None:
+        rerun.counters[name] = rerun.counters.get(name, 0) + n
+
+
+# 再実行の中の区間を切り替える（画面の描画など、with文で囲みにくい処理の計測用）
+def phase(name):
+    rerun = getattr(_local, "rerun", None)
+    if rerun is None:
+        return
+    now = time.perf_counter()
+    if rerun.phase is not None:
+        _record(rerun.phase[0], now - rerun.phase[1])
+    rerun.phase = (name, now)
+    rerun.last = now
+
+
+def _finish(rerun, end, interrupted):
+    if rerun.phase is not None:
+        # 終了時にはこのスレッドの実行中の記録が別の再実行になっていることがあるので、明示して記録する
+        _record(rerun.phase[0], max(0.0, end - rerun.phase[1]), rerun)
+        rerun.phase = None
+    data = rerun.to_dict(end, interrupted)
+    with _lock:
+        _reruns.append(data)
+    logger.info(json.dumps(data, ensure_ascii=False))
+
+
+# 再実行の計測を始める（keyはセッションごとに一意な値）
+def start_rerun(key, label=""):
+    """st.rerun()などで前回の再実行が最後まで実行されなかった場合は、ここで区切る"""
+    previous = _open_rerun_pop(key)
+    if previous is not None:
+        _finish(previous, previous.last, True)
+    if not _enabled:
+        _local.rerun = None
+        return
+    rerun = _Rerun(key, label)
+    with _lock:
+        _open_reruns[key] = rerun
+    _local.rerun = rerun
+
+
+# 再実行の計測を終える
+def end_rerun(key):
+    rerun = _open_rerun_pop(key)
+    _local.rerun = None
+    if rerun is not None:
+        _finish(rerun, time.perf_counter(), False)
+
+
+def _open_rerun_pop(key):
+    with _lock:
+        return _open_reruns.pop(key, None)
+
+
+# プロセス全体の計測結果（合計時間の長い順）
+def stats():
+    with _lock:
+        items = [(name, list(stat)) for name, stat in _totals.items()]
+    return [{"name": name, "calls": calls, "total_ms": round(total * 1000, 3),
+             "mean_ms": round(total * 1000 / calls, 3), "max_ms": round(longest * 1000, 3)}
+            for name, (calls, total, longest) in sorted(items, key=lambda item: item[1][1], reverse=True)]
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+# 最近の再実行の記録（新しい順）
+def recent_reruns():
+    with _lock:
+        return list(reversed(_reruns))
+
+
+# 計測結果をJSON Lines形式で書き出す
+def export_jsonl():
+    lines = [json.dumps(rerun, ensure_ascii=False) for rerun in recent_reruns()]
+    lines.append(json.dumps({"type": "totals", "stats": stats(), "counters": counters()}, ensure_ascii=False))
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+        _counters.clear()
+        _reruns.clear()
@@ -0,0 +1,492 @@
+from collections import Counter
+from itertools import repeat
+import numpy as np
+from scipy import sparse
+import perf
+import codec
+from search_index import tokenize, TITLE_WEIGHT
+
+# 記事ごとに保存する関連記事の数（表示するのはこのうち上位の数件）
+NEIGHBOURS = 20
+
+# これより類似度の低い記事は関連記事にしない
+MIN_SIMILARITY = 0.05
+
+# これより多くの割合の記事に現れる語は、ありふれていて関連を表さないので使わない
+# （記事が少ないうちはMIN_MAX_DF件までは使う）
+MAX_DF_RATIO = 0.25
+MIN_MAX_DF = 20
+
+# 類似度には記事ごとに重みの大きい語をこの数だけ使う（その記事らしさを表す語に絞り、
+# 一括計算の行列の積がどの記事も似た語を持つ大きなコーパスでも記事数の2乗に膨らまないようにする）
+MAX_TERMS = 50
+
+# 前回の一括計算の後に変更された記事がこの数と記事数のREBUILD_RATIO倍の両方を超えたら、
+# コンパクションのときに全体を計算し直す（語の重みのずれを直し、関連記事を一括で求め直す）
+REBUILD_MIN_ROWS = 1000
+REBUILD_RATIO = 0.1
+
+# 1回の変更でこれより多くの記事が追加・更新・削除されたら、1件ずつ更新せずに一括で計算し直す
+# （1件ごとに全記事との類似度を求めるので、取り込みや大きな百科事典の最初の保存では一括のほうが速い）
+APPLY_REBUILD_ROWS = 256
+
+# 一括計算で一度に類似度を求める記事の数（メモリの使用量を抑える）
+BLOCK_ROWS = 1024
+
+# 最小の行数（足りなくなったら倍に増やす）
+MIN_CAPACITY = 1024
+
+
+# 記事の語の出現回数（検索と同じ分割。タイトルの語は重く数える）
+def term_counts(title, article):
+    counts = Counter(tokenize(article.get("content", "")))
+    for token in tokenize(title):
+        counts[token] += TITLE_WEIGHT
+    return counts
+
+
+class RelatedArticles:
+    """記事の本文のTF-IDFベクトルのコサイン類似度による関連記事の索引
+
+    一括計算のときに全記事のベクトル（重みの大きいMAX_TERMS語）を疎行列にし、ブロックごとの
+    行列の積で各記事の上位NEIGHBOURS件を求めて保存しておく。その後に変更された記事は、その記事の
+    ベクトルと全記事との類似度を1回の行列とベクトルの積で求め、その記事と、関連記事の一覧に入る
+    （または入っていた）記事の一覧だけを更新する。語の重み（IDF）は一括計算の時点のものを使い続け、
+    変更が溜まったらコンパクションのときに計算し直す（optimize）。
+    関連記事の取得は保存済みの一覧を返すだけなので、記事数によらない。
+    """
+
+    def __init__(self, version=0):
+        self.version = version   # 反映済みのコミット番号
+        self.rows = {}           # タイトル → 行番号
+        self.titles = []         # 行番号 → タイトル（空きの行はNone）
+        self.free = []
+        self.terms = {}          # 語 → 列番号
+        self.df = np.zeros(0, np.int64)          # 列番号 → その語を含む記事数
+        self.counts = sparse.csr_matrix((0, 0), dtype=np.float32)   # 一括計算時の語の出現回数（行 × 列）
+        self.columns = sparse.csc_matrix((0, 0), dtype=np.float32)  # 一括計算時の正規化したベクトル（列ごと）
+        self.stale = np.zeros(0, bool)            # 一括計算の後に変更・削除された行
+        self.delta = {}          # 一括計算の後に変更された行 → (列番号の配列, 出現回数の配列, ベクトル)
+        self._delta_matrix = None                 # deltaの重みを並べた疎行列（必要になったときに作る）
+        self.neighbours = np.zeros((0, NEIGHBOURS), np.int32)   # 行 → 関連記事の行（類似度の高い順、空きは-1）
+        self.scores = np.zeros((0, NEIGHBOURS), np.float32)
+
+    @classmethod
+    def build(cls, encyclopedia, context=None):
+        related = cls()
+        for title in encyclopedia:
+            related._allocate(title)
+        if context is not None:
+            # 全文検索インデックスが記事ごとの語の出現回数を持っているので、本文を分割し直さずに済む
+            # （検索インデックスのほうが新しいコミットまで反映していても、その後のログの再適用で揃う）
+            related.counts = related._counts_from_postings(context.index("search").postings())
+        else:
+            ids, values = [], []
+            for title, article in encyclopedia.items():
+                counts = term_counts(title, article)
+                ids.append(related._term_ids(counts))
+                values.append(np.fromiter(counts.values(), np.float32, len(counts)))
+            related.counts = _stack(ids, values, len(related.terms))
+        related.stale = np.zeros(len(related.titles), bool)
+        related.rebuild()
+        return related
+
+    def _counts_from_postings(self, postings):
+        """(検索語, タイトルの配列, 出現回数の配列) の並びから、出現回数の行列を作る"""
+        rows, cols, values = [], [], []
+        row_of = self.rows.get
+        for term, docs, counts in postings:
+            term_rows = np.fromiter(map(row_of, docs, repeat(-1)), np.int64, len(docs))
+            keep = term_rows >= 0
+            if not keep.any():
+                continue
+            rows.append(term_rows[keep])
+            cols.append(np.full(keep.sum(), len(self.terms), np.int32))
+            values.append(counts[keep].astype(np.float32))
+            self.terms[term] = len(self.terms)
+        self.df = np.zeros(len(self.terms), np.int64)
+        if not rows:
+            return sparse.csr_matrix((len(self.titles), len(self.terms)), dtype=np.float32)
+        return sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                 shape=(len(self.titles), len(self.terms)))
+
+    @classmethod
+    def load(cls, path):
+        data = codec.load_file(path)
+        related = cls(data["version"])
+        related.titles = data["titles"]
+        related.rows = {title: row for row, title in enumerate(related.titles) if title is not None}
+        related.free = [row for row, title in enumerate(related.titles) if title is None]
+        related.terms = {term: i for i, term in enumerate(data["terms"])}
+        related._grow(len(related.titles))
+        shape = (len(related.titles), len(data["terms"]))
+        related.counts = sparse.csr_matrix((_decode(data["data"], "<i4").astype(np.float32),
+                                            _decode(data["indices"], "<i4"), _decode(data["indptr"], "<i4")),
+                                           shape=shape)
+        related.df = np.bincount(related.counts.indices, minlength=shape[1]).astype(np.int64)
+        # ベクトルも保存しておき、読み込みのたびに重みを計算し直さない
+        related.columns = sparse.csr_matrix((_decode(data["vector_data"], "<f4"),
+                                             _decode(data["vector_indices"], "<i4"),
+                                             _decode(data["vector_indptr"], "<i4")), shape=shape).tocsc()
+        related.stale = np.zeros(shape[0], bool)
+        related.neighbours[:shape[0]] = _decode(data["neighbours"], "<i4").reshape(-1, NEIGHBOURS)
+        related.scores[:shape[0]] = _decode(data["scores"], "<f4").reshape(-1, NEIGHBOURS)
+        return related
+
+    def save(self, path):
+        counts = self._merged_counts()
+        vectors = self._merged_vectors()
+        rows = len(self.titles)
+        terms = [None] * len(self.terms)
+        for term, i in self.terms.items():
+            terms[i] = term
+        data = codec.dumps({
+            "version": self.version, "titles": self.titles, "terms": terms,
+            "indptr": _encode(counts.indptr.astype("<i4")), "indices": _encode(counts.indices.astype("<i4")),
+            "data": _encode(counts.data.astype("<i4")),
+            "vector_indptr": _encode(vectors.indptr.astype("<i4")),
+            "vector_indices": _encode(vectors.indices.astype("<i4")),
+            "vector_data": _encode(vectors.data.astype("<f4")),
+            "neighbours": _encode(self.neighbours[:rows].astype("<i4").ravel()),
+            "scores": _encode(self.scores[:rows].astype("<f4").ravel()),
+        })
+        codec.replace_file(path, lambda f: f.write(data))
+
+    # 行と列の管理
+
+    def _allocate(self, title):
+        if self.free:
+            row = self.free.pop()
+            self.titles[row] = title
+        else:
+            row = len(self.titles)
+            self.titles.append(title)
+            self._grow(row + 1)
+        self.rows[title] = row
+        return row
+
+    def _grow(self, needed):
+        capacity = len(self.neighbours)
+        if needed <= capacity:
+            return
+        capacity = max(MIN_CAPACITY, capacity * 2, needed)
+        neighbours = np.full((capacity, NEIGHBOURS), -1, np.int32)
+        neighbours[:len(self.neighbours)] = self.neighbours
+        scores = np.zeros((capacity, NEIGHBOURS), np.float32)
+        scores[:len(self.scores)] = self.scores
+        self.neighbours, self.scores = neighbours, scores
+
+    def _term_ids(self, counts):
+        terms = self.terms
+        ids = list(map(terms.get, counts))
+        if None in ids:
+            for i, term in enumerate(counts):
+                if ids[i] is None:
+                    ids[i] = terms[term] = len(terms)
+        if len(terms) > len(self.df):
+            self.df = np.concatenate([self.df, np.zeros(max(len(self.terms), 2 * len(self.df)) - len(self.df),
+                                                        np.int64)])
+        return np.array(ids, np.int32)
+
+    def _row_counts(self, row):
+        """行の (列番号の配列, 出現回数の配列)"""
+        if row in self.delta:
+            return self.delta[row][:2]
+        if row < self.counts.shape[0] and not self.stale[row]:
+            start, end = self.counts.indptr[row], self.counts.indptr[row + 1]
+            return self.counts.indices[start:end], self.counts.data[start:end]
+        return np.zeros(0, np.int32), np.zeros(0, np.float32)
+
+    def _set_counts(self, row, counts):
+        """行の語の出現回数を置き換え、語を含む記事数も差分で更新する（counts=Noneなら削除）"""
+        old_ids, _ = self._row_counts(row)
+        np.subtract.at(self.df, old_ids, 1)
+        if row < len(self.stale):
+            self.stale[row] = True
+        self.delta.pop(row, None)
+        self._delta_matrix = None
+        if counts is None:
+            return
+        ids = self._term_ids(counts)
+        values = np.fromiter(counts.values(), np.float32, len(counts))
+        np.add.at(self.df, ids, 1)
+        self.delta[row] = (ids, values, None)
+
+    # 重みの計算
+
+    def _live_count(self):
+        return len(self.rows)
+
+    def _max_df(self):
+        return max(MIN_MAX_DF, MAX_DF_RATIO * self._live_count())
+
+    def _tfidf(self, ids, values):
+        # 出現回数は対数で抑え、ありふれた語は0にする
+        n = self._live_count()
+        df = self.df[ids]
+        weights = ((1 + np.log(values)) * (np.log((1 + n) / (1 + df)) + 1)).astype(np.float32)
+        weights[df > self._max_df()] = 0
+        return weights
+
+    def _weights(self, ids, values):
+        """語の出現回数から、重みの大きいMAX_TERMS語のL2正規化したTF-IDFの (列番号, 重み) を返す"""
+        weights = self._tfidf(ids, values)
+        keep = np.flatnonzero(weights > 0)
+        if len(keep) > MAX_TERMS:
+            # 重みが同じ語は列番号の小さい順に選ぶ（一括計算と同じ語を選ぶように）
+            keep = keep[np.lexsort((ids[keep], -weights[keep]))[:MAX_TERMS]]
+        weights = weights[keep]
+        norm = np.sqrt(np.dot(weights, weights))
+        return ids[keep], weights / norm if norm > 0 else weights
+
+    def _weigh(self):
+        """一括計算時の出現回数の行列から、正規化したベクトルの行列を作る（行のブロックごと）"""
+        counts = self.counts
+        rows, cols, values = [], [], []
+        for start in range(0, counts.shape[0], BLOCK_ROWS):
+            block = counts[start:start + BLOCK_ROWS]
+            block = sparse.csr_matrix((self._tfidf(block.indices, block.data), block.indices, block.indptr),
+                                      shape=block.shape)
+            block.eliminate_zeros()
+            block_rows, block_cols, weights, _ = _top_per_row(block, MAX_TERMS)
+            norms = np.sqrt(np.bincount(block_rows, weights=weights * weights, minlength=block.shape[0]))
+            rows.append(block_rows + start)
+            cols.append(block_cols)
+            values.append((weights / norms[block_rows]).astype(np.float32))
+        self.columns = sparse.csc_matrix(
+            (np.concatenate(values or [np.zeros(0, np.float32)]),
+             (np.concatenate(rows or [np.zeros(0, np.int64)]), np.concatenate(cols or [np.zeros(0, np.int32)]))),
+            shape=counts.shape)
+        self.stale = np.zeros(counts.shape[0], bool)
+        self.delta = {}
+        self._delta_matrix = None
+
+    def _merged_counts(self):
+        """一括計算時の出現回数に、その後の変更を反映した行列"""
+        return self._merge(self.counts, {row: (ids, values) for row, (ids, values, _) in self.delta.items()})
+
+    def _merged_vectors(self):
+        """一括計算時のベクトルに、その後に変更された記事のベクトルを反映した行列"""
+        self._delta_weights()
+        return self._merge(self.columns, {row: vector for row, (_, _, vector) in self.delta.items()})
+
+    def _merge(self, base, changed):
+        shape = (len(self.titles), len(self.terms))
+        if len(self.stale):
+            base = sparse.diags((~self.stale).astype(np.float32)) @ base
+        base = sparse.csr_matrix(base, dtype=np.float32)
+        base.resize(shape)
+        if changed:
+            rows = list(changed)
+            delta = _stack([changed[row][0] for row in rows], [changed[row][1] for row in rows], shape[1])
+            # 変更された行を並べた行列を、行番号の位置に置く
+            placed = sparse.csr_matrix((np.ones(len(rows), np.float32), (rows, np.arange(len(rows)))),
+                                       shape=(shape[0], len(rows))) @ delta
+            base = (base + placed).tocsr()
+            base.eliminate_zeros()
+        base.sort_indices()
+        return base
+
+    # 類似度
+
+    def _similarities(self, ids, weights):
+        """あるベクトルと全記事との類似度の配列（行番号の順）"""
+        scores = np.zeros(len(self.neighbours), np.float32)
+        base_rows, base_terms = self.columns.shape
+        if base_rows:
+            known = ids < base_terms
+            if known.any():
+                # 列ごとの行列から、このベクトルに含まれる語の列だけを取り出して掛ける
+                part = self.columns[:, ids[known]] @ weights[known]
+                part[self.stale] = 0
+                scores[:base_rows] = part
+        if self.delta:
+            rows, matrix = self._delta_weights()
+            dense = np.zeros(matrix.shape[1], np.float32)
+            dense[ids] = weights
+            scores[rows] = matrix @ dense
+        return scores
+
+    def _delta_weights(self):
+        if self._delta_matrix is None:
+            rows = np.fromiter(self.delta, np.int64, len(self.delta))
+            vectors = []
+            for row in rows.tolist():
+                ids, values, vector = self.delta[row]
+                if vector is None:
+                    vector = self._weights(ids, values)
+                    self.delta[row] = (ids, values, vector)
+                vectors.append(vector)
+            matrix = _stack([ids for ids, _ in vectors], [weights for _, weights in vectors], len(self.terms))
+            self._delta_matrix = (rows, matrix)
+        return self._delta_matrix
+
+    def _set_neighbours(self, row, scores, exclude=None):
+        """類似度の配列から行の関連記事の一覧を作る（excludeの行は入れない）"""
+        scores = scores.copy()
+        scores[row] = 0
+        if exclude is not None:
+            scores[exclude] = 0
+        count = min(NEIGHBOURS, len(scores) - 1)
+        top = np.argpartition(-scores, count)[:count] if count > 0 else np.zeros(0, np.int64)
+        top = top[np.argsort(-scores[top], kind="stable")]
+        top = top[scores[top] >= MIN_SIMILARITY]
+        self.neighbours[row] = -1
+        self.scores[row] = 0
+        self.neighbours[row, :len(top)] = top
+        self.scores[row, :len(top)] = scores[top]
+
+    def _row_vector(self, row):
+        """行の正規化したベクトルの (列番号の配列, 重みの配列)"""
+        if row in self.delta:
+            ids, values, vector = self.delta[row]
+            if vector is None:
+                vector = self._weights(ids, values)
+                self.delta[row] = (ids, values, vector)
+            return vector
+        vector = self.columns[row].tocsr()
+        return vector.indices, vector.data
+
+    def _drop_neighbour(self, target):
+        """他の記事の一覧からtargetを取り除く（後ろの記事を詰める）
+
+        一覧が埋まっていた記事は、一覧の外に次の候補がありうるので関連記事を求め直す。
+        """
+        holders, positions = np.nonzero(self.neighbours == target)
+        for holder, position in zip(holders.tolist(), positions.tolist()):
+            if self.neighbours[holder, -1] >= 0:
+                self._set_neighbours(holder, self._similarities(*self._row_vector(holder)), exclude=target)
+                continue
+            self.neighbours[holder, position:-1] = self.neighbours[holder, position + 1:]
+            self.scores[holder, position:-1] = self.scores[holder, position + 1:]
+            self.neighbours[holder, -1] = -1
+            self.scores[holder, -1] = 0
+
+    def _offer_neighbour(self, target, scores):
+        """targetとの類似度が一覧の最下位より高い記事の一覧に、targetを入れる"""
+        lowest = np.where(self.neighbours[:, -1] >= 0, self.scores[:, -1], 0)
+        candidates = np.flatnonzero((scores > lowest) & (scores >= MIN_SIMILARITY))
+        for holder in candidates.tolist():
+            if holder == target or self.titles[holder] is None:
+                continue
+            score = scores[holder]
+            position = int(np.searchsorted(-self.scores[holder], -score, side="right"))
+            self.neighbours[holder, position + 1:] = self.neighbours[holder, position:-1]
+            self.scores[holder, position + 1:] = self.scores[holder, position:-1]
+            self.neighbours[holder, position] = target
+            self.scores[holder, position] = score
+
+    @perf.timed("related.apply_changes")
+    def apply_changes(self, updated, deleted, context=None):
+        """変更された記事のベクトルと、その記事が関わる関連記事の一覧だけを更新する
+
+        変更された記事がAPPLY_REBUILD_ROWSより多ければ、全体を一括で計算し直す。
+        """
+        batch = len(updated) + len(deleted) > APPLY_REBUILD_ROWS
+        for title in deleted:
+            row = self.rows.pop(title, None)
+            if row is None:
+                continue
+            self._set_counts(row, None)
+            if not batch:
+                self._drop_neighbour(row)
+            self.neighbours[row] = -1
+            self.scores[row] = 0
+            self.titles[row] = None
+            self.free.append(row)
+        changed = []
+        for title, article in updated.items():
+            row = self.rows.get(title)
+            if row is None:
+                row = self._allocate(title)
+            self._set_counts(row, term_counts(title, article))
+            changed.append(row)
+        if batch:
+            self.rebuild()
+            return
+        for row in changed:
+            ids, values, _ = self.delta[row]
+            vector = self._weights(ids, values)
+            self.delta[row] = (ids, values, vector)
+            scores = self._similarities(*vector)
+            self._set_neighbours(row, scores)
+            self._drop_neighbour(row)
+            self._offer_neighbour(row, scores)
+
+    @perf.timed("related.rebuild")
+    def rebuild(self):
+        """すべての記事のベクトルと関連記事を一括で計算し直す"""
+        self.counts = self._merged_counts()
+        self.df = np.bincount(self.counts.indices, minlength=self.counts.shape[1]).astype(np.int64)
+        self._weigh()
+        rows = self.counts.shape[0]
+        self._grow(rows)
+        self.neighbours[:] = -1
+        self.scores[:] = 0
+        if not rows:
+            return
+        matrix = self.columns.tocsr()
+        transposed = matrix.T.tocsr()  # 語 × 記事
+        for start in range(0, rows, BLOCK_ROWS):
+            block = (matrix[start:start + BLOCK_ROWS] @ transposed).tocsr()
+            # 自分自身と類似度の低い記事を除いてから、行ごとに上位を取り出す
+            block_rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+            block.data[(block.indices == block_rows + start) | (block.data < MIN_SIMILARITY)] = 0
+            block.eliminate_zeros()
+            block_rows, others, scores, ranks = _top_per_row(block, NEIGHBOURS)
+            self.neighbours[block_rows + start, ranks] = others
+            self.scores[block_rows + start, ranks] = scores
+
+    def optimize(self):
+        """コンパクションのときに呼ばれる。前回の一括計算の後の変更が多ければ計算し直す"""
+        if len(self.delta) > max(REBUILD_MIN_ROWS, REBUILD_RATIO * self._live_count()):
+            self.rebuild()
+
+    @perf.timed("related.related")
+    def related(self, title, limit=10):
+        """[(タイトル, 類似度)] を類似度の高い順に最大limit件返す"""
+        row = self.rows.get(title)
+        if row is None:
+            return []
+        return [(self.titles[other], float(score))
+                for other, score in zip(self.neighbours[row, :limit].tolist(), self.scores[row, :limit].tolist())
+                if other >= 0]
+
+
+# 行ごとの (列番号の配列, 値の配列) を並べた疎行列
+def _stack(ids, values, columns):
+    lengths = [len(row_ids) for row_ids in ids]
+    indptr = np.zeros(len(ids) + 1, np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    if not ids:
+        return sparse.csr_matrix((0, columns), dtype=np.float32)
+    return sparse.csr_matrix((np.concatenate(values).astype(np.float32), np.concatenate(ids), indptr),
+                             shape=(len(ids), columns))
+
+
+# 疎行列の各行の値の大きい順（同じ値は列番号の小さい順）に最大k個を取り出す
+def _top_per_row(matrix, k):
+    """(行, 列, 値, 行の中の順位) の配列を返す（値は0以上、列番号は行ごとに並べ替え済みであること）"""
+    matrix.sort_indices()
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    if not len(rows):
+        return rows, matrix.indices, matrix.data, rows
+    # 行の順、行の中では値の大きい順になるキーで1回だけ安定ソートする（同じ値は列番号の順のまま残る）
+    order = np.argsort(rows * (float(matrix.data.max()) + 1) - matrix.data, kind="stable")
+    ranks = np.arange(len(order)) - matrix.indptr[rows]
+    keep = ranks < k
+    order = order[keep]
+    return rows[keep], matrix.indices[order], matrix.data[order], ranks[keep]
+
+
+def _encode(array):
+    # バイナリ形式では配列のバイト列のまま、JSON形式では数値のリストで保存する
+    if codec.binary_enabled():
+        return array.tobytes()
+    return array.tolist()
+
+
+def _decode(value, dtype):
+    if isinstance(value, bytes):
+        return np.frombuffer(value, dtype)
+    return np.array(value, dtype)
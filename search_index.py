@@ -0,0 +1,383 @@
+import re
+import math
+import unicodedata
+from collections import Counter
+import numpy as np
+import perf
+import codec
+
+# 日本語（ひらがな・カタカナ・漢字）の文字範囲
+_CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3005"
+_TOKEN_PATTERN = re.compile(rf"([{_CJK_CHARS}]+)|([^\W_{_CJK_CHARS}]+)")
+_CJK_PATTERN = re.compile(rf"[{_CJK_CHARS}]")
+
+# タイトルに含まれる語は本文より重く数える
+TITLE_WEIGHT = 3
+
+# BM25のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 差分で持っている記事がこの数と記事数のMERGE_RATIO倍の両方を超えたら、列の形式にまとめ直す
+MERGE_MIN_DOCS = 1000
+MERGE_RATIO = 0.1
+
+# 記事番号ごとの配列の最小の長さ（足りなくなったら倍に増やす）
+MIN_CAPACITY = 1024
+
+_EMPTY = np.zeros(0, np.int32)
+
+
+# 検索用にテキストを正規化（全角・半角の統一と小文字化）
+def normalize_text(text):
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+# テキストを検索語に分割
+def tokenize(text):
+    """日本語は文字バイグラム、英数字は単語単位に分割する"""
+    tokens = []
+    for cjk, word in _TOKEN_PATTERN.findall(normalize_text(text)):
+        if cjk:
+            if len(cjk) == 1:
+                tokens.append(cjk)
+            else:
+                tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        else:
+            tokens.append(word)
+    return tokens
+
+
+class SearchIndex:
+    """記事のタイトルと本文の転置インデックス（BM25でランキング）
+
+    転置リストは、タイトルと検索語を番号に置き換え、検索語ごとの記事番号と出現回数を1本の配列に
+    つなげた列の形式で持つ（ファイルに保存する形式と同じ）。その後に追加・更新された記事だけを
+    辞書の差分で持ち、削除・更新された記事は列の形式のほうでは印を付けて読み飛ばす。
+    差分が溜まったら列の形式にまとめ直す（merge）。
+    """
+
+    def __init__(self, version=0):
+        self.version = version   # 反映済みのコミット番号
+        self.titles = []         # 記事番号 → タイトル（空きはNone）
+        self.ids = {}            # タイトル → 記事番号
+        self.free = []
+        self.terms = {}          # 検索語 → 検索語番号
+        self.term_list = []      # 検索語番号 → 検索語
+        self.lengths = np.zeros(0, np.int32)   # 記事番号 → 文書の長さ（検索語数）
+        self.total_length = 0
+        self.stale = np.zeros(0, bool)          # 列の形式の転置リストでは読み飛ばす記事
+        self.indptr = np.zeros(1, np.int64)     # 検索語番号 → doc_ids・countsの範囲
+        self.doc_ids = _EMPTY
+        self.counts = _EMPTY
+        self.delta = {}          # 検索語番号 → {記事番号: 出現回数}（まとめ直した後に追加された記事）
+        self.delta_terms = {}    # 差分で持っている記事番号 → 検索語番号のリスト（削除用）
+        self._grams = None       # 文字・3文字組 → 検索語番号の集合（containingで使うときに作る）
+
+    @classmethod
+    def build(cls, encyclopedia, context=None):
+        index = cls()
+        terms, docs, counts = [], [], []
+        for title, article in encyclopedia.items():
+            doc_counts = _doc_counts(title, article)
+            doc = index._allocate(title)
+            terms.append(np.array(index._term_ids(doc_counts), np.int64))
+            docs.append(np.full(len(doc_counts), doc, np.int32))
+            counts.append(np.array(list(doc_counts.values()), np.int32))
+            index.lengths[doc] = length = sum(doc_counts.values())
+            index.total_length += length
+        index._set_columns(terms, docs, counts)
+        return index
+
+    @classmethod
+    def load(cls, path):
+        data = codec.load_file(path)
+        if "indptr" not in data:
+            return cls._from_postings(data)
+        index = cls(data["version"])
+        index.titles = data["titles"]
+        index.ids = {title: doc for doc, title in enumerate(index.titles) if title is not None}
+        index.free = [doc for doc, title in enumerate(index.titles) if title is None]
+        index.term_list = data["terms"]
+        index.terms = {term: i for i, term in enumerate(index.term_list)}
+        index._grow(len(index.titles))
+        index.lengths[:len(index.titles)] = _unpack(data["lengths"], np.int32)
+        index.total_length = int(index.lengths.sum())
+        index.indptr = _unpack(data["indptr"], np.int64)
+        index.doc_ids = _unpack(data["doc_ids"], np.int32)
+        index.counts = _unpack(data["counts"], np.int32)
+        return index
+
+    @classmethod
+    def _from_postings(cls, data):
+        """検索語 → {タイトル: 出現回数} の形で保存していた以前の形式を読み込む"""
+        if "titles" in data:
+            titles = data["titles"]
+            lengths = codec.unpack_ints(data["lengths"])
+            postings = ((term, codec.unpack_ints(ids), codec.unpack_ints(counts))
+                        for term, (ids, counts) in zip(data["terms"], data["postings"]))
+        else:
+            titles = list(data["lengths"])
+            lengths = data["lengths"].values()
+            title_ids = {title: i for i, title in enumerate(titles)}
+            postings = ((term, [title_ids[title] for title in docs], list(docs.values()))
+                        for term, docs in data["postings"].items())
+        index = cls(data.get("version", 0))
+        for title, length in zip(titles, lengths):
+            doc = index._allocate(title)
+            index.lengths[doc] = length
+        index.total_length = int(index.lengths.sum())
+        terms, docs, counts = [], [], []
+        for term, ids, term_counts in postings:
+            docs.append(np.asarray(ids, np.int32))
+            terms.append(np.full(len(docs[-1]), index._term_id(term), np.int64))
+            counts.append(np.asarray(term_counts, np.int32))
+        index._set_columns(terms, docs, counts)
+        return index
+
+    def save(self, path):
+        self._merge()
+        data = codec.dumps({
+            "version": self.version, "titles": self.titles, "terms": self.term_list,
+            "lengths": _pack(self.lengths[:len(self.titles)]),
+            "indptr": _pack(self.indptr), "doc_ids": _pack(self.doc_ids), "counts": _pack(self.counts),
+        })
+        codec.replace_file(path, lambda f: f.write(data))
+
+    # 記事番号と検索語番号の管理
+
+    def _allocate(self, title):
+        if self.free:
+            doc = self.free.pop()
+            self.titles[doc] = title
+        else:
+            doc = len(self.titles)
+            self.titles.append(title)
+            self._grow(doc + 1)
+        self.ids[title] = doc
+        return doc
+
+    def _grow(self, needed):
+        capacity = len(self.lengths)
+        if needed <= capacity:
+            return
+        capacity = max(MIN_CAPACITY, capacity * 2, needed)
+        lengths = np.zeros(capacity, np.int32)
+        lengths[:len(self.lengths)] = self.lengths
+        stale = np.zeros(capacity, bool)
+        stale[:len(self.stale)] = self.stale
+        self.lengths, self.stale = lengths, stale
+
+    def _term_id(self, term):
+        term_id = self.terms.get(term)
+        if term_id is None:
+            term_id = self.terms[term] = len(self.term_list)
+            self.term_list.append(term)
+            if self._grams is not None:
+                self._add_grams(term_id, term)
+        return term_id
+
+    def _term_ids(self, terms):
+        get = self.terms.get
+        term_ids = [get(term) for term in terms]
+        if None in term_ids:
+            term_ids = [self._term_id(term) if term_id is None else term_id for term, term_id in zip(terms, term_ids)]
+        return term_ids
+
+    def _set_columns(self, terms, docs, counts):
+        """(検索語番号, 記事番号, 出現回数) の配列から列の形式の転置リストを作る"""
+        terms = np.concatenate(terms) if terms else np.zeros(0, np.int64)
+        docs = np.concatenate(docs) if docs else _EMPTY
+        counts = np.concatenate(counts) if counts else _EMPTY
+        order = np.lexsort((docs, terms))
+        self.indptr = np.zeros(len(self.term_list) + 1, np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(self.term_list)), out=self.indptr[1:])
+        self.doc_ids, self.counts = docs[order], counts[order]
+        self.stale[:] = False
+        self.delta, self.delta_terms = {}, {}
+
+    def _merge(self):
+        """差分を列の形式の転置リストにまとめ直し、どの記事にも含まれなくなった検索語を捨てる"""
+        if not self.delta and not self.stale.any():
+            return
+        base_terms = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        keep = ~self.stale[self.doc_ids]
+        terms, docs, counts = [base_terms[keep]], [self.doc_ids[keep]], [self.counts[keep]]
+        for term_id, term_docs in self.delta.items():
+            terms.append(np.full(len(term_docs), term_id, np.int64))
+            docs.append(np.fromiter(term_docs, np.int32, len(term_docs)))
+            counts.append(np.fromiter(term_docs.values(), np.int32, len(term_docs)))
+        terms = np.concatenate(terms)
+        used = np.bincount(terms, minlength=len(self.term_list)) > 0
+        renumber = np.cumsum(used) - 1
+        self.term_list = [term for term, is_used in zip(self.term_list, used.tolist()) if is_used]
+        self.terms = {term: i for i, term in enumerate(self.term_list)}
+        self._grams = None
+        self._set_columns([renumber[terms]], docs, counts)
+
+    def optimize(self):
+        """コンパクションのときに呼ばれる。保存する前に差分をまとめ直す"""
+        self._merge()
+
+    # 記事の追加と削除
+
+    def add(self, title, article):
+        if title in self.ids:
+            self.remove(title)
+        doc_counts = _doc_counts(title, article)
+        doc = self._allocate(title)
+        term_ids = self._term_ids(doc_counts)
+        for term_id, count in zip(term_ids, doc_counts.values()):
+            self.delta.setdefault(term_id, {})[doc] = count
+        self.delta_terms[doc] = term_ids
+        self.lengths[doc] = length = sum(doc_counts.values())
+        self.total_length += length
+
+    def remove(self, title):
+        doc = self.ids.pop(title, None)
+        if doc is None:
+            return
+        for term_id in self.delta_terms.pop(doc, ()):
+            docs = self.delta[term_id]
+            del docs[doc]
+            if not docs:
+                del self.delta[term_id]
+        # 列の形式の転置リストにある分は、まとめ直すまで読み飛ばす
+        self.stale[doc] = True
+        self.total_length -= int(self.lengths[doc])
+        self.lengths[doc] = 0
+        self.titles[doc] = None
+        self.free.append(doc)
+
+    @perf.timed("search.apply_changes")
+    def apply_changes(self, updated, deleted, context=None):
+        """保存時の差分（更新された記事と削除されたタイトル）を反映する"""
+        for title in deleted:
+            self.remove(title)
+        for title, article in updated.items():
+            self.add(title, article)
+        if len(self.delta_terms) > max(MERGE_MIN_DOCS, MERGE_RATIO * len(self.ids)):
+            self._merge()
+
+    # 検索
+
+    def _postings(self, term_id):
+        """検索語の (記事番号の配列, 出現回数の配列)（削除された記事を除く）"""
+        if term_id is None:
+            return _EMPTY, _EMPTY
+        docs, counts = _EMPTY, _EMPTY
+        if term_id < len(self.indptr) - 1:
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            docs, counts = self.doc_ids[start:end], self.counts[start:end]
+            keep = ~self.stale[docs]
+            if not keep.all():
+                docs, counts = docs[keep], counts[keep]
+        delta = self.delta.get(term_id)
+        if delta:
+            docs = np.concatenate([docs, np.fromiter(delta, np.int32, len(delta))])
+            counts = np.concatenate([counts, np.fromiter(delta.values(), np.int32, len(delta))])
+        return docs, counts
+
+    def postings(self):
+        """(検索語, 記事のタイトルの配列, 出現回数の配列) を順に返す（関連記事の一括計算用）"""
+        self._merge()
+        titles = np.array(self.titles, object)
+        for term_id, term in enumerate(self.term_list):
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            yield term, titles[self.doc_ids[start:end]], self.counts[start:end]
+
+    def _add_grams(self, term_id, term):
+        # 3文字に満たない語でも探せるよう、3文字組に加えて1文字ずつも登録する
+        for gram in set(term) | _trigrams(term):
+            self._grams.setdefault(gram, set()).add(term_id)
+
+    def _terms_containing(self, token):
+        """tokenを部分文字列として含む検索語の番号（検索語の文字と3文字組の索引で絞り込む）"""
+        if self._grams is None:
+            self._grams = {}
+            for term_id, term in enumerate(self.term_list):
+                self._add_grams(term_id, term)
+        grams = _trigrams(token) if len(token) >= 3 else set(token)
+        sets = sorted((self._grams.get(gram, set()) for gram in grams), key=len)
+        term_ids = sets[0].intersection(*sets[1:])
+        return [term_id for term_id in term_ids if token in self.term_list[term_id]]
+
+    def containing(self, text):
+        """textを部分文字列として含む可能性のある記事のタイトルの集合を返す
+
+        転置インデックスで候補を絞るだけなので、実際に含むかは呼び出し側で確認すること。
+        検索語に分割できないtextの場合はNone（絞り込めない）を返す。
+        """
+        tokens = set(tokenize(text))
+        if not tokens:
+            return None
+        # 日本語のバイグラムは本文でも必ず同じバイグラムになるので、あればそれだけで絞り込む
+        bigrams = [token for token in tokens if len(token) == 2 and _CJK_PATTERN.match(token)]
+        candidates = None
+        for token in bigrams or tokens:
+            if bigrams:
+                docs = self._postings(self.terms.get(token))[0]
+            else:
+                # 英単語や1文字の日本語は、本文ではより長い検索語の一部になっている場合がある
+                parts = [self._postings(term_id)[0] for term_id in self._terms_containing(token)]
+                docs = np.unique(np.concatenate(parts)) if parts else _EMPTY
+            candidates = docs if candidates is None else np.intersect1d(candidates, docs, assume_unique=True)
+            if not len(candidates):
+                break
+        return {self.titles[doc] for doc in candidates.tolist()}
+
+    @perf.timed("search.search")
+    def search(self, query, limit=None):
+        """すべての検索語を含む記事を関連度の高い順に [(タイトル, スコア)] で返す"""
+        terms = set(tokenize(query))
+        if not terms or not self.ids:
+            return []
+        # 出現する記事が少ない検索語から絞り込む
+        postings = sorted((self._postings(self.terms.get(term)) for term in terms), key=lambda p: len(p[0]))
+        candidates = np.sort(postings[0][0])
+        for docs, _ in postings[1:]:
+            if not len(candidates):
+                break
+            candidates = np.intersect1d(candidates, docs, assume_unique=True)
+        if not len(candidates):
+            return []
+
+        doc_count = len(self.ids)
+        k1 = BM25_K1
+        norm = k1 * (1 - BM25_B + BM25_B * self.lengths[candidates] / (self.total_length / doc_count))
+        scores = np.zeros(len(candidates))
+        for docs, counts in postings:
+            idf = math.log(1 + (doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+            order = np.argsort(docs)
+            tf = counts[order][np.searchsorted(docs[order], candidates)].astype(np.float64)
+            scores += idf * tf * (k1 + 1) / (tf + norm)
+        order = np.argsort(-scores, kind="stable")
+        if limit:
+            order = order[:limit]
+        return [(self.titles[doc], float(score)) for doc, score in zip(candidates[order].tolist(), scores[order].tolist())]
+
+
+# 記事の検索語ごとの出現回数（タイトルの語は重く数える）
+def _doc_counts(title, article):
+    counts = Counter(tokenize(article.get("content", "")))
+    for token in tokenize(title):
+        counts[token] += TITLE_WEIGHT
+    return counts
+
+
+# 語に含まれる3文字の並び
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _pack(array):
+    # バイナリ形式では整数のバイト列、JSON形式では数値のリストで保存する
+    if codec.binary_enabled():
+        return array.astype("<i8" if array.dtype == np.int64 else "<i4").tobytes()
+    return array.tolist()
+
+
+def _unpack(value, dtype):
+    if isinstance(value, bytes):
+        return np.frombuffer(value, "<i8" if dtype == np.int64 else "<i4").astype(dtype)
+    return np.array(value, dtype)
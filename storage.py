@@ -0,0 +1,1237 @@
+import json
+import os
+import base64
+import hashlib
+import glob
+import math
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping, MutableMapping
+import wal
+import codec
+import perf
+
+try:
+    import fcntl
+except ImportError:  # Windowsではファイルロックを使わずプロセス内のロックだけにする
+    fcntl = None
+from blobstore import BlobStore, ThumbnailCache, is_blob_ref, referenced_blobs
+from bodystore import BodyStore, LazyArticle, image_refs, split_article
+from search_index import SearchIndex
+from article_links import LinkGraph
+from title_suggest import TitleSuggester
+from article_stats import ArticleStats
+from related_articles import RelatedArticles
+from history import RevisionHistory
+from categories import CategoryIndex, CategoryOverlay, normalize_categories
+from title_index import SortedTitles
+
+# ファイルパス
+USERS_FILE = "users_data.json"  # 旧形式（全ユーザーを1ファイルに保存）
+DATA_DIR = "users_data"
+INDEX_FILE = os.path.join(DATA_DIR, "users_index.json")
+USERS_DIR = os.path.join(DATA_DIR, "users")
+
+# ログがこのサイズとスナップショットのサイズの両方を超えたらコンパクションする
+COMPACT_MIN_BYTES = 1024 * 1024
+
+# 本文ファイルを書き直した後、古いファイルを削除せずに残しておく時間（秒）
+# 読み込み済みの記事はファイルを開いたままにしているので、削除された後も本文を読める
+BODIES_GRACE_SECONDS = 600
+
+# プロセス内で共有する記事データの数（ユーザーとコミット番号の組ごと）
+SHARED_CACHE_SIZE = 16
+
+# 一括変更の終了時に、他のプロセスのコンパクションが終わるのを待つ最大の時間（秒）
+BULK_COMPACT_TIMEOUT = 120
+
+# 共有の記事データに重ねる変更がこの数と記事数の平方根の両方を超えたら、1つの辞書にまとめ直す
+SHARED_FLATTEN_MIN = 64
+
+
+# ユーザー名からシャードのディレクトリ名を生成（日本語や記号を含むユーザー名にも対応）
+def user_key(username):
+    return hashlib.sha256(username.encode("utf-8")).hexdigest()[:32]
+
+
+# ユーザーごとのデータディレクトリ
+def user_dir(username):
+    return os.path.join(USERS_DIR, user_key(username))
+
+
+# ユーザーの百科事典スナップショットのパス
+def snapshot_path(username):
+    # 中身の形式（JSONかバイナリか）は先頭のバイト列で判定するので、ファイル名は以前のまま
+    return os.path.join(user_dir(username), "snapshot.json")
+
+
+# ユーザーの記事操作ログ（WAL）のパス
+def wal_path(username):
+    return os.path.join(user_dir(username), "wal.jsonl")
+
+
+# 本文ファイルのパス（ファイル名はスナップショットに書かれている）
+def bodies_path(username, name):
+    return os.path.join(user_dir(username), name)
+
+
+# スナップショット導入前のシャードのパス
+def shard_path(username):
+    return os.path.join(user_dir(username), "encyclopedia.json")
+
+
+# 記事から導出されるインデックス（名前 → (クラス, ファイル名)）。この順に更新する
+DERIVED_INDEXES = {
+    "search": (SearchIndex, "search_index.json"),
+    "links": (LinkGraph, "link_graph.json"),
+    "titles": (TitleSuggester, "title_suggest.json"),
+    "stats": (ArticleStats, "article_stats.json"),
+    "related": (RelatedArticles, "related_articles.json"),
+}
+
+
+# ユーザーの導出インデックスのパス
+def index_path(username, name):
+    return os.path.join(user_dir(username), DERIVED_INDEXES[name][1])
+
+
+# ユーザーの画像blobストア
+def get_blob_store(username):
+    return BlobStore(os.path.join(user_dir(username), "blobs"))
+
+
+# ユーザーのサムネイルキャッシュ
+def get_thumbnail_cache(username):
+    return ThumbnailCache(os.path.join(user_dir(username), "thumbs"))
+
+
+_histories = {}  # ユーザー名 → RevisionHistory（版の一覧をプロセス内で保持する）
+
+
+# ユーザーの記事の変更履歴
+def get_history(username):
+    with _user_locks_guard:
+        history = _histories.get(username)
+        if history is None:
+            history = _histories[username] = RevisionHistory(os.path.join(user_dir(username), "history"))
+        return history
+
+
+# 記事にインラインで埋め込まれたBase64画像をblobストアに移し、参照に置き換える
+def externalize_images(encyclopedia, store):
+    """旧形式の画像を変換した記事のタイトルを返す
+
+    本文ファイルに保存済みの記事（LazyArticle）は変換後のものなので読み込まない。
+    """
+    changed = []
+    for title, article in encyclopedia.items():
+        if isinstance(article, LazyArticle):
+            continue
+        images = article.get("images", [])
+        if any(not is_blob_ref(image) for image in images):
+            article["images"] = [image if is_blob_ref(image) else store.put(base64.b64decode(image))
+                                 for image in images]
+            changed.append(title)
+    return changed
+
+
+# 旧形式（文字列）のカテゴリーをリスト形式に変換
+def normalize_legacy_categories(encyclopedia):
+    """変換した記事のタイトルを返す"""
+    changed = []
+    for title, article in encyclopedia.items():
+        if isinstance(article, dict) and "category" in article and not isinstance(article["category"], list):
+            article["category"] = normalize_categories(article["category"])
+            changed.append(title)
+    return changed
+
+
+_DELETED = object()  # セッション内で削除した記事の印
+
+
+class LayeredArticles(Mapping):
+    """あるコミット時点の記事の辞書に、その後のコミットで変更された記事を重ねた辞書
+
+    保存のたびに全記事の辞書をコピーせず、変更された記事だけを持つ。どちらの辞書も共有するので書き換えない。
+    """
+
+    def __init__(self, base, changes, size):
+        self.base = base
+        self.changes = changes  # 変更された記事（削除された記事は_DELETED）
+        self._size = size
+
+    def __getitem__(self, title):
+        article = self.changes.get(title)
+        if article is None:
+            return self.base[title]
+        if article is _DELETED:
+            raise KeyError(title)
+        return article
+
+    def __contains__(self, title):
+        article = self.changes.get(title)
+        if article is None:
+            return title in self.base
+        return article is not _DELETED
+
+    def __iter__(self):
+        changes, base = self.changes, self.base
+        for title in base:
+            if changes.get(title) is not _DELETED:
+                yield title
+        for title, article in changes.items():
+            if article is not _DELETED and title not in base:
+                yield title
+
+    def __len__(self):
+        return self._size
+
+    def _put(self, title, article):
+        if title not in self:
+            self._size += 1
+        self.changes[title] = article
+
+    def _delete(self, title):
+        self._size -= 1
+        if title in self.base:
+            self.changes[title] = _DELETED
+        else:
+            del self.changes[title]
+
+
+class SharedArticles:
+    """あるコミット時点の記事データ（同じユーザーの全セッションで共有するので書き換えない）"""
+
+    def __init__(self, articles, version, categories=None, titles=None):
+        self.articles = articles
+        self.version = version
+        self.categories = categories if categories is not None else CategoryIndex.build(articles)
+        self.titles = titles if titles is not None else sorted(articles)  # ソート済みのタイトル
+
+    def advance(self, ops, version):
+        """操作を適用した新しいコミット時点のデータを作る
+
+        全記事をコピーせず、このデータに変更分を重ねる（記事そのものも共有する）。
+        重ねた変更が増えたら、まとめ直して1つの辞書にする。
+        """
+        if isinstance(self.articles, LayeredArticles):
+            base, changes = self.articles.base, dict(self.articles.changes)
+        else:
+            base, changes = self.articles, {}
+        articles = LayeredArticles(base, changes, len(self.articles))
+        categories = CategoryOverlay.over(self.categories)
+        titles = SortedTitles.over(self.titles)
+        updated, deleted = wal.summarize_ops(ops)
+        for title in deleted:
+            if title in articles:
+                categories.remove(title, articles[title])
+                titles.remove(title)
+                articles._delete(title)
+        for title, article in updated.items():
+            if title in articles:
+                categories.remove(title, articles[title])
+            else:
+                titles.add(title)
+            articles._put(title, article)
+            categories.add(title, article)
+        if len(changes) > max(SHARED_FLATTEN_MIN, math.isqrt(len(base))):
+            return SharedArticles(dict(articles), version, categories.flatten(), list(titles))
+        return SharedArticles(articles, version, categories, titles)
+
+
+
+
+class Encyclopedia(MutableMapping):
+    """共有の記事データにセッション内の変更を重ねた百科事典の辞書
+
+    セッションごとには変更した記事だけを持つ。変更されたタイトルを記録するので、
+    保存時に全記事を比較しなくても、変更分だけをログに書き込める。
+    """
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.version = shared.version  # 読み込み時点のコミット番号
+        self.last_result = None   # 最後に保存したときのSaveResult
+        self.lock = threading.RLock()  # バックグラウンドの保存スレッドと排他する
+        self.categories = CategoryOverlay.over(shared.categories)
+        self.titles = SortedTitles.over(shared.titles)
+        self._local = {}          # 変更した記事（削除した記事は_DELETED）
+        self._size = len(shared.articles)
+        self._touched = {}        # 変更されたタイトル（順序を保持）
+        self._renames = []
+        self._queued = {}         # 取り出したがまだ保存が終わっていない操作のタイトル → 操作の数
+
+    def __getitem__(self, title):
+        article = self._local.get(title)
+        if article is None:
+            return self.shared.articles[title]
+        if article is _DELETED:
+            raise KeyError(title)
+        return article
+
+    def __contains__(self, title):
+        article = self._local.get(title)
+        if article is None:
+            return title in self.shared.articles
+        return article is not _DELETED
+
+    def __iter__(self):
+        with self.lock:
+            local, articles = self._local, self.shared.articles
+        for title in articles:
+            if local.get(title) is not _DELETED:
+                yield title
+        for title, article in local.items():
+            if article is not _DELETED and title not in articles:
+                yield title
+
+    def __len__(self):
+        return self._size
+
+    def __setitem__(self, title, article):
+        with self.lock:
+            if title in self:
+                self.categories.remove(title, self[title])
+            else:
+                self.titles.add(title)
+                self._size += 1
+            self._local[title] = article
+            self.categories.add(title, article)
+            self._touched[title] = None
+
+    def __delitem__(self, title):
+        with self.lock:
+            self.categories.remove(title, self[title])
+            self.titles.remove(title)
+            self._local[title] = _DELETED
+            self._size -= 1
+            self._touched[title] = None
+
+    def rebase(self, shared, ops=()):
+        """保存後の共有データに乗り換え、まだ保存していない変更だけを手元に残す
+
+        opsは保存が終わった操作。取り出し済みでも保存待ちの操作（書き込みキューの
+        後続のまとまりなど）が変更した記事は、保存が終わるまで手元に残す。
+        """
+        with self.lock:
+            self._release_queued(ops)
+            local = {title: article for title, article in self._local.items()
+                     if title in self._touched or title in self._queued}
+            categories = CategoryOverlay.over(shared.categories)
+            titles = SortedTitles.over(shared.titles)
+            size = len(shared.articles)
+            for title, article in local.items():
+                if title in shared.articles:
+                    categories.remove(title, shared.articles[title])
+                    titles.remove(title)
+                    size -= 1
+                if article is not _DELETED:
+                    categories.add(title, article)
+                    titles.add(title)
+                    size += 1
+            self.shared, self._local, self._size = shared, local, size
+            self.categories, self.titles = categories, titles
+            self.version = shared.version
+
+    def title_set_key(self):
+        """タイトルの集合が同じなら同じになるキー（全タイトルをなぞらず、コミット番号とセッション内の追加・削除から作る）"""
+        with self.lock:
+            articles = self.shared.articles
+            changed = frozenset((title, article is not _DELETED) for title, article in self._local.items()
+                                if (article is not _DELETED) != (title in articles))
+            return self.shared.version, changed
+
+    def rename(self, old_title, new_title, article):
+        """記事のタイトルを変更して内容を置き換える
+
+        変更先のタイトルの記事が既にあると、その記事の版が履歴に残らないのでValueErrorになる。
+        """
+        with self.lock:
+            if new_title != old_title and new_title in self:
+                raise ValueError(f"「{new_title}」という記事が既に存在します")
+            del self[old_title]
+            self[new_title] = article
+            self._renames.append((old_title, new_title))
+
+    def restore_changes(self, ops):
+        """保存できなかった操作を未保存の変更として戻す"""
+        with self.lock:
+            self._release_queued(ops)
+            self._restore_changes(ops)
+
+    def _hold_queued(self, ops):
+        for op in ops:
+            for title in _op_titles((op,)):
+                self._queued[title] = self._queued.get(title, 0) + 1
+
+    def _release_queued(self, ops):
+        for op in ops:
+            for title in _op_titles((op,)):
+                count = self._queued.get(title, 0) - 1
+                if count > 0:
+                    self._queued[title] = count
+                else:
+                    self._queued.pop(title, None)
+
+    def _restore_changes(self, ops):
+        # 戻す操作のほうが手元の変更より前に行われたので、先頭に入れる
+        renames, touched = [], {}
+        for op in ops:
+            if op["op"] == "rename":
+                renames.append((op["from"], op["to"]))
+                touched[op["from"]] = None
+                touched[op["to"]] = None
+            else:
+                touched[op["title"]] = None
+        touched.update(self._touched)
+        self._renames = renames + self._renames
+        self._touched = touched
+
+    def has_changes(self):
+        return bool(self._touched)
+
+    def pop_changes(self):
+        """前回の保存以降の変更をログの操作のリストとして取り出す"""
+        with self.lock:
+            return self._pop_changes()
+
+    def _pop_changes(self):
+        ops = []
+        done = set()
+        # A→B→Cのように続けて名前を変えた場合は、A→Cの1つの名前の変更にまとめる
+        chains = []    # [元のタイトル, 今のタイトル]（最初に名前を変えた順）
+        current = {}   # 今のタイトル → chainsの要素
+        for old_title, new_title in self._renames:
+            chain = current.pop(old_title, None)
+            if chain is None:
+                chain = [old_title, old_title]
+                chains.append(chain)
+            chain[1] = new_title
+            current[new_title] = chain
+        for old_title, new_title in chains:
+            if old_title == new_title or old_title in done or new_title in done:
+                continue
+            if old_title not in self and new_title in self:
+                ops.append({"op": "rename", "from": old_title, "to": new_title,
+                            "article": self[new_title]})
+                done.update((old_title, new_title))
+        for title in self._touched:
+            if title in done:
+                continue
+            if title in self:
+                ops.append({"op": "put", "title": title, "article": self[title]})
+            else:
+                ops.append({"op": "delete", "title": title})
+        self._touched = {}
+        self._renames = []
+        self._hold_queued(ops)
+        return ops
+
+
+# 保存前後の百科事典を比較して、変更をログの操作のリストにする
+def diff_encyclopedia(old, new):
+    ops = [{"op": "put", "title": title, "article": article}
+           for title, article in new.items() if old.get(title) != article]
+    ops += [{"op": "delete", "title": title} for title in old if title not in new]
+    return ops
+
+
+# JSONファイルの読み込み
+def _read_json(path, default):
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return default
+
+
+# スナップショットなどのデータファイルの読み込み（JSONとバイナリ形式のどちらにも対応）
+def _read_data(path, default):
+    if os.path.exists(path):
+        return codec.load_file(path)
+    return default
+
+
+# JSONファイルの保存（インデントなしでコンパクトに書き込む）
+def _write_json(path, data):
+    encoded = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    codec.replace_file(path, lambda f: f.write(encoded))
+
+
+# データファイルの保存（codec.STORAGE_FORMATの形式で書き込む）
+def _write_data(path, data):
+    encoded = codec.dumps(data)
+    codec.replace_file(path, lambda f: f.write(encoded))
+
+
+# スナップショットを保存
+@perf.timed("storage.write_snapshot")
+def _write_snapshot(username, version, articles):
+    """本文と画像は本文ファイルに追記し、スナップショットには一覧用の項目と本文の位置だけを書く
+
+    前回のスナップショットから変わっていない記事は、本文ファイル上の位置をそのまま引き継ぐ。
+    """
+    stores = {article.store.path for article in articles.values() if isinstance(article, LazyArticle)}
+    if not stores:
+        # すべての記事が書き換えられている場合も、今の本文ファイルに追記する
+        name = _read_data(snapshot_path(username), {}).get("bodies")
+        if name:
+            stores.add(bodies_path(username, name))
+    if len(stores) == 1:
+        store = BodyStore(stores.pop())
+    else:
+        store = BodyStore(bodies_path(username, f"bodies-{uuid.uuid4().hex[:8]}.dat"))
+    metas = {}
+    offsets = {}  # タイトル → [位置, 長さ, 本文の文字数, 画像の数, 画像のblobの参照（画像があるときだけ）]
+    pending = []
+    for title, article in articles.items():
+        if isinstance(article, LazyArticle) and article.store.path == store.path:
+            metas[title] = article.meta
+            offsets[title] = list(article.ref[:4]) + _image_ref_column(image_refs(article))
+        else:
+            metas[title], body = split_article(article)
+            pending.append((title, body))
+    for (title, body), (offset, length) in zip(pending, store.append([body for _, body in pending])):
+        images = body.get("images", [])
+        offsets[title] = [offset, length, len(body.get("content", "")), len(images)] + _image_ref_column(images)
+    live = sum(ref[1] for ref in offsets.values())
+    if store.size() - live > max(COMPACT_MIN_BYTES, live):
+        store, offsets = _rewrite_bodies(username, store, offsets)
+    _write_data(snapshot_path(username), {"version": version, "bodies": os.path.basename(store.path),
+                                          "articles": metas, "offsets": offsets})
+
+
+# 本文の位置と一緒に保存する画像の参照（コンパクションで本文を読まずに使われている画像を求める）
+def _image_ref_column(images):
+    return [[image for image in images if is_blob_ref(image)]] if images else []
+
+
+# 使われている本文だけを新しい本文ファイルにコピーする（更新や削除で不要な本文が増えたとき）
+def _rewrite_bodies(username, store, offsets):
+    new_store = BodyStore(bodies_path(username, f"bodies-{uuid.uuid4().hex[:8]}.dat"))
+    new_offsets = {}
+    position = 0
+
+    def write(f):
+        nonlocal position
+        with open(store.path, "rb") as src:
+            for title, ref in sorted(offsets.items(), key=lambda item: item[1][0]):
+                src.seek(ref[0])
+                f.write(src.read(ref[1]))
+                new_offsets[title] = [position] + ref[1:]
+                position += ref[1]
+
+    codec.replace_file(new_store.path, write)
+    return new_store, new_offsets
+
+
+# スナップショットを読み込む
+@perf.timed("storage.read_snapshot")
+def _read_snapshot(username, retries=3):
+    """(コミット番号, 記事の辞書) を返す（本文と画像は記事を参照したときに読み込む）
+
+    本文ファイルは開いたままにするので、後でコンパクションが古いファイルを削除しても読める。
+    """
+    snapshot = _read_data(snapshot_path(username), None)
+    if snapshot is None:
+        # スナップショット導入前のシャード
+        return 0, _read_json(shard_path(username), {})
+    if "bodies" not in snapshot:
+        # 本文を分けて保存する前のスナップショット
+        return snapshot["version"], snapshot["articles"]
+    try:
+        store = BodyStore(bodies_path(username, snapshot["bodies"])).pin()
+    except FileNotFoundError:
+        # スナップショットを読んだ後に、コンパクションが新しいスナップショットに置き換えて削除した
+        if retries <= 0:
+            raise
+        return _read_snapshot(username, retries - 1)
+    offsets = snapshot["offsets"]
+    return snapshot["version"], {title: LazyArticle(meta, store, offsets[title])
+                                 for title, meta in snapshot["articles"].items()}
+
+
+# スナップショットが本文を分けて保存する形式になっているか
+def _has_bodies(username):
+    return bool(glob.glob(bodies_path(username, "bodies-*.dat")))
+
+
+# スナップショットに使われていない古い本文ファイルを削除
+def _remove_old_bodies(username):
+    snapshot = _read_data(snapshot_path(username), {})
+    cutoff = time.time() - BODIES_GRACE_SECONDS
+    for path in glob.glob(bodies_path(username, "bodies-*.dat")):
+        if os.path.basename(path) != snapshot.get("bodies") and os.path.getmtime(path) < cutoff:
+            try:
+                os.remove(path)
+            except OSError:
+                # Windowsでは開いているセッションがあると削除できないので、次のコンパクションで削除する
+                pass
+
+
+# ログの先頭のコミット番号（これより後のコミットだけがログに残っている）
+def _log_base_version(entries):
+    first = entries[0]
+    # コンパクション後のログは操作を持たない見出し行から始まる
+    return first["version"] if "ops" not in first else first["version"] - 1
+
+
+class FileLock:
+    """プロセス内のロックとファイルロック（flock）を組み合わせたロック
+
+    同じスレッドからは入れ子で取得できる。別プロセスのStreamlitやワーカーとも排他する。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def acquire(self, blocking=True):
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if self._depth == 0:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, "a+b")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    self._file.close()
+                    self._thread_lock.release()
+                    return False
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+_user_locks = {}
+_user_locks_guard = threading.Lock()
+_index_lock = FileLock(os.path.join(DATA_DIR, ".users_index.lock"))
+
+
+# ユーザーごとのロックを取得（"memory"はプロセス内のキャッシュ用、それ以外はファイルロック）
+def _get_lock(username, kind):
+    with _user_locks_guard:
+        key = (username, kind)
+        if key not in _user_locks:
+            if kind == "memory":
+                _user_locks[key] = threading.RLock()
+            else:
+                _user_locks[key] = FileLock(os.path.join(user_dir(username), f".{kind}.lock"))
+        return _user_locks[key]
+
+
+# メモリ上のキャッシュ（全文検索インデックスなど）を守るプロセス内のロック
+def _user_lock(username):
+    return _get_lock(username, "memory")
+
+
+# 記事の書き込みをプロセス間で排他するロック（ユーザーごとなので別のユーザーの保存は待たない）
+def _write_lock(username):
+    return _get_lock(username, "write")
+
+
+# 同じユーザーのコンパクションを同時に1つだけ実行するためのロック
+def _compaction_lock(username):
+    return _get_lock(username, "compact")
+
+
+# 現在のコミット番号（ログの末尾だけを読んで求める）
+def current_version(username):
+    entry = wal.last_entry(wal_path(username))
+    if entry is not None:
+        return entry["version"]
+    return _read_data(snapshot_path(username), {}).get("version", 0)
+
+
+# スナップショットにログを適用して最新の状態を求める
+@perf.timed("storage.load_state")
+def _load_state(username, retries=3):
+    version, articles = _read_snapshot(username)
+    entries = [entry for entry, _ in wal.read_entries(wal_path(username))]
+    if entries and _log_base_version(entries) > version:
+        # 読み込みの途中でコンパクションが完了したので読み直す
+        if retries == 0:
+            raise RuntimeError(f"{username}のスナップショットとログが一致しません")
+        return _load_state(username, retries - 1)
+    for entry in entries:
+        if entry["version"] > version:
+            wal.apply_ops(articles, entry["ops"])
+            version = entry["version"]
+    return version, articles
+
+
+SaveResult = namedtuple("SaveResult", ["status", "version", "conflicts"])
+SaveResult.__doc__ = """保存の結果
+
+status: "saved"（保存した）, "merged"（他のセッションの変更を取り込んで保存した）,
+        "conflict"（他のセッションと同じ記事を変更していたため保存しなかった）,
+        "unchanged"（変更がなかった）
+"""
+
+
+# 操作が変更するタイトルの集合
+def _op_titles(ops):
+    titles = set()
+    for op in ops:
+        if op["op"] == "rename":
+            titles.update((op["from"], op["to"]))
+        else:
+            titles.add(op["title"])
+    return titles
+
+
+# 指定したコミット番号より後の他のセッションによる操作を取得
+def _ops_since(username, base_version):
+    """ログから取得できない（コンパクションで消えている）場合はNoneを返す"""
+    entries = [entry for entry, _ in wal.read_entries(wal_path(username))]
+    if not entries or _log_base_version(entries) > base_version:
+        return None
+    ops = []
+    for entry in entries:
+        if "ops" in entry and entry["version"] > base_version:
+            ops.extend(entry["ops"])
+    return ops
+
+
+# 変更をログに1件のコミットとして追記する
+@perf.timed("storage.commit")
+def _commit(username, ops, base_version=None, lookup=None, record_history=True, base_articles=None):
+    """(SaveResult, 取り込んだ他のセッションの操作) を返す
+
+    base_versionを渡すと、それ以降に他のセッションが同じ記事を変更していないか確認する。
+    その間のログがコンパクションで消えている場合は、変更する記事をbase_articlesと最新の内容で比べる
+    （このとき他のセッションの操作は分からないのでNoneを返す）。
+    lookupはインデックスの更新で他の記事の内容が必要になったときに使う（タイトル → 記事）。
+    record_historyがTrueなら、置き換えられる前の記事を変更履歴に残す。
+    base_articlesはbase_version時点の記事（変更履歴に残す記事をディスクから読み直さずに求める）。
+    """
+    with _write_lock(username):
+        current = current_version(username)
+        others = []
+        previous = None
+        if base_version is not None and base_version != current:
+            others = _ops_since(username, base_version)
+            titles = _op_titles(ops)
+            if others is not None:
+                conflicts = titles & _op_titles(others)
+            elif base_articles is None:
+                conflicts = titles
+            else:
+                # 読み込み後のログがコンパクションで消えているので、変更する記事が読み込み時点から変わったかを比べる
+                previous = _load_articles(username, titles)
+                conflicts = {title for title in titles
+                             if not _same_article(previous.get(title), base_articles.get(title))}
+            if conflicts:
+                return SaveResult("conflict", current, sorted(conflicts)), []
+        merged = others is None or bool(others)
+        version = current + 1
+        if record_history and previous is None:
+            previous = _articles_before(username, current, ops, others, base_articles)
+        wal.append(wal_path(username), {"version": version, "ops": ops})
+        if record_history:
+            get_history(username).record(version, ops, previous.get)
+        with _user_lock(username):
+            # 他のセッションの変更を取り込んだ場合、手元の記事は古いのでlookupは使わない
+            _update_indexes(username, version, ops, None if merged else lookup)
+    _maybe_compact(username)
+    return SaveResult("merged" if merged else "saved", version, []), others
+
+
+# 2つの記事が同じ内容か（同じ本文ファイルの同じ位置なら本文を読み込まずに判定する）
+def _same_article(a, b):
+    if a is None or b is None:
+        return a is b
+    if isinstance(a, LazyArticle) and isinstance(b, LazyArticle) and \
+            a.store.path == b.store.path and a.ref[:2] == b.ref[:2]:
+        return True
+    return dict(a) == dict(b)
+
+
+# 操作で置き換えられる、コミット時点の記事（変更履歴に残す用）
+def _articles_before(username, version, ops, others, base_articles):
+    """操作が変更するタイトルの記事だけを持つ辞書を返す（書き込みのロック中に呼ぶ）
+
+    共有データが追い出されていても、全記事を読み込み直さずに済むようにする。
+    """
+    shared = _cached_shared(username, version)
+    if shared is not None:
+        return shared.articles
+    titles = _op_titles(ops)
+    if base_articles is not None:
+        # 読み込み時点の記事に、その後の他のセッションの操作を重ねる
+        updated, deleted = wal.summarize_ops(others)
+        return {title: updated[title] if title in updated else base_articles.get(title)
+                for title in titles if title not in deleted}
+    return _load_articles(username, titles)
+
+
+# 最新の状態のうち、指定したタイトルの記事だけを読み込む
+def _load_articles(username, titles, retries=3):
+    snapshot = _read_data(snapshot_path(username), None)
+    if snapshot is None or "bodies" not in snapshot:
+        # 本文を分けて保存する前の形式は全体を読み込む
+        articles = _load_state(username)[1]
+        return {title: articles[title] for title in titles if title in articles}
+    try:
+        store = BodyStore(bodies_path(username, snapshot["bodies"])).pin()
+    except FileNotFoundError:
+        store = None
+    entries = [entry for entry, _ in wal.read_entries(wal_path(username))]
+    if store is None or (entries and _log_base_version(entries) > snapshot["version"]):
+        # 読み込みの途中でコンパクションが完了したので読み直す
+        if retries == 0:
+            raise RuntimeError(f"{username}のスナップショットとログが一致しません")
+        return _load_articles(username, titles, retries - 1)
+    metas, offsets = snapshot["articles"], snapshot["offsets"]
+    articles = {title: LazyArticle(metas[title], store, offsets[title]) for title in titles if title in metas}
+    for entry in entries:
+        if entry["version"] > snapshot["version"]:
+            wal.apply_ops(articles, [op for op in entry["ops"] if _op_titles((op,)) & titles])
+    return articles
+
+
+_compacting = set()
+_bulk = {}  # 一括で変更中のユーザー名 → 入れ子の深さ
+
+
+# 大量の記事を一括で保存する間、インデックスの更新とコンパクションを後回しにする
+@contextmanager
+def bulk_changes(username):
+    """終了時にインデックスを1回だけ作り直し、コンパクションを行う
+
+    コミットごとにインデックスを更新すると、保存済みの記事が増えるほど1回の保存が遅くなるため、
+    記事の取り込みなどではまとめて最後に作り直す。途中で読み込まれた場合もログから追いつくので結果は変わらない。
+    他のプロセスのコンパクションがBULK_COMPACT_TIMEOUT秒たっても終わらなければTimeoutErrorにする
+    （変更はログに保存済みで、インデックスも次に使うときにログから追いつく）。
+    """
+    with _user_locks_guard:
+        _bulk[username] = _bulk.get(username, 0) + 1
+    try:
+        yield
+    finally:
+        with _user_locks_guard:
+            _bulk[username] -= 1
+            done = not _bulk[username]
+            if done:
+                del _bulk[username]
+        compacted = not done or _compact_after_bulk(username)
+    if not compacted:
+        raise TimeoutError(f"{BULK_COMPACT_TIMEOUT}秒待ってもコンパクションを開始できませんでした（変更は保存済みです）")
+
+
+# 他のプロセスがコンパクション中なら終わるまで待ってからコンパクションする（できなければFalse）
+def _compact_after_bulk(username):
+    deadline = time.monotonic() + BULK_COMPACT_TIMEOUT
+    while not compact(username):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def _in_bulk(username):
+    with _user_locks_guard:
+        return username in _bulk
+
+
+# ログが大きくなったらバックグラウンドでコンパクションを始める
+def _maybe_compact(username):
+    if _in_bulk(username):
+        return
+    log_size = os.path.getsize(wal_path(username)) if os.path.exists(wal_path(username)) else 0
+    snapshot_size = os.path.getsize(snapshot_path(username)) if os.path.exists(snapshot_path(username)) else 0
+    if log_size < max(COMPACT_MIN_BYTES, snapshot_size):
+        return
+    with _user_locks_guard:
+        if username in _compacting:
+            return
+        _compacting.add(username)
+
+    def run():
+        try:
+            compact(username)
+        finally:
+            with _user_locks_guard:
+                _compacting.discard(username)
+
+    threading.Thread(target=run, name=f"compact-{user_key(username)}", daemon=True).start()
+
+
+# ログをスナップショットにまとめる
+@perf.timed("storage.compact")
+def compact(username):
+    """スナップショットとログを1つのスナップショットに畳み込み、ログを短くする
+
+    スナップショットの作成中も保存を止めないよう、開始時点までのログだけを
+    畳み込み、その後に追記された分は新しいログに引き継ぐ。
+    別のプロセスがコンパクション中の場合は何もせずFalseを返す。
+    """
+    if not _compaction_lock(username).acquire(blocking=False):
+        return False
+    try:
+        version, articles = _compact_log(username)
+    finally:
+        _compaction_lock(username).release()
+
+    # 保持する期間を過ぎた古い版を変更履歴から捨てる
+    history = get_history(username)
+    with _write_lock(username):
+        history.compact()
+    # 参照されなくなった画像とサムネイルを削除（変更履歴に残っている版の画像は残す）
+    live_refs = referenced_blobs(articles) | history.referenced_blobs()
+    get_blob_store(username).gc(live_refs)
+    get_thumbnail_cache(username).gc(live_refs)
+    _remove_old_bodies(username)
+    if _in_bulk(username):
+        return True
+    # 導出インデックスもこのタイミングで保存する（差分で更新してきたインデックスは必要なら作り直してから）
+    with _user_lock(username):
+        for name in DERIVED_INDEXES:
+            index = get_index(username, name)
+            if hasattr(index, "optimize"):
+                index.optimize()
+            index.save(index_path(username, name))
+    return True
+
+
+# 開始時点までのログをスナップショットに畳み込む
+def _compact_log(username):
+    path = wal_path(username)
+    with _write_lock(username):
+        log_end = os.path.getsize(path) if os.path.exists(path) else 0
+
+    version, articles = _read_snapshot(username)
+    for entry, offset in wal.read_entries(path):
+        if offset > log_end:
+            break
+        if "ops" in entry and entry["version"] > version:
+            wal.apply_ops(articles, entry["ops"])
+            version = entry["version"]
+    # ログはまだ残っているので、ここでスナップショットを置き換えても読み込み結果は変わらない
+    _write_snapshot(username, version, articles)
+
+    with _write_lock(username):
+        # スナップショットの後に追記されたログを新しいログとして残す
+        tail = b""
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                f.seek(log_end)
+                tail = f.read()
+        # 先頭にスナップショットのコミット番号を書いておき、ログが空でも番号を求められるようにする
+        header = json.dumps({"version": version}).encode("utf-8") + b"\n"
+        codec.replace_file(path, lambda f: f.write(header + tail))
+        if os.path.exists(shard_path(username)):
+            os.remove(shard_path(username))
+    return version, articles
+
+
+# 旧形式の単一ファイルをインデックス＋ユーザー別シャードに移行
+def migrate_legacy_file(legacy_path=USERS_FILE):
+    """旧形式のusers_data.jsonを分割して保存し、移行済みファイルをリネームする"""
+    if not os.path.exists(legacy_path):
+        return 0
+    with open(legacy_path, "r", encoding="utf-8") as f:
+        legacy_users = json.load(f)
+
+    index = _read_json(INDEX_FILE, {})
+    for username, data in legacy_users.items():
+        data = dict(data)
+        encyclopedia = data.pop("encyclopedia", {})
+        externalize_images(encyclopedia, get_blob_store(username))
+        normalize_legacy_categories(encyclopedia)
+        _write_snapshot(username, 0, encyclopedia)
+        index[username] = data
+    # シャードをすべて書き終えてからインデックスを保存する
+    _write_json(INDEX_FILE, index)
+    os.replace(legacy_path, legacy_path + ".migrated")
+    return len(legacy_users)
+
+
+# ユーザーデータ（認証情報のインデックス）の読み込み
+@perf.timed("storage.load_users")
+def load_users():
+    """ユーザー名 → {password, created} の辞書を返す（記事データは含まない）"""
+    if not os.path.exists(INDEX_FILE) and os.path.exists(USERS_FILE):
+        with _index_lock:
+            # 他のプロセスが先に移行していないか確認してから移行する
+            if not os.path.exists(INDEX_FILE):
+                migrate_legacy_file()
+    return _read_json(INDEX_FILE, {})
+
+
+# 新規ユーザーの登録
+def create_user(username, password_hash, created):
+    with _index_lock:
+        # 読み込みから保存までの間に他のプロセスが登録したユーザーを消さないよう、ロックの中で書き換える
+        users = load_users()
+        users[username] = {"password": password_hash, "created": created}
+        _write_json(INDEX_FILE, users)
+
+
+class _IndexContext:
+    """インデックスの更新中に、他の記事や先に更新されたインデックスを参照するための窓口"""
+
+    def __init__(self, username, lookup=None):
+        self.username = username
+        self._lookup = lookup
+        self._articles = None
+
+    def article(self, title):
+        if self._lookup is not None:
+            return self._lookup(title)
+        # 他のプロセスによる変更に追いつく場合など、手元に記事がなければ最新の状態を読み込む
+        if self._articles is None:
+            self._articles = get_shared_articles(self.username).articles
+        return self._articles.get(title)
+
+    def index(self, name):
+        return get_index(self.username, name)
+
+    def blob_size(self, ref):
+        """画像のファイルサイズ（バイト。見つからなければ0）"""
+        try:
+            return os.path.getsize(get_blob_store(self.username).path(ref))
+        except OSError:
+            return 0
+
+
+_derived = {}  # (ユーザー名, インデックス名) → インデックス（index.versionのコミットまで反映済み）
+
+
+# 記事から導出されるインデックスを取得
+@perf.timed("storage.get_index")
+def get_index(username, name):
+    """プロセス内でキャッシュし、他のプロセスによる変更はログから追いつく"""
+    with _user_lock(username):
+        index = _derived.get((username, name))
+        if index is None and os.path.exists(index_path(username, name)):
+            index = DERIVED_INDEXES[name][0].load(index_path(username, name))
+        if index is None or index.version < current_version(username):
+            index = _catch_up_index(username, name, index)
+        _derived[(username, name)] = index
+        return index
+
+
+# ログからインデックスに未反映のコミットを適用する
+def _catch_up_index(username, name, index):
+    entries = [entry for entry, _ in wal.read_entries(wal_path(username))]
+    if index is None or not entries or index.version < _log_base_version(entries):
+        # インデックスがない（移行直後など）か、必要なログがコンパクションで消えているので作り直す
+        version, articles = _load_state(username)
+        index = DERIVED_INDEXES[name][0].build(articles, _IndexContext(username, articles.get))
+        index.version = version
+        index.save(index_path(username, name))
+        return index
+    context = _IndexContext(username)
+    for entry in entries:
+        if "ops" in entry and entry["version"] > index.version:
+            updated, deleted = wal.summarize_ops(entry["ops"])
+            index.apply_changes(updated, deleted, context)
+            index.version = entry["version"]
+    return index
+
+
+# コミットした変更をメモリ上のインデックスに反映（ファイルへの保存はコンパクション時）
+def _update_indexes(username, version, ops, lookup=None):
+    if _in_bulk(username):
+        # 一括変更の後で作り直すので、メモリ上のインデックスは捨てておく
+        for name in DERIVED_INDEXES:
+            _derived.pop((username, name), None)
+        return
+    updated, deleted = wal.summarize_ops(ops)
+    context = _IndexContext(username, lookup)
+    for name in DERIVED_INDEXES:
+        index = _derived.get((username, name))
+        if index is not None and index.version == version - 1:
+            index.apply_changes(updated, deleted, context)
+            index.version = version
+
+
+_shared = OrderedDict()  # (ユーザー名, コミット番号) → SharedArticles
+_shared_lock = threading.Lock()
+
+
+# 共有の記事データをキャッシュに登録（同じユーザーの古いコミット番号のデータは捨てる）
+def _cache_shared(username, shared):
+    with _shared_lock:
+        for key in [key for key in _shared if key[0] == username and key[1] < shared.version]:
+            del _shared[key]
+        _shared[(username, shared.version)] = shared
+        _shared.move_to_end((username, shared.version))
+        while len(_shared) > SHARED_CACHE_SIZE:
+            _shared.popitem(last=False)
+    return shared
+
+
+def _cached_shared(username, version):
+    with _shared_lock:
+        shared = _shared.get((username, version))
+        if shared is not None:
+            _shared.move_to_end((username, version))
+    perf.count("storage.shared_cache.hit" if shared is not None else "storage.shared_cache.miss")
+    return shared
+
+
+# 共有の記事データのキャッシュからユーザーの分を捨てる
+def release_shared(username):
+    """保存したばかりの本文を持ったままの共有データを手放し、次はスナップショットから読み込み直す
+
+    大量の記事を取り込むときにコンパクションの後で呼ぶと、メモリには一覧用の項目だけが残る。
+    """
+    with _shared_lock:
+        for key in [key for key in _shared if key[0] == username]:
+            del _shared[key]
+
+
+# 最新のコミット時点の記事データを取得（全セッションで共有する）
+@perf.timed("storage.get_shared_articles")
+def get_shared_articles(username):
+    """他のプロセスが保存してコミット番号が変わっていれば読み込み直す"""
+    shared = _cached_shared(username, current_version(username))
+    if shared is not None:
+        return shared
+    with _user_lock(username):
+        version, articles = _load_state(username)
+        shared = _cached_shared(username, version)
+        if shared is not None:
+            return shared
+        # 旧形式の画像やカテゴリーが残っていれば変換して保存し、保存後の状態を共有する
+        changed = externalize_images(articles, get_blob_store(username))
+        changed += normalize_legacy_categories(articles)
+        if changed:
+            ops = [{"op": "put", "title": title, "article": articles[title]} for title in dict.fromkeys(changed)]
+            # 保存形式の変換なので変更履歴には残さない
+            _commit(username, ops, lookup=articles.get, record_history=False)
+            return get_shared_articles(username)
+        if not _has_bodies(username) and compact(username):
+            # 本文を分けて保存する形式に書き直し、次からは一覧用の項目だけを読み込む
+            return get_shared_articles(username)
+        return _cache_shared(username, SharedArticles(articles, version))
+
+
+# ユーザーの百科事典データを取得
+def get_user_encyclopedia(username):
+    """共有の記事データを参照し、セッション内の変更だけを持つEncyclopediaを返す"""
+    return Encyclopedia(get_shared_articles(username))
+
+
+# ユーザーの百科事典データを保存
+@perf.timed("storage.save_user_encyclopedia")
+def save_user_encyclopedia(username, encyclopedia, check_user=True):
+    """変更された記事だけをログに追記し、SaveResultを返す
+
+    読み込んだ後に他のセッションが保存していた場合、別の記事への変更なら
+    取り込んだうえで保存し、同じ記事を変更していた場合は保存しない。
+    """
+    if check_user and username not in load_users():
+        return SaveResult("unchanged", None, [])
+    if isinstance(encyclopedia, Encyclopedia):
+        return commit_changes(username, encyclopedia, encyclopedia.pop_changes())
+    # 通常の辞書の場合は保存済みの内容との差分を上書きする
+    ops = diff_encyclopedia(_load_state(username)[1], encyclopedia)
+    if not ops:
+        return SaveResult("unchanged", current_version(username), [])
+    return _commit(username, ops, lookup=encyclopedia.get)[0]
+
+
+# 読み込み時点の記事に操作を重ねた状態を引く関数（タイトル → 記事）
+def _committed_lookup(base_articles, ops):
+    updated, deleted = wal.summarize_ops(ops)
+
+    def lookup(title):
+        if title in updated:
+            return updated[title]
+        return None if title in deleted else base_articles.get(title)
+    return lookup
+
+
+# Encyclopediaから取り出した変更を保存し、結果をEncyclopediaに反映する
+def commit_changes(username, encyclopedia, ops):
+    if not ops:
+        return SaveResult("unchanged", encyclopedia.version, [])
+    # 書き込みスレッドで呼ばれる間もセッションは編集を続けるので、手元の記事ではなく
+    # 読み込み時点の記事にこの操作を重ねた、コミットされる状態をインデックスの更新に使う
+    base_articles = encyclopedia.shared.articles
+    result, others = _commit(username, ops, encyclopedia.version, _committed_lookup(base_articles, ops),
+                             base_articles=base_articles)
+    with encyclopedia.lock:
+        if result.status == "conflict":
+            encyclopedia.restore_changes(ops)
+        else:
+            # 他のセッションの変更も含めた保存後の共有データに乗り換える
+            shared = _cached_shared(username, result.version)
+            if shared is None and others is None:
+                # 取り込んだ他のセッションの操作が分からないので、最新の状態を読み込む
+                shared = get_shared_articles(username)
+            elif shared is None:
+                shared = _cache_shared(username, encyclopedia.shared.advance(others + ops, result.version))
+            encyclopedia.rebase(shared, ops)
+        encyclopedia.last_result = result
+    return result
+
+
+# タイトルと本文の全文検索
+@perf.timed("storage.search_articles")
+def search_articles(username, query, limit=None):
+    """[(タイトル, スコア)] を関連度の高い順に返す"""
+    return get_index(username, "search").search(query, limit)
+
+
+# タイトルの入力候補（誤字や全角・半角、カタカナ・ひらがなの違いを許す）
+def suggest_titles(username, query, limit=10, within=None):
+    """[(タイトル, 編集距離)] を良い順に返す（withinを渡すとその集合のタイトルだけ）"""
+    return get_index(username, "titles").suggest(query, limit, within)
+
+
+# 記事の過去の版の一覧（新しい順。各版の内容は読み込まない）
+def article_history(username, title):
+    """[{"version", "time", "saved", "kind", ...}] を返す（versionはその版を置き換えたコミット番号）"""
+    return get_history(username).revisions(title)
+
+
+# 記事の過去の版を復元
+def get_revision(username, title, version):
+    """versionのコミットで置き換えられる前の記事を返す（復元できなければValueError）"""
+    return get_history(username).revision(title, version, get_shared_articles(username).articles.get(title))
+
+
+# 統計情報（記事数などの合計と、列ごとの配列にした記事の項目）
+def get_article_stats(username):
+    return get_index(username, "stats")
+
+
+# 内容の似ている記事（保存済みの一覧を返すだけなので記事数によらない）
+def related_articles(username, title, limit=10):
+    """[(タイトル, 類似度)] を類似度の高い順に返す"""
+    return get_index(username, "related").related(title, limit)
+
+
+# 記事間のリンクのグラフ（被リンクや孤立した記事の一覧に使う）
+def get_link_graph(username):
+    return get_index(username, "links")
+
+
+if __name__ == "__main__":
+    # 旧形式からの一括移行: python storage.py
+    count = migrate_legacy_file()
+    print(f"{count}人のユーザーを移行しました")
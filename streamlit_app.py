@@ -1,98 +1,96 @@
 import streamlit as st
-import json
+import pandas as pd
 import os
+import uuid
 import hashlib
-import base64
+import tempfile
 from datetime import datetime
-from io import BytesIO
-from PIL import Image
-
-# ファイルパス
-USERS_FILE = "users_data.json"
+from storage import (load_users, create_user, get_user_encyclopedia,
+                     get_blob_store, get_thumbnail_cache, search_articles, get_link_graph,
+                     suggest_titles, article_history, get_revision, get_article_stats,
+                     related_articles)
+from writer import save_in_background, flush, save_status
+from images import encode_images, decode_image, load_thumbnail
+from article_links import link_article
+from categories import normalize_categories
+from transfer import export_zip, export_jsonl, import_archive
+import perf
 
 # パスワードのハッシュ化
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
-# 画像をBase64エンコード
-def encode_image(image_file):
-    """アップロードされた画像を高品質なBase64文字列に変換"""
-    if image_file is not None:
-        # PILで画像を開く
-        img = Image.open(image_file)
-        
-        # 画像を適度なサイズにリサイズ（幅800px程度に制限して容量削減）
-        max_width = 800
-        if img.width > max_width:
-            ratio = max_width / img.width
-            new_height = int(img.height * ratio)
-            img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
-        
-        # 高品質でバイトストリームに保存
-        buffered = BytesIO()
-        # 画像形式を保持（JPEG, PNGなど）
-        img_format = img.format if img.format else 'PNG'
-        if img_format == 'JPEG':
-            img.save(buffered, format=img_format, quality=95, optimize=True)
-        else:
-            img.save(buffered, format=img_format, optimize=True)
-        
-        return base64.b64encode(buffered.getvalue()).decode()
-    return None
+# 記事を保存（ディスクへの書き込みはバックグラウンドで行う）
+def save_articles():
+    """書き込みを待たずに戻る。保存の結果（競合やエラーを含む）は次の再実行でヘッダーに表示する"""
+    save_in_background(st.session_state.username, st.session_state.encyclopedia)
 
-# Base64文字列を画像に変換
-def decode_image(base64_string):
-    """Base64文字列を画像に変換"""
-    if base64_string:
-        return Image.open(BytesIO(base64.b64decode(base64_string)))
-    return None
+# パフォーマンス画面を表示できるユーザー（環境変数にカンマ区切りで指定）
+ADMIN_USERS = {name.strip() for name in os.environ.get("ENCYCLOPEDIA_ADMINS", "").split(",") if name.strip()}
 
-# 記事内容から他の記事タイトルを検出してリンク化
-def create_article_links(content, all_titles, current_title):
-    """記事内容に含まれる他の記事タイトルをハイライト（改行を保持）"""
-    linked_content = content
-    # 現在の記事以外のタイトルを検索（長いタイトルから順に処理して部分一致を防ぐ）
-    sorted_titles = sorted([t for t in all_titles if t != current_title], key=len, reverse=True)
-    
-    for title in sorted_titles:
-        if title in linked_content:
-            # タイトルを太字でハイライト
-            linked_content = linked_content.replace(title, f"**{title}**")
-    
-    # 改行を<br>タグに変換してMarkdownで正しく表示
-    linked_content = linked_content.replace('\n', '  \n')
-    
-    return linked_content
+# 1ページに表示する件数
+SIDEBAR_PAGE_SIZE = 50
+RESULTS_PAGE_SIZE = 30
+LINKS_PAGE_SIZE = 12
+PICKER_PAGE_SIZE = 100
+
+# タイトルの入力候補の最大件数
+TITLE_SUGGESTIONS = 50
 
-# ユーザーデータの読み込み
-def load_users():
-    if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+# 関連記事（内容の似ている記事）の表示件数
+RELATED_ARTICLES = 8
 
-# ユーザーデータの保存
-def save_users(users):
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
+# 画面からダウンロードできる書き出しの最大サイズ（バイト）
+# st.download_buttonはファイル全体をメモリに読み込んで送るので、これより大きい書き出しはコマンドで作る
+MAX_DOWNLOAD_BYTES = 200 * 1024 * 1024
 
-# ユーザーの百科事典データを取得
-def get_user_encyclopedia(username):
-    users = load_users()
-    if username in users:
-        return users[username].get("encyclopedia", {})
-    return {}
+# ページ送りを表示して、表示する範囲 (開始, 終了) を返す
+def page_range(total, page_size, key):
+    pages = max(1, -(-total // page_size))
+    if pages == 1:
+        return 0, total
+    # 記事が減ってページ数が少なくなった場合は最後のページにする
+    st.session_state[key] = min(st.session_state.get(key, 1), pages)
+    page = st.number_input(f"ページ（全{pages}ページ）", min_value=1, max_value=pages, step=1, key=key)
+    start = (page - 1) * page_size
+    return start, min(start + page_size, total)
 
-# ユーザーの百科事典データを保存
-def save_user_encyclopedia(username, encyclopedia):
-    users = load_users()
-    if username in users:
-        users[username]["encyclopedia"] = encyclopedia
-        save_users(users)
+# 進み具合のバーを表示し、取り込み・書き出しに渡すコールバックを返す
+def progress_callback(text):
+    bar = st.progress(0.0, text=text)
+    shown = [-1]
+
+    def update(done, fraction):
+        # 1%進むごとに表示を更新する（記事ごとに更新すると画面への送信が多くなりすぎる）
+        percent = int(fraction * 100)
+        if percent != shown[0]:
+            shown[0] = percent
+            bar.progress(fraction, text=f"{text}（{done:,}件）")
+    return update
+
+# 保存の状態を表示（他のセッションと同じ記事を変更していた場合は最新の内容を読み込み直す）
+def show_save_status():
+    status = save_status(st.session_state.encyclopedia)
+    if status == "conflict":
+        conflicts = st.session_state.encyclopedia.last_result.conflicts
+        st.session_state.encyclopedia = get_user_encyclopedia(st.session_state.username)
+        st.error(f"他のセッションで「{'」「'.join(conflicts)}」が更新されていたため保存できませんでした。"
+                 "最新の内容を読み込んだので、もう一度操作してください。")
+    elif status == "error":
+        st.error("保存中にエラーが発生しました。次の保存時に再試行します。")
+    elif status == "pending":
+        st.caption("⏳ 保存中...")
+    else:
+        st.caption("💾 保存済み")
 
 # アプリの設定
 st.set_page_config(page_title="オリジナル百科事典", page_icon="📚", layout="wide")
 
+# 再実行ごとの計測（無効なときは何もしない）
+if "perf_session" not in st.session_state:
+    st.session_state.perf_session = uuid.uuid4().hex
+perf.start_rerun(st.session_state.perf_session, st.session_state.get("username") or "")
+
 # セッション状態の初期化
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
@@ -102,6 +100,8 @@ if "encyclopedia" not in st.session_state:
     st.session_state.encyclopedia = {}
 if "selected_article" not in st.session_state:
     st.session_state.selected_article = None
+if "opened_image" not in st.session_state:
+    st.session_state.opened_image = None
 
 # ログイン/サインアップ画面
 if not st.session_state.logged_in:
@@ -123,6 +123,8 @@ if not st.session_state.logged_in:
                     if users[username]["password"] == hash_password(password):
                         st.session_state.logged_in = True
                         st.session_state.username = username
+                        # 前のセッションの保存待ちを書き込んでから読み込む
+                        flush(username)
                         st.session_state.encyclopedia = get_user_encyclopedia(username)
                         st.success(f"ようこそ、{username}さん！")
                         st.rerun()
@@ -151,23 +153,25 @@ if not st.session_state.logged_in:
                     if new_username in users:
                         st.error("このユーザー名は既に使用されています")
                     else:
-                        users[new_username] = {
-                            "password": hash_password(new_password),
-                            "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            "encyclopedia": {}
-                        }
-                        save_users(users)
+                        create_user(new_username, hash_password(new_password),
+                                    datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
                         st.success("登録が完了しました！ログインしてください。")
 
 else:
     # ログイン後のメイン画面
+    perf.phase("render.header")
+    blob_store = get_blob_store(st.session_state.username)
+    thumbnail_cache = get_thumbnail_cache(st.session_state.username)
     
     # タイトルとログアウトボタン
     col1, col2 = st.columns([4, 1])
     with col1:
         st.title(f"📚 {st.session_state.username}の百科事典")
     with col2:
+        show_save_status()
         if st.button("🚪 ログアウト"):
+            # 保存待ちの変更を書き込んでからログアウト
+            flush(st.session_state.username)
             st.session_state.logged_in = False
             st.session_state.username = None
             st.session_state.encyclopedia = {}
@@ -176,9 +180,13 @@ else:
     st.markdown("---")
     
     # サイドバー
+    perf.phase("render.sidebar")
     with st.sidebar:
         st.header("メニュー")
-        menu = st.radio("機能を選択", ["🔍 記事を検索", "➕ 新規記事作成", "📝 記事を編集", "🗑️ 記事を削除", "📊 統計情報"])
+        menu_items = ["🔍 記事を検索", "➕ 新規記事作成", "📝 記事を編集", "🗑️ 記事を削除", "📦 インポート/エクスポート", "📊 統計情報"]
+        if st.session_state.username in ADMIN_USERS:
+            menu_items.append("⏱️ パフォーマンス")
+        menu = st.radio("機能を選択", menu_items)
         
         st.markdown("---")
         
@@ -187,52 +195,57 @@ else:
         
         if show_list:
             if st.session_state.encyclopedia:
-                for title in sorted(st.session_state.encyclopedia.keys()):
+                titles = st.session_state.encyclopedia.titles
+                start, end = page_range(len(titles), SIDEBAR_PAGE_SIZE, "sidebar_page")
+                for title in titles[start:end]:
                     st.text(f"• {title}")
             else:
                 st.info("まだ記事がありません")
     
     # メイン画面
+    perf.phase(f"render.{menu}")
     if menu == "🔍 記事を検索":
         st.header("記事を検索")
         
         if st.session_state.encyclopedia:
-            # カテゴリー一覧を取得（リスト形式にも対応）
-            all_categories = set()
-            for article in st.session_state.encyclopedia.values():
-                cats = article.get("category", ["未分類"])
-                if isinstance(cats, list):
-                    all_categories.update(cats)
-                else:
-                    all_categories.add(cats)
-            all_categories = sorted(all_categories)
+            # カテゴリー一覧を取得
+            all_categories = st.session_state.encyclopedia.categories.names()
             
             col1, col2 = st.columns(2)
             with col1:
-                search_term = st.text_input("🔎 検索キーワードを入力", placeholder="記事のタイトルで検索")
+                search_term = st.text_input("🔎 検索キーワードを入力", placeholder="記事のタイトルや本文で検索")
             with col2:
                 selected_category = st.selectbox("🏷️ カテゴリーで絞り込み", ["すべて"] + all_categories)
             
-            # 検索結果のフィルタリング
-            results = st.session_state.encyclopedia.copy()
-            
-            # キーワード検索
+            # キーワード検索（タイトルと本文の全文検索・関連度順）
             if search_term:
-                results = {k: v for k, v in results.items() 
-                          if search_term.lower() in k.lower()}
+                results = [title for title, score in search_articles(st.session_state.username, search_term)
+                           if title in st.session_state.encyclopedia]
+                # 検索語に分割できない部分一致（1文字の検索など）や誤字を含むタイトルも入力候補から拾う
+                found = set(results)
+                results += [title for title, distance in
+                            suggest_titles(st.session_state.username, search_term, TITLE_SUGGESTIONS)
+                            if title not in found and title in st.session_state.encyclopedia]
+            elif selected_category != "すべて":
+                # カテゴリーのソート済みの索引から、表示するページの分だけを取り出す
+                results = st.session_state.encyclopedia.categories.sorted_titles(selected_category)
+            else:
+                # ソート済みのタイトルの索引から、表示するページの分だけを取り出す
+                results = st.session_state.encyclopedia.titles
             
             # カテゴリーで絞り込み
-            if selected_category != "すべて":
-                results = {k: v for k, v in results.items() 
-                          if selected_category in (v.get("category", ["未分類"]) if isinstance(v.get("category", []), list) else [v.get("category", "未分類")])}
+            if search_term and selected_category != "すべて":
+                in_category = st.session_state.encyclopedia.categories.titles(selected_category)
+                results = [k for k in results if k in in_category]
             
             if results:
                 st.success(f"{len(results)}件の記事が見つかりました")
                 
                 # 記事タイトルボタンを表示
                 st.markdown("### 📋 記事一覧")
+                start, end = page_range(len(results), RESULTS_PAGE_SIZE, "results_page")
                 cols = st.columns(3)
-                for idx, title in enumerate(sorted(results.keys())):
+                for idx, title in enumerate(results[start:end]):
                     with cols[idx % 3]:
                         if st.button(f"📄 {title}", key=f"article_btn_{title}", use_container_width=True):
                             st.session_state.selected_article = title
@@ -245,11 +258,7 @@ else:
                     content = st.session_state.encyclopedia[st.session_state.selected_article]
                     
                     # カテゴリー表示
-                    cats = content.get('category', ['未分類'])
-                    if isinstance(cats, list):
-                        category_display = ", ".join(cats)
-                    else:
-                        category_display = cats
+                    category_display = ", ".join(normalize_categories(content.get('category')))
                     st.markdown(f"**カテゴリー:** {category_display}")
                     st.markdown(f"**作成日:** {content.get('created', '不明')}")
                     
@@ -260,39 +269,81 @@ else:
                         # 画像を横に並べて表示（3列）
                         img_cols = st.columns(min(len(images), 3))
                         for idx, img_data in enumerate(images):
-                            img = decode_image(img_data)
-                            if img:
+                            thumb = load_thumbnail(img_data, blob_store, thumbnail_cache)
+                            if thumb:
                                 with img_cols[idx % 3]:
-                                    st.image(img, caption=f"画像 {idx + 1}", width=150)
+                                    st.image(thumb, caption=f"画像 {idx + 1}", width=150)
+                                    if st.button("🔍 拡大", key=f"open_image_{idx}"):
+                                        st.session_state.opened_image = img_data
+                        
+                        # 拡大表示が選ばれた画像だけ元のサイズで読み込む
+                        if st.session_state.opened_image in images:
+                            img = decode_image(st.session_state.opened_image, blob_store)
+                            if img:
+                                st.image(img, caption=f"画像 {images.index(st.session_state.opened_image) + 1}")
+                            if st.button("✖️ 閉じる", key="close_image"):
+                                st.session_state.opened_image = None
+                                st.rerun()
                     
                     st.markdown("---")
                     
                     # 記事内容に他の記事へのリンクを作成
                     article_content = content.get('content', '')
-                    all_titles = list(st.session_state.encyclopedia.keys())
                     
                     # 他の記事タイトルを検出してボタン化
                     st.markdown("### 本文")
                     
                     # 記事内容を表示（他の記事タイトルをハイライト）
-                    linked_content = create_article_links(article_content, all_titles, st.session_state.selected_article)
+                    # タイトルの集合が変わっていなければ、全タイトルをなぞらずに構築済みのオートマトンを使う
+                    linked_content, mentioned_articles = link_article(
+                        article_content, st.session_state.encyclopedia.titles, st.session_state.selected_article,
+                        key=(st.session_state.username, st.session_state.encyclopedia.title_set_key()))
                     st.markdown(linked_content)
                     
                     # 関連記事のボタンを表示
                     st.markdown("---")
                     st.markdown("### 🔗 本文中で言及されている記事")
                     
-                    mentioned_articles = [t for t in all_titles if t != st.session_state.selected_article and t in article_content]
-                    
                     if mentioned_articles:
-                        link_cols = st.columns(min(len(mentioned_articles), 4))
-                        for idx, mentioned_title in enumerate(mentioned_articles):
+                        start, end = page_range(len(mentioned_articles), LINKS_PAGE_SIZE, f"mentions_page_{st.session_state.selected_article}")
+                        link_cols = st.columns(min(end - start, 4))
+                        for idx, mentioned_title in enumerate(mentioned_articles[start:end]):
                             with link_cols[idx % len(link_cols)]:
                                 if st.button(f"➡️ {mentioned_title}", key=f"link_{mentioned_title}", use_container_width=True):
                                     st.session_state.selected_article = mentioned_title
                                     st.rerun()
                     else:
                         st.info("この記事では他の記事への言及はありません")
+                    
+                    # 被リンク（この記事に言及している記事）を表示
+                    st.markdown("### ↩️ この記事に言及している記事")
+                    backlinks = get_link_graph(st.session_state.username).backlinks(st.session_state.selected_article)
+                    backlinks = [t for t in backlinks if t in st.session_state.encyclopedia]
+                    if backlinks:
+                        start, end = page_range(len(backlinks), LINKS_PAGE_SIZE, f"backlinks_page_{st.session_state.selected_article}")
+                        back_cols = st.columns(min(end - start, 4))
+                        for idx, source_title in enumerate(backlinks[start:end]):
+                            with back_cols[idx % len(back_cols)]:
+                                if st.button(f"⬅️ {source_title}", key=f"backlink_{source_title}", use_container_width=True):
+                                    st.session_state.selected_article = source_title
+                                    st.rerun()
+                    else:
+                        st.info("この記事に言及している記事はありません")
+
+                    # 関連記事（本文の内容が似ている記事）を表示
+                    st.markdown("### 🧭 関連記事")
+                    related = related_articles(st.session_state.username, st.session_state.selected_article, RELATED_ARTICLES)
+                    related = [(t, score) for t, score in related if t in st.session_state.encyclopedia]
+                    if related:
+                        related_cols = st.columns(min(len(related), 4))
+                        for idx, (related_title, score) in enumerate(related):
+                            with related_cols[idx % len(related_cols)]:
+                                if st.button(f"🧭 {related_title}", key=f"related_{related_title}",
+                                             help=f"類似度: {score:.2f}", use_container_width=True):
+                                    st.session_state.selected_article = related_title
+                                    st.rerun()
+                    else:
+                        st.info("内容の似ている記事はありません")
                         
             else:
                 st.warning("該当する記事が見つかりませんでした")
@@ -335,13 +386,8 @@ else:
                         categories = ["未分類"]
                     
                     # 画像をエンコード（複数対応）
-                    images_data = []
-                    if uploaded_images:
-                        for img_file in uploaded_images:
-                            img_file.seek(0)  # ファイルポインタを先頭に戻す
-                            encoded = encode_image(img_file)
-                            if encoded:
-                                images_data.append(encoded)
+                    # 複数の画像は並列に変換する
+                    images_data = encode_images(uploaded_images, blob_store, thumbnail_cache)
                     
                     st.session_state.encyclopedia[title] = {
                         "category": categories,
@@ -349,7 +395,7 @@ else:
                         "images": images_data,
                         "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                     }
-                    save_user_encyclopedia(st.session_state.username, st.session_state.encyclopedia)
+                    save_articles()
                     st.success(f"✅ 記事「{title}」を保存しました！")
                     st.balloons()
     
@@ -363,29 +409,22 @@ else:
                 search_edit = st.text_input("🔎 記事を検索", placeholder="記事のタイトルで絞り込み", key="search_edit")
             with col2:
                 # カテゴリー一覧を取得
-                all_categories = set()
-                for article in st.session_state.encyclopedia.values():
-                    cats = article.get("category", ["未分類"])
-                    if isinstance(cats, list):
-                        all_categories.update(cats)
-                    else:
-                        all_categories.add(cats)
-                category_filter = st.selectbox("🏷️ カテゴリーで絞り込み", ["すべて"] + sorted(all_categories), key="category_edit")
+                all_categories = st.session_state.encyclopedia.categories.names()
+                category_filter = st.selectbox("🏷️ カテゴリーで絞り込み", ["すべて"] + all_categories, key="category_edit")
             
-            # 検索結果のフィルタリング
-            filtered_articles = list(st.session_state.encyclopedia.keys())
-            
-            # キーワード検索
+            # キーワード検索（タイトルの入力候補を良い順に。カテゴリーが指定されていればその記事だけ）
             if search_edit:
-                filtered_articles = [k for k in filtered_articles 
-                                   if search_edit.lower() in k.lower()]
-            
-            # カテゴリーで絞り込み
-            if category_filter != "すべて":
-                filtered_articles = [k for k in filtered_articles
-                                   if category_filter in (st.session_state.encyclopedia[k].get("category", ["未分類"]) 
-                                   if isinstance(st.session_state.encyclopedia[k].get("category", []), list) 
-                                   else [st.session_state.encyclopedia[k].get("category", "未分類")])]
+                within = None
+                if category_filter != "すべて":
+                    within = st.session_state.encyclopedia.categories.titles(category_filter)
+                filtered_articles = [title for title, distance in
+                                     suggest_titles(st.session_state.username, search_edit, TITLE_SUGGESTIONS, within)
+                                     if title in st.session_state.encyclopedia]
+            elif category_filter != "すべて":
+                filtered_articles = st.session_state.encyclopedia.categories.sorted_titles(category_filter)
+            else:
+                # ソート済みのタイトルの索引から、選択肢のページの分だけを取り出す
+                filtered_articles = st.session_state.encyclopedia.titles
             
             if not filtered_articles:
                 st.warning("該当する記事が見つかりませんでした")
@@ -393,17 +432,14 @@ else:
                 if search_edit or category_filter != "すべて":
                     st.success(f"{len(filtered_articles)}件の記事が見つかりました")
                 
-                article_to_edit = st.selectbox("編集する記事を選択", sorted(filtered_articles))
+                start, end = page_range(len(filtered_articles), PICKER_PAGE_SIZE, "edit_page")
+                article_to_edit = st.selectbox("編集する記事を選択", filtered_articles[start:end])
             
                 if article_to_edit:
                     current_data = st.session_state.encyclopedia[article_to_edit]
                     
                     # カテゴリーをリストから文字列に変換
-                    current_categories = current_data.get("category", [])
-                    if isinstance(current_categories, list):
-                        category_str = ", ".join(current_categories)
-                    else:
-                        category_str = current_categories
+                    category_str = ", ".join(current_data.get("category", []))
                     
                     with st.form("edit_article"):
                         new_title = st.text_input("📝 記事タイトル", value=article_to_edit)
@@ -415,10 +451,10 @@ else:
                             st.write(f"**現在の画像: {len(existing_images)}枚**")
                             current_img_cols = st.columns(min(len(existing_images), 3))
                             for idx, img_data in enumerate(existing_images):
-                                current_img = decode_image(img_data)
-                                if current_img:
+                                current_thumb = load_thumbnail(img_data, blob_store, thumbnail_cache)
+                                if current_thumb:
                                     with current_img_cols[idx % 3]:
-                                        st.image(current_img, caption=f"画像 {idx + 1}", width=150)
+                                        st.image(current_thumb, caption=f"画像 {idx + 1}", width=150)
                         
                         # 画像の更新（複数対応）
                         uploaded_images = st.file_uploader("🖼️ 新しい画像をアップロード（任意・複数選択可・空欄の場合は既存の画像を保持）", 
@@ -441,6 +477,8 @@ else:
                         if submitted:
                             if not new_title:
                                 st.error("タイトルを入力してください")
+                            elif new_title != article_to_edit and new_title in st.session_state.encyclopedia:
+                                st.error("同じタイトルの記事が既に存在します")
                             elif not new_content:
                                 st.error("記事内容を入力してください")
                             else:
@@ -456,28 +494,62 @@ else:
                                     images_data = []  # すべての画像を削除
                                 elif uploaded_images:
                                     # 新しい画像に更新
-                                    images_data = []
-                                    for img_file in uploaded_images:
-                                        img_file.seek(0)
-                                        encoded = encode_image(img_file)
-                                        if encoded:
-                                            images_data.append(encoded)
-                                
-                                # 古いタイトルのデータを削除
-                                if new_title != article_to_edit:
-                                    del st.session_state.encyclopedia[article_to_edit]
+                                    images_data = encode_images(uploaded_images, blob_store, thumbnail_cache)
                                 
                                 # 新しいデータを保存
-                                st.session_state.encyclopedia[new_title] = {
+                                updated_article = {
                                     "category": categories,
                                     "content": new_content,
                                     "images": images_data,
                                     "created": current_data.get("created", datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
                                     "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                                 }
-                                save_user_encyclopedia(st.session_state.username, st.session_state.encyclopedia)
+                                if new_title != article_to_edit:
+                                    # タイトルを変更した場合は古いタイトルのデータを置き換える
+                                    st.session_state.encyclopedia.rename(article_to_edit, new_title, updated_article)
+                                else:
+                                    st.session_state.encyclopedia[new_title] = updated_article
+                                save_articles()
                                 st.success(f"✅ 記事「{new_title}」を更新しました！")
                                 st.rerun()
+                    
+                    # 変更履歴（表示を選んだときだけ読み込み、過去の版はセッションに保持しない）
+                    if st.toggle("📜 変更履歴を表示", key="show_history"):
+                        revisions = article_history(st.session_state.username, article_to_edit)
+                        if not revisions:
+                            st.info("この記事の変更履歴はまだありません")
+                        else:
+                            labels = {}
+                            for revision_info in revisions:
+                                label = f"{revision_info['time']} までの版（保存日時: {revision_info['saved'] or '不明'}）"
+                                if "renamed_from" in revision_info:
+                                    label += f"・旧タイトル「{revision_info['renamed_from']}」"
+                                labels[revision_info["version"]] = label
+                            revision_version = st.selectbox("表示する版", list(labels), format_func=labels.get,
+                                                            key="history_version")
+                            try:
+                                revision = get_revision(st.session_state.username, article_to_edit, revision_version)
+                            except ValueError as e:
+                                st.error(str(e))
+                                revision = None
+                            if revision:
+                                with st.container(border=True):
+                                    st.markdown(f"**カテゴリー:** {', '.join(normalize_categories(revision.get('category')))}")
+                                    revision_images = revision.get("images", [])
+                                    if revision_images:
+                                        revision_cols = st.columns(min(len(revision_images), 3))
+                                        for idx, img_data in enumerate(revision_images):
+                                            thumb = load_thumbnail(img_data, blob_store, thumbnail_cache)
+                                            if thumb:
+                                                with revision_cols[idx % 3]:
+                                                    st.image(thumb, caption=f"画像 {idx + 1}", width=150)
+                                    st.markdown(revision.get("content", ""))
+                                if st.button("↩️ この版に戻す", key="restore_revision"):
+                                    restored = dict(revision, updated=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                                    st.session_state.encyclopedia[article_to_edit] = restored
+                                    save_articles()
+                                    st.success(f"✅ 記事「{article_to_edit}」を選んだ版に戻しました")
+                                    st.rerun()
         else:
             st.info("編集する記事がありません")
     
@@ -485,7 +557,9 @@ else:
         st.header("記事を削除")
         
         if st.session_state.encyclopedia:
-            article_to_delete = st.selectbox("削除する記事を選択", sorted(st.session_state.encyclopedia.keys()))
+            titles = st.session_state.encyclopedia.titles
+            start, end = page_range(len(titles), PICKER_PAGE_SIZE, "delete_page")
+            article_to_delete = st.selectbox("削除する記事を選択", titles[start:end])
             
             if article_to_delete:
                 st.warning(f"本当に「{article_to_delete}」を削除しますか？")
@@ -497,16 +571,16 @@ else:
                     st.write(f"**この記事の画像 ({len(preview_images)}枚) も削除されます:**")
                     del_preview_cols = st.columns(min(len(preview_images), 3))
                     for idx, img_data in enumerate(preview_images):
-                        img = decode_image(img_data)
-                        if img:
+                        thumb = load_thumbnail(img_data, blob_store, thumbnail_cache)
+                        if thumb:
                             with del_preview_cols[idx % 3]:
-                                st.image(img, caption=f"画像 {idx + 1}", width=150)
+                                st.image(thumb, caption=f"画像 {idx + 1}", width=150)
                 
                 col1, col2 = st.columns([1, 4])
                 with col1:
                     if st.button("🗑️ 削除", type="primary"):
                         del st.session_state.encyclopedia[article_to_delete]
-                        save_user_encyclopedia(st.session_state.username, st.session_state.encyclopedia)
+                        save_articles()
                         st.success(f"記事「{article_to_delete}」を削除しました")
                         st.rerun()
                 with col2:
@@ -514,53 +588,169 @@ else:
         else:
             st.info("削除する記事がありません")
     
+    elif menu == "📦 インポート/エクスポート":
+        st.header("インポート/エクスポート")
+        
+        st.subheader("📤 エクスポート")
+        export_format = st.radio("形式", ["ZIP（画像は別ファイル）", "JSON Lines（画像はBase64で埋め込み）"])
+        if st.button("書き出しを作成"):
+            # 保存待ちの変更も含めて書き出す
+            flush(st.session_state.username)
+            is_zip = export_format.startswith("ZIP")
+            export = export_zip if is_zip else export_jsonl
+            file_name = f"{st.session_state.username}.{'zip' if is_zip else 'jsonl'}"
+            # 作成中のアーカイブは一時ファイルに書き込んでいくが、st.download_buttonは
+            # ファイルの内容をすべて読み込んで送るので、MAX_DOWNLOAD_BYTESまでの書き出しだけを画面から渡す
+            with tempfile.TemporaryDirectory() as export_dir:
+                export_path = os.path.join(export_dir, file_name)
+                with open(export_path, "wb") as archive_file:
+                    count = export(st.session_state.username, archive_file, progress=progress_callback("書き出し中"))
+                size = os.path.getsize(export_path)
+                st.caption(f"ファイルサイズ: {size / 1024 / 1024:,.1f} MB")
+                if size > MAX_DOWNLOAD_BYTES:
+                    st.warning(f"{MAX_DOWNLOAD_BYTES // 1024 // 1024} MBを超える書き出しは画面からダウンロードできません。"
+                               "サーバーで次のコマンドを実行して、ファイルに直接書き出してください。")
+                    st.code(f"python transfer.py export {st.session_state.username} {file_name}", language="bash")
+                else:
+                    with open(export_path, "rb") as archive_file:
+                        st.download_button(f"📥 ダウンロード（{count:,}件）", archive_file, file_name=file_name,
+                                           mime="application/zip" if is_zip else "application/x-ndjson",
+                                           on_click="ignore")
+        
+        st.markdown("---")
+        st.subheader("📥 インポート")
+        uploaded_archive = st.file_uploader("ZIPまたはJSON Linesのファイル", type=["zip", "jsonl"])
+        overwrite = st.checkbox("同じタイトルの記事を上書きする", value=True)
+        if uploaded_archive and st.button("取り込む", type="primary"):
+            flush(st.session_state.username)
+            try:
+                summary = import_archive(st.session_state.username, uploaded_archive, overwrite,
+                                         progress=progress_callback("取り込み中"))
+            except (ValueError, OSError) as e:
+                st.error(f"ファイルを読み込めませんでした: {e}")
+            else:
+                st.session_state.encyclopedia = get_user_encyclopedia(st.session_state.username)
+                st.success(f"{summary['imported']:,}件の記事と{summary['images']:,}枚の画像を取り込みました"
+                           + (f"（{summary['skipped']:,}件はスキップ）" if summary["skipped"] else ""))
+                if summary["errors"]:
+                    with st.expander(f"⚠️ {summary['error_count']:,}件の問題"):
+                        st.write("\n".join(f"- {error}" for error in summary["errors"]))
+    
     elif menu == "📊 統計情報":
         st.header("統計情報")
         
         if st.session_state.encyclopedia:
+            # 保存のたびに差分で更新している集計を使う（記事を1件ずつ読み直さない）
+            stats = get_article_stats(st.session_state.username)
             col1, col2, col3, col4 = st.columns(4)
             
             with col1:
                 st.metric("📚 総記事数", len(st.session_state.encyclopedia))
             
             with col2:
-                all_categories = set()
-                for article in st.session_state.encyclopedia.values():
-                    cats = article.get("category", ["未分類"])
-                    if isinstance(cats, list):
-                        all_categories.update(cats)
-                    else:
-                        all_categories.add(cats)
-                st.metric("🏷️ カテゴリー数", len(all_categories))
+                st.metric("🏷️ カテゴリー数", len(st.session_state.encyclopedia.categories))
             
             with col3:
-                total_chars = sum(len(v.get("content", "")) for v in st.session_state.encyclopedia.values())
-                st.metric("✍️ 総文字数", f"{total_chars:,}")
+                st.metric("✍️ 総文字数", f"{stats.totals['chars']:,}")
             
             with col4:
-                # 画像付き記事数と総画像数を計算
-                articles_with_images = sum(1 for v in st.session_state.encyclopedia.values() if v.get("images"))
-                total_images = sum(len(v.get("images", [])) for v in st.session_state.encyclopedia.values())
-                st.metric("🖼️ 総画像数", total_images)
-                st.caption(f"画像付き記事: {articles_with_images}件")
+                st.metric("🖼️ 総画像数", stats.totals["images"])
+                st.caption(f"画像付き記事: {stats.totals['with_images']}件・"
+                           f"合計 {stats.totals['image_bytes'] / 1024 / 1024:,.1f} MB")
             
             st.markdown("---")
             st.subheader("カテゴリー別記事数")
             
-            category_count = {}
-            for article in st.session_state.encyclopedia.values():
-                cats = article.get("category", ["未分類"])
-                if isinstance(cats, list):
-                    for cat in cats:
-                        category_count[cat] = category_count.get(cat, 0) + 1
-                else:
-                    category_count[cats] = category_count.get(cats, 0) + 1
-            
-            for cat, count in sorted(category_count.items(), key=lambda x: x[1], reverse=True):
+            for cat, count in st.session_state.encyclopedia.categories.counts():
                 st.write(f"**{cat}**: {count}件")
+            
+            st.markdown("---")
+            st.subheader("記事の文字数の分布")
+            starts, counts = stats.length_histogram()
+            st.bar_chart(pd.DataFrame({"文字数": [f"{start:,}文字〜" for start in starts], "記事数": counts}),
+                         x="文字数", y="記事数", sort=False)
+            
+            st.subheader("記事数の推移（月ごと）")
+            over_time = stats.articles_over_time()
+            if len(over_time):
+                st.line_chart(over_time.rename(columns={"created": "作成", "updated": "最終更新", "total": "累計"}))
+            else:
+                st.info("作成日時のわかる記事がありません")
+            
+            st.subheader("カテゴリーの組み合わせ（記事数の多い10カテゴリー）")
+            st.caption("同じ記事に両方のカテゴリーが付いている記事数（対角は各カテゴリーの記事数）")
+            st.dataframe(stats.category_cooccurrence(10))
+            
+            st.subheader("カテゴリー別の文字数と画像サイズ")
+            totals = stats.category_totals(20)
+            totals["image_bytes"] = (totals["image_bytes"] / 1024 / 1024).round(2)
+            st.dataframe(totals.rename(columns={"articles": "記事数", "chars": "総文字数", "image_bytes": "画像 (MB)"}))
+            
+            st.markdown("---")
+            st.subheader("記事間のリンク")
+            link_graph = get_link_graph(st.session_state.username)
+            orphans = link_graph.orphans()
+            dead_ends = link_graph.dead_ends()
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric("🏝️ どこからも言及されていない記事", len(orphans))
+                if orphans:
+                    with st.expander("一覧を表示"):
+                        st.write("、".join(orphans))
+            with col2:
+                st.metric("🚧 他の記事に言及していない記事", len(dead_ends))
+                if dead_ends:
+                    with st.expander("一覧を表示"):
+                        st.write("、".join(dead_ends))
         else:
             st.info("まだ記事がありません")
     
+    elif menu == "⏱️ パフォーマンス":
+        st.header("パフォーマンス")
+        
+        enabled = st.toggle("計測を有効にする", value=perf.enabled())
+        if enabled != perf.enabled():
+            perf.set_enabled(enabled)
+            st.rerun()
+        if not perf.enabled():
+            st.info("計測は無効です（環境変数 ENCYCLOPEDIA_PERF=1 でも有効にできます）")
+        
+        reruns = perf.recent_reruns()
+        if reruns:
+            st.subheader("直前の再実行")
+            last = reruns[0]
+            st.caption(f"{last['started']}　{last['label']}　合計 {last['total_ms']:.1f} ms")
+            st.dataframe([{"name": name, **timing} for name, timing in
+                          sorted(last["timings"].items(), key=lambda item: item[1]["total_ms"], reverse=True)],
+                         width="stretch")
+            with st.expander(f"最近の再実行（{len(reruns)}件）"):
+                st.dataframe([{"started": r["started"], "label": r["label"], "total_ms": r["total_ms"],
+                               "interrupted": r["interrupted"]} for r in reruns], width="stretch")
+        
+        st.subheader("処理ごとの合計（プロセス全体）")
+        stats = perf.stats()
+        if stats:
+            st.dataframe(stats, width="stretch")
+        else:
+            st.info("まだ計測結果がありません")
+        
+        counters = perf.counters()
+        if counters:
+            st.subheader("キャッシュなどの回数")
+            st.dataframe([{"name": name, "count": value} for name, value in sorted(counters.items())],
+                         width="stretch")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button("📥 JSON Linesで書き出す", perf.export_jsonl(), file_name="perf.jsonl",
+                               mime="application/x-ndjson")
+        with col2:
+            if st.button("🧹 計測結果をリセット"):
+                perf.reset()
+                st.rerun()
+    
     # フッター
     st.markdown("---")
-    st.markdown("💡 **ヒント**: サイドバーから機能を選択して、あなただけの百科事典を作りましょう！")
\ No newline at end of file
+    st.markdown("💡 **ヒント**: サイドバーから機能を選択して、あなただけの百科事典を作りましょう！")
+
+perf.end_rerun(st.session_state.perf_session)
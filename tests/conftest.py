@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+from bodystore import BodyStore  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    """テストごとに空のデータディレクトリで動かし、プロセス内のキャッシュも空にする"""
+    monkeypatch.chdir(tmp_path)
+    storage._shared.clear()
+    storage._derived.clear()
+    storage._histories.clear()
+    storage._user_locks.clear()
+    BodyStore._memory.clear()
+    yield tmp_path
+    storage._shared.clear()
+    storage._derived.clear()
+    storage._histories.clear()
+    storage._user_locks.clear()
+    BodyStore._memory.clear()
+
+
+@pytest.fixture
+def user():
+    storage.create_user("alice", "hash", "2026-01-01 00:00:00")
+    return "alice"
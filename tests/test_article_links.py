@@ -0,0 +1,58 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import article_links
+from article_links import TitleMatcher, get_title_matcher, link_article
+
+
+def test_matcher_cache_from_many_threads(monkeypatch):
+    monkeypatch.setattr(article_links, "_MATCHER_CACHE_SIZE", 4)
+    title_sets = [[f"記事{i}", f"記事{i}{j}"] for i in range(12) for j in range(3)]
+    with ThreadPoolExecutor(8) as executor:
+        matchers = list(executor.map(get_title_matcher, title_sets * 20))
+
+    assert all(matcher.titles == frozenset(titles) for matcher, titles in zip(matchers, title_sets * 20))
+    assert len(article_links._matcher_cache) <= 4
+
+
+def brute_force_find(text, titles, exclude=None):
+    """各位置で最長のタイトルを探し、見つかったらその後ろから続ける"""
+    matches, i = [], 0
+    while i < len(text):
+        found = max((t for t in titles if t and t != exclude and text.startswith(t, i)), key=len, default=None)
+        if found:
+            matches.append((i, i + len(found), found))
+            i += len(found)
+        else:
+            i += 1
+    return matches
+
+
+def test_find_prefers_leftmost_longest_without_nesting():
+    matcher = TitleMatcher(["東京", "東京都", "京都", "都庁"])
+
+    # 「東京都」の中の「東京」「京都」や、重なる「都庁」は見つけない
+    assert matcher.find("東京都庁と京都") == [(0, 3, "東京都"), (5, 7, "京都")]
+    assert matcher.find("東京タワー") == [(0, 2, "東京")]
+
+
+def test_find_excludes_current_title():
+    matcher = TitleMatcher(["東京", "東京都"])
+
+    assert matcher.find("東京都の東京", exclude="東京都") == [(0, 2, "東京"), (4, 6, "東京")]
+
+
+def test_find_matches_brute_force():
+    rng = random.Random(0)
+    for _ in range(200):
+        titles = ["".join(rng.choices("abc", k=rng.randint(1, 4))) for _ in range(rng.randint(1, 6))]
+        text = "".join(rng.choices("abcd", k=30))
+        exclude = rng.choice(titles + [None])
+        assert TitleMatcher(titles).find(text, exclude) == brute_force_find(text, titles, exclude)
+
+
+def test_link_article_highlights_titles_and_keeps_line_breaks():
+    linked, mentioned = link_article("東京都と大阪\n大阪と東京都", ["東京都", "大阪", "記事"], "記事")
+
+    assert linked == "**東京都**と**大阪**  \n**大阪**と**東京都**"
+    assert mentioned == ["東京都", "大阪"]
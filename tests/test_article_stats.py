@@ -0,0 +1,64 @@
+import numpy as np
+
+from article_stats import ArticleStats
+
+
+def article(length, categories, created, updated=None):
+    result = {"category": categories, "content": "あ" * length, "images": [], "created": created}
+    if updated:
+        result["updated"] = updated
+    return result
+
+
+ARTICLES = {
+    "A": article(0, ["地理", "歴史"], "2026-01-05 10:00:00", "2026-03-10 09:00:00"),
+    "B": article(3, ["地理"], "2026-01-20 12:00:00"),
+    "C": article(5, ["歴史", "人物"], "2026-03-01 08:00:00"),
+    "D": article(50, ["地理", "歴史"], "2026-03-15 18:00:00"),
+    "E": article(500, [], ""),
+}
+
+
+def test_length_histogram_uses_log_bins():
+    stats = ArticleStats.build(ARTICLES)
+
+    # 区間は [0, 1), [1, 7), [7, 63), [63, 501]（geomspace(1, 501, 4)を整数にしたもの）
+    starts, counts = stats.length_histogram(bins=3)
+    assert starts.tolist() == [0, 1, 7, 63]
+    assert counts.tolist() == [1, 2, 1, 1]
+    empty = ArticleStats.build({}).length_histogram()
+    assert len(empty[0]) == 0 and len(empty[1]) == 0
+
+
+def test_articles_over_time_counts_each_month():
+    stats = ArticleStats.build(ARTICLES)
+    frame = stats.articles_over_time()
+
+    # 記事のない2月も0件として並び、日時のない記事は数えない
+    assert [str(period)[:7] for period in frame.index] == ["2026-01", "2026-02", "2026-03"]
+    assert frame["created"].tolist() == [2, 0, 2]
+    # 更新日時のない記事は作成日時を更新日時として数える
+    assert frame["updated"].tolist() == [1, 0, 3]
+    assert frame["total"].tolist() == [2, 2, 4]
+
+
+def test_category_cooccurrence_counts_pairs():
+    stats = ArticleStats.build(ARTICLES)
+    matrix = stats.category_cooccurrence()
+
+    assert list(matrix.index) == ["地理", "歴史", "人物", "未分類"]
+    assert matrix.to_numpy().tolist() == [
+        [3, 2, 0, 0],
+        [2, 3, 1, 0],
+        [0, 1, 1, 0],
+        [0, 0, 0, 1],
+    ]
+    assert stats.category_cooccurrence(top=2).to_numpy().tolist() == [[3, 2], [2, 3]]
+
+    # 記事を書き換えると、古いカテゴリーの組は数えない
+    stats.apply_changes({"D": article(50, ["人物"], "2026-03-15 18:00:00")}, {"A"})
+    matrix = stats.category_cooccurrence()
+    assert list(matrix.index) == ["人物", "地理", "歴史", "未分類"]
+    assert np.diag(matrix.to_numpy()).tolist() == [2, 1, 1, 1]
+    assert matrix.loc["歴史", "人物"] == 1 and matrix.loc["地理", "歴史"] == 0
+    assert stats.totals == {"articles": 4, "chars": 558, "images": 0, "with_images": 0, "image_bytes": 0}
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+import codec
+
+DATA = {"version": 3, "articles": {"東京": {"category": ["地理"], "content": "首都" * 200, "images": []}},
+        "offsets": [0, 1, 2 ** 31]}
+
+
+def test_dumps_and_loads_round_trip():
+    data = codec.dumps(DATA)
+
+    assert data.startswith(codec.MAGIC)
+    assert data[len(codec.MAGIC)] == codec.FORMAT_VERSION
+    assert codec.loads(data) == DATA
+
+
+def test_falls_back_to_zlib_without_zstandard(monkeypatch):
+    zstd_data = codec.dumps(DATA)
+    monkeypatch.setattr(codec, "zstandard", None)
+    data = codec.dumps(DATA)
+
+    assert data[len(codec.MAGIC) + 1] == codec.COMPRESS_ZLIB
+    assert codec.loads(data) == DATA
+    # zstdで保存済みのデータは、zstandardがなければ読み込めないことを伝える
+    with pytest.raises(ValueError):
+        codec.loads(zstd_data)
+
+
+def test_load_file_reads_legacy_json(tmp_path):
+    path = tmp_path / "snapshot.json"
+    path.write_text(json.dumps(DATA, ensure_ascii=False), encoding="utf-8")
+
+    assert codec.load_file(str(path)) == DATA
+
+
+def test_json_format_is_written_when_binary_is_disabled(monkeypatch):
+    monkeypatch.setattr(codec, "STORAGE_FORMAT", "json")
+    data = codec.dumps(DATA)
+
+    assert json.loads(data) == DATA
+    assert codec.loads(data) == DATA
+
+
+def test_records_compress_long_content_only():
+    long_body = {"content": "本文" * 500, "created": "2026-01-01 00:00:00"}
+    short_body = {"content": "短い本文"}
+
+    assert codec.load_record(codec.dump_record(long_body)) == long_body
+    assert len(codec.dump_record(long_body)) < len(long_body["content"].encode("utf-8"))
+    assert codec.load_record(codec.dump_record(short_body)) == short_body
+    assert codec.load_record(b'{"content": "JSON\\u306e\\u884c"}') == {"content": "JSONの行"}
+
+
+def test_pack_ints_round_trip_as_little_endian():
+    values = [0, 1, 255, 256, 2 ** 32 - 1]
+    packed = codec.pack_ints(values)
+
+    assert packed[:8] == b"\x00\x00\x00\x00\x01\x00\x00\x00"
+    assert list(codec.unpack_ints(packed)) == values
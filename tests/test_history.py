@@ -0,0 +1,123 @@
+import time
+
+import pytest
+
+import history
+import storage
+from history import RevisionHistory
+from storage import article_history, get_revision, get_user_encyclopedia, save_user_encyclopedia
+
+
+def article(content):
+    return {"category": ["未分類"], "content": content, "images": [], "created": "2026-01-01 00:00:00"}
+
+
+class Clock:
+    """historyモジュールが使う時刻を進められるようにする"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def localtime(self, seconds=None):
+        return time.localtime(self.now if seconds is None else seconds)
+
+    def strftime(self, fmt, value=None):
+        return time.strftime(fmt, value or self.localtime())
+
+
+def put(title, content):
+    return {"op": "put", "title": title, "article": article(content)}
+
+
+def record_versions(revisions, title, count, start=1):
+    """titleを版1, 2, ...と書き換えて、置き換えた版を記録する（今の版の内容を返す）"""
+    for version in range(start, start + count):
+        revisions.record(version, [put(title, f"版{version}\n")],
+                         lambda _: article(f"版{version - 1}\n"))
+    return article(f"版{start + count - 1}\n")
+
+
+def test_full_copy_is_saved_every_full_interval(tmp_path, monkeypatch):
+    monkeypatch.setattr(history, "FULL_INTERVAL", 3)
+    revisions = RevisionHistory(str(tmp_path))
+    current = record_versions(revisions, "A", 7)
+
+    kinds = [entry["kind"] for entry in reversed(revisions.revisions("A"))]
+    assert kinds == ["delta", "delta", "full", "delta", "delta", "full", "delta"]
+    # どの版も、直近の全体のコピーか今の記事から復元できる
+    for version in range(1, 8):
+        assert revisions.revision("A", version, current)["content"] == f"版{version - 1}\n"
+
+
+def test_compact_keeps_the_newest_revisions(tmp_path, monkeypatch):
+    monkeypatch.setattr(history, "FULL_INTERVAL", 3)
+    revisions = RevisionHistory(str(tmp_path))
+    current = record_versions(revisions, "A", 8)
+    record_versions(revisions, "B", 2, start=9)
+
+    assert revisions.compact(max_revisions=4, max_age_days=None)
+    assert [entry["version"] for entry in revisions.revisions("A")] == [8, 7, 6, 5]
+    assert [entry["version"] for entry in revisions.revisions("B")] == [10, 9]
+    for version in (5, 6, 7, 8):
+        assert revisions.revision("A", version, current)["content"] == f"版{version - 1}\n"
+    assert revisions.revision("A", 4, current) is None
+    # 捨てる版がなければ書き直さない
+    assert not revisions.compact(max_revisions=4, max_age_days=None)
+
+
+def test_compact_drops_revisions_older_than_max_age(tmp_path, monkeypatch):
+    clock = Clock(time.time() - 10 * 86400)
+    monkeypatch.setattr(history, "time", clock)
+    revisions = RevisionHistory(str(tmp_path))
+    record_versions(revisions, "A", 2)
+    clock.now += 8 * 86400
+    current = record_versions(revisions, "A", 2, start=3)
+
+    assert revisions.compact(max_revisions=None, max_age_days=5)
+    assert [entry["version"] for entry in revisions.revisions("A")] == [4, 3]
+    assert revisions.revision("A", 3, current)["content"] == "版2\n"
+    # ファイルを読み直しても同じ版が残っている
+    assert [entry["version"] for entry in RevisionHistory(str(tmp_path)).revisions("A")] == [4, 3]
+
+
+def test_renamed_article_carries_its_history(tmp_path):
+    revisions = RevisionHistory(str(tmp_path))
+    record_versions(revisions, "A", 2)
+    revisions.record(3, [{"op": "rename", "from": "A", "to": "B", "article": article("新しい名前\n")}],
+                     lambda title: article("版2\n") if title == "A" else None)
+
+    assert revisions.revisions("A") == []
+    entries = revisions.revisions("B")
+    assert [entry["version"] for entry in entries] == [3, 2, 1]
+    assert entries[0]["renamed_from"] == "A"
+    assert revisions.revision("B", 1, article("新しい名前\n"))["content"] == "版0\n"
+
+
+def test_rename_chain_in_one_commit_is_saved_as_one_rename(user):
+    enc = get_user_encyclopedia(user)
+    enc["A"] = article("一版")
+    save_user_encyclopedia(user, enc)
+    enc.rename("A", "B", article("二版"))
+    enc.rename("B", "C", article("三版"))
+
+    ops = enc.pop_changes()
+    assert [(op["op"], op.get("from"), op.get("to", op.get("title"))) for op in ops] == [
+        ("rename", "A", "C"), ("delete", None, "B")]
+    assert storage.commit_changes(user, enc, ops).status == "saved"
+    revision, = article_history(user, "C")
+    assert revision["renamed_from"] == "A" and revision["kind"] == "delta"
+    assert get_revision(user, "C", revision["version"])["content"] == "一版"
+    assert article_history(user, "A") == [] and article_history(user, "B") == []
+
+
+def test_rename_onto_existing_title_is_rejected(user):
+    enc = get_user_encyclopedia(user)
+    enc["A"] = article("a")
+    enc["B"] = article("b")
+
+    with pytest.raises(ValueError):
+        enc.rename("A", "B", article("a2"))
+    assert enc["B"]["content"] == "b" and "A" in enc
@@ -0,0 +1,133 @@
+import base64
+import os
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image
+
+import storage
+from blobstore import BlobStore, ThumbnailCache
+from images import backfill_thumbnails, decode_image, encode_images, load_thumbnail, make_thumbnail
+
+
+def test_decode_blob_smaller_than_2kb(tmp_path):
+    # 単色の画像はWebPにすると2KBに満たない（PCDの判定が2048バイト目へseekする）
+    buffer = BytesIO()
+    Image.new("RGB", (1200, 900), (200, 30, 30)).save(buffer, format="WEBP")
+    data = buffer.getvalue()
+    assert len(data) < 2048
+    store = BlobStore(str(tmp_path / "blobs"))
+    ref = store.put(data)
+
+    img = decode_image(ref, store)
+
+    assert img.size == (1200, 900)
+    assert img.getpixel((0, 0))[0] > 150
+
+
+def test_identical_uploads_are_stored_once(tmp_path):
+    buffer = BytesIO()
+    Image.new("RGB", (40, 30), (0, 120, 200)).save(buffer, format="PNG")
+    store = BlobStore(str(tmp_path / "blobs"))
+
+    refs = encode_images([BytesIO(buffer.getvalue()), BytesIO(buffer.getvalue())], store)
+
+    assert refs[0] == refs[1]
+    assert list(store.refs()) == [refs[0]]
+
+
+def png_bytes(size=(40, 30), mode="RGB", color=(0, 120, 200)):
+    buffer = BytesIO()
+    Image.new(mode, size, color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_make_thumbnail_fits_and_fills_transparency():
+    img = Image.new("RGBA", (1200, 600), (0, 0, 0, 0))
+
+    thumb = Image.open(BytesIO(make_thumbnail(img)))
+
+    assert thumb.format == "JPEG"
+    assert thumb.size == (300, 150)
+    assert thumb.getpixel((0, 0)) == (255, 255, 255)
+
+
+def test_load_thumbnail_creates_and_caches(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"))
+    thumbnails = ThumbnailCache(str(tmp_path / "thumbs"))
+    ref = store.put(png_bytes((900, 600)))
+
+    data = load_thumbnail(ref, store, thumbnails)
+
+    assert thumbnails.exists(ref)
+    assert Image.open(BytesIO(data)).size == (300, 200)
+    assert load_thumbnail(ref, store, thumbnails) == data
+    # 旧形式のBase64画像はサムネイルを作るだけで保存しない
+    legacy = base64.b64encode(png_bytes()).decode("ascii")
+    assert Image.open(BytesIO(load_thumbnail(legacy, store, thumbnails))).size == (40, 30)
+    assert load_thumbnail("0" * 64, store, thumbnails) is None
+
+
+def test_backfill_thumbnails_creates_missing_only(user):
+    store = storage.get_blob_store(user)
+    thumbnails = storage.get_thumbnail_cache(user)
+    first, second = store.put(png_bytes()), store.put(png_bytes(color=(200, 0, 0)))
+    thumbnails.put(first, b"existing")
+    enc = storage.get_user_encyclopedia(user)
+    enc["A"] = {"category": ["a"], "content": "a", "images": [first, second], "created": "2026-01-01 00:00:00"}
+    storage.save_user_encyclopedia(user, enc)
+
+    assert backfill_thumbnails([user]) == 1
+    assert thumbnails.exists(second)
+    assert backfill_thumbnails() == 0
+
+
+def test_thumbnail_cache_keeps_recent_items_in_memory(tmp_path, monkeypatch):
+    monkeypatch.setattr(ThumbnailCache, "_memory", OrderedDict())
+    monkeypatch.setattr(ThumbnailCache, "max_memory_items", 2)
+    thumbnails = ThumbnailCache(str(tmp_path / "thumbs"))
+    refs = ["a" * 64, "b" * 64, "c" * 64]
+    for ref in refs:
+        thumbnails.put(ref, ref.encode())
+
+    assert list(ThumbnailCache._memory) == [thumbnails.path(ref) for ref in refs[1:]]
+    # メモリから追い出されたサムネイルはディスクから読み込み、最近使ったものとして残す
+    assert thumbnails.get(refs[0]) == refs[0].encode()
+    assert list(ThumbnailCache._memory) == [thumbnails.path(refs[2]), thumbnails.path(refs[0])]
+    assert thumbnails.get("d" * 64) is None
+
+
+def test_thumbnail_cache_gc_removes_unreferenced_old_thumbnails(tmp_path):
+    thumbnails = ThumbnailCache(str(tmp_path / "thumbs"))
+    live, old, recent = "a" * 64, "b" * 64, "c" * 64
+    for ref in (live, old, recent):
+        thumbnails.put(ref, b"jpeg")
+    for ref in (live, old):
+        os.utime(thumbnails.path(ref), (0, 0))
+
+    assert thumbnails.gc({live}) == 1
+    assert [thumbnails.exists(ref) for ref in (live, old, recent)] == [True, False, True]
+
+
+def animated_gif(size):
+    frames = [Image.new("RGB", size, color) for color in ((255, 0, 0), (0, 255, 0), (0, 0, 255))]
+    buffer = BytesIO()
+    frames[0].save(buffer, format="GIF", save_all=True, append_images=frames[1:], duration=80, loop=0)
+    return buffer.getvalue()
+
+
+def test_animated_images_keep_all_frames(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"))
+    thumbnails = ThumbnailCache(str(tmp_path / "thumbnails"))
+    small, large = animated_gif((60, 40)), animated_gif((1000, 500))
+
+    small_ref, large_ref = encode_images([BytesIO(small), BytesIO(large)], store, thumbnails)
+
+    # 小さなGIFはそのまま保存し、大きなGIFは縮小したアニメーションのWebPにする
+    assert store.read(small_ref) == small
+    img = Image.open(BytesIO(store.read(large_ref)))
+    assert img.format == "WEBP" and img.size == (800, 400)
+    assert img.is_animated and img.n_frames == 3
+    # サムネイルは1コマ目から作る
+    thumb = Image.open(BytesIO(thumbnails.get(large_ref)))
+    assert thumb.getpixel((10, 10))[0] > 200
@@ -0,0 +1,166 @@
+import random
+
+import pytest
+
+import storage
+from categories import normalize_categories
+from storage import DERIVED_INDEXES, get_index, get_user_encyclopedia, save_user_encyclopedia
+
+WORDS = ["東京", "大阪", "京都", "電車", "歴史", "料理", "寺院", "港", "川", "山", "祭り", "城"]
+CATEGORIES = ["地理", "交通", "文化", "食べ物"]
+
+
+def random_article(rng, titles):
+    words = rng.choices(WORDS, k=rng.randint(3, 12))
+    # 他の記事のタイトルにも言及する（リンクのグラフ用）
+    words += rng.sample(titles, k=min(len(titles), rng.randint(0, 2)))
+    return {"category": rng.sample(CATEGORIES, k=rng.randint(1, 2)), "content": "、".join(words),
+            "images": [], "created": f"2026-0{rng.randint(1, 9)}-1{rng.randint(0, 9)} 00:00:00",
+            "updated": f"2026-10-1{rng.randint(0, 9)} 00:00:00"}
+
+
+def edit_randomly(user, seed):
+    """インデックスをメモリに読み込んだまま、追加・更新・削除・名前の変更を保存していく"""
+    rng = random.Random(seed)
+    for name in DERIVED_INDEXES:
+        get_index(user, name)
+    titles = []
+    for step in range(60):
+        enc = get_user_encyclopedia(user)
+        for _ in range(rng.randint(1, 4)):
+            action = rng.random()
+            if titles and action < 0.15:
+                title = rng.choice(titles)
+                del enc[title]
+                titles.remove(title)
+            elif titles and action < 0.25:
+                old = rng.choice(titles)
+                new = f"{old}改{step}"
+                if new not in enc:
+                    enc.rename(old, new, random_article(rng, titles))
+                    titles[titles.index(old)] = new
+            elif titles and action < 0.6:
+                enc[rng.choice(titles)] = random_article(rng, titles)
+            else:
+                title = f"{rng.choice(WORDS)}{step}{rng.randint(0, 9)}"
+                if title not in enc:
+                    titles.append(title)
+                enc[title] = random_article(rng, titles)
+        assert save_user_encyclopedia(user, enc).status in ("saved", "merged")
+    return titles
+
+
+def rebuilt(user, name):
+    version, articles = storage._load_state(user)
+    index = DERIVED_INDEXES[name][0].build(articles, storage._IndexContext(user, articles.get))
+    index.version = version
+    return index
+
+
+def rounded(results):
+    return sorted((title, round(score, 5)) for title, score in results)
+
+
+@pytest.mark.parametrize("seed", [1, 2])
+def test_incremental_indexes_match_full_rebuild(user, seed):
+    titles = edit_randomly(user, seed)
+    version = storage.current_version(user)
+
+    search, full_search = get_index(user, "search"), rebuilt(user, "search")
+    assert search.version == version
+    for word in WORDS + titles[:5]:
+        assert rounded(search.search(word)) == rounded(full_search.search(word))
+
+    links, full_links = get_index(user, "links"), rebuilt(user, "links")
+    for title in titles:
+        assert links.links(title) == full_links.links(title)
+        assert links.backlinks(title) == full_links.backlinks(title)
+    assert links.orphans() == full_links.orphans()
+
+    suggester, full_suggester = get_index(user, "titles"), rebuilt(user, "titles")
+    for query in WORDS + [title[:2] for title in titles[:5]]:
+        assert suggester.suggest(query, 20) == full_suggester.suggest(query, 20)
+
+    stats, full_stats = get_index(user, "stats"), rebuilt(user, "stats")
+    frame = stats.frame().sort_values("title").reset_index(drop=True)
+    full_frame = full_stats.frame().sort_values("title").reset_index(drop=True)
+    assert frame.equals(full_frame)
+    assert stats.category_totals().sort_index().equals(full_stats.category_totals().sort_index())
+
+    # 関連記事は語の重みを一括計算の時点のまま使うので、差分で更新した一覧は類似度を比べずに形だけ確かめる
+    # （全体の計算と近いことはtest_related_articlesで確かめる）
+    related, full_related = get_index(user, "related"), rebuilt(user, "related")
+    for title in titles:
+        neighbours = related.related(title, 5)
+        assert all(other in titles and other != title for other, _ in neighbours)
+        assert [score for _, score in neighbours] == sorted((score for _, score in neighbours), reverse=True)
+    # 差分で持っている出現回数から計算し直すと、全体を計算し直した結果と一致する
+    related.rebuild()
+    for title in titles:
+        assert [round(score, 5) for _, score in related.related(title, 5)] == \
+            [round(score, 5) for _, score in full_related.related(title, 5)]
+
+
+def test_indexes_reloaded_from_disk_catch_up_from_log(user):
+    titles = edit_randomly(user, 3)
+    storage.compact(user)
+    enc = get_user_encyclopedia(user)
+    enc[titles[0]] = {"category": ["地理"], "content": "新しい本文 富士山", "images": []}
+    save_user_encyclopedia(user, enc)
+
+    # 保存済みのファイルを読み込み、コンパクション後のログから追いつく
+    storage._derived.clear()
+    assert [title for title, _ in storage.search_articles(user, "富士山")] == [titles[0]]
+    assert get_index(user, "links").version == storage.current_version(user)
+
+
+def counted_categories(articles):
+    titles = {}
+    for title, article in articles.items():
+        for category in normalize_categories(article.get("category")):
+            titles.setdefault(category, set()).add(title)
+    return titles
+
+
+def assert_categories_match(categories, articles):
+    expected = counted_categories(articles)
+    assert categories.names() == sorted(expected)
+    assert dict(categories.counts()) == {category: len(titles) for category, titles in expected.items()}
+    for category in CATEGORIES + ["未分類"]:
+        assert categories.titles(category) == expected.get(category, set())
+        assert list(categories.sorted_titles(category)) == sorted(expected.get(category, ()))
+
+
+def test_category_index_matches_recount_after_edits(user, monkeypatch):
+    # 共有の索引に重ねた変更を、途中で何度かまとめ直す
+    monkeypatch.setattr(storage, "SHARED_FLATTEN_MIN", 4)
+    rng = random.Random(4)
+    titles = []
+    for step in range(40):
+        enc = get_user_encyclopedia(user)
+        action = rng.random()
+        if titles and action < 0.2:
+            title = rng.choice(titles)
+            del enc[title]
+            titles.remove(title)
+        elif titles and action < 0.4:
+            old = rng.choice(titles)
+            new = f"{old}改{step}"
+            enc.rename(old, new, random_article(rng, titles))
+            titles[titles.index(old)] = new
+        elif titles and action < 0.7:
+            article = random_article(rng, titles)
+            # カテゴリーなしの記事は未分類として数える
+            enc[rng.choice(titles)] = dict(article, category=[]) if action < 0.5 else article
+        else:
+            title = f"記事{step}"
+            titles.append(title)
+            enc[title] = random_article(rng, titles)
+        # 保存前のセッションの索引と、保存後の共有の索引
+        assert_categories_match(enc.categories, dict(enc.items()))
+        save_user_encyclopedia(user, enc)
+        assert_categories_match(enc.categories, dict(enc.items()))
+        assert_categories_match(get_user_encyclopedia(user).categories, dict(enc.items()))
+
+    storage._shared.clear()
+    assert_categories_match(get_user_encyclopedia(user).categories, dict(enc.items()))
@@ -0,0 +1,98 @@
+import json
+
+import pytest
+
+import perf
+
+
+@pytest.fixture(autouse=True)
+def clean_perf():
+    enabled = perf.enabled()
+    perf.reset()
+    yield
+    perf.set_enabled(enabled)
+    perf.reset()
+
+
+@perf.timed("test.work")
+def work(value):
+    return value * 2
+
+
+def test_disabled_instrumentation_records_nothing():
+    perf.set_enabled(False)
+    perf.start_rerun("session")
+    assert work(2) == 4
+    with perf.span("test.span") as span:
+        pass
+    perf.count("test.hit")
+    perf.phase("render.page")
+    perf.end_rerun("session")
+
+    assert span is perf._NULL_SPAN
+    assert perf.stats() == [] and perf.counters() == {} and perf.recent_reruns() == []
+
+
+def test_enabled_instrumentation_records_rerun_phases():
+    perf.set_enabled(True)
+    perf.start_rerun("session", "記事を検索")
+    perf.phase("render.header")
+    assert work(2) == 4
+    with perf.span("test.span"):
+        pass
+    perf.count("test.hit", 3)
+    perf.phase("render.body")
+    perf.end_rerun("session")
+
+    rerun, = perf.recent_reruns()
+    assert rerun["label"] == "記事を検索" and not rerun["interrupted"]
+    assert set(rerun["timings"]) == {"render.header", "render.body", "test.work", "test.span"}
+    assert rerun["timings"]["test.work"]["calls"] == 1
+    assert rerun["counters"] == {"test.hit": 3}
+    assert {stat["name"] for stat in perf.stats()} == set(rerun["timings"])
+
+
+def test_unfinished_rerun_is_closed_as_interrupted():
+    perf.set_enabled(True)
+    perf.start_rerun("session", "1回目")
+    work(1)
+    # st.rerun()で最後まで実行されなかった場合は、次の再実行の開始で区切る
+    perf.start_rerun("session", "2回目")
+    perf.end_rerun("session")
+
+    second, first = perf.recent_reruns()
+    assert first["label"] == "1回目" and first["interrupted"]
+    assert second["label"] == "2回目" and not second["interrupted"]
+
+
+def test_interrupted_rerun_after_phase_has_no_negative_time():
+    perf.set_enabled(True)
+    perf.start_rerun("session", "1回目")
+    work(1)
+    perf.phase("render.page")
+    # 区間を始めた後に計測のある処理がないまま中断された
+    perf.start_rerun("session", "2回目")
+    perf.end_rerun("session")
+
+    _, first = perf.recent_reruns()
+    assert first["interrupted"]
+    assert first["timings"]["render.page"]["total_ms"] >= 0
+    assert first["total_ms"] >= first["timings"]["test.work"]["total_ms"]
+
+
+def test_export_jsonl_has_reruns_then_totals():
+    perf.set_enabled(True)
+    for label in ("1回目", "2回目"):
+        perf.start_rerun("session", label)
+        work(1)
+        perf.count("test.hit")
+        perf.end_rerun("session")
+
+    records = [json.loads(line) for line in perf.export_jsonl().splitlines()]
+
+    assert [record["type"] for record in records] == ["rerun", "rerun", "totals"]
+    assert [record["label"] for record in records[:2]] == ["2回目", "1回目"]
+    assert records[2]["counters"] == {"test.hit": 2}
+    stat, = records[2]["stats"]
+    assert stat["name"] == "test.work" and stat["calls"] == 2
+    assert set(stat) == {"name", "calls", "total_ms", "mean_ms", "max_ms"}
@@ -0,0 +1,78 @@
+import random
+
+import related_articles
+from related_articles import NEIGHBOURS, RelatedArticles
+
+WORDS = ["東京", "大阪", "京都", "電車", "歴史", "料理", "寺院", "港", "川", "山", "祭り", "城"]
+
+
+def corpus(seed, count):
+    rng = random.Random(seed)
+    return {f"記事{seed}-{i}": {"category": ["未分類"], "content": "、".join(rng.choices(WORDS, k=8)), "images": []}
+            for i in range(count)}
+
+
+# 語の重みに差がつくよう、出現しやすさに偏りのある語彙から本文を作る
+VOCABULARY = [f"w{i}" for i in range(400)]
+FREQUENCIES = [1 / (i + 1) for i in range(len(VOCABULARY))]
+
+
+def vocabulary_article(rng):
+    return {"category": ["未分類"], "content": " ".join(rng.choices(VOCABULARY, FREQUENCIES, k=30)), "images": []}
+
+
+def scores(index, titles):
+    return {title: [round(score, 4) for _, score in index.related(title, 5)] for title in titles}
+
+
+def test_large_change_is_applied_in_batch(monkeypatch):
+    monkeypatch.setattr(related_articles, "APPLY_REBUILD_ROWS", 10)
+    old, new = corpus(1, 8), corpus(2, 30)
+    index = RelatedArticles.build(old)
+    calls = []
+    rebuild = RelatedArticles.rebuild
+    monkeypatch.setattr(RelatedArticles, "rebuild", lambda self: calls.append(1) or rebuild(self))
+
+    # 少ない変更は1件ずつ、多い変更は一括で計算し直す
+    index.apply_changes(dict(list(new.items())[:5]), {"記事1-0"})
+    assert calls == []
+    index.apply_changes(new, set(old))
+    assert calls == [1]
+    assert scores(index, new) == scores(RelatedArticles.build(new), new)
+    assert index.related("記事1-1") == []
+
+
+def test_incremental_changes_stay_close_to_full_build():
+    rng = random.Random(3)
+    articles = {f"a{i}": vocabulary_article(rng) for i in range(300)}
+    index = RelatedArticles.build(articles)
+    for step in range(40):
+        action = rng.random()
+        title = rng.choice(sorted(articles))
+        if action < 0.3:
+            del articles[title]
+            index.apply_changes({}, {title})
+            continue
+        if action < 0.6:
+            title = f"new{step}"
+        articles[title] = vocabulary_article(rng)
+        index.apply_changes({title: articles[title]}, set())
+
+    # 語の重みは一括計算の時点のまま使うので、全体を計算し直した索引とは許容範囲内で比べる
+    full = RelatedArticles.build(articles)
+    vectors = full.columns.tocsr()
+
+    def similarity(a, b):
+        return float(vectors[full.rows[a]].multiply(vectors[full.rows[b]]).sum())
+
+    for title in articles:
+        related, expected = index.related(title, NEIGHBOURS), full.related(title, NEIGHBOURS)
+        # 取り除かれた記事の後には次の候補が入り、一覧が短くならない
+        assert len(related) >= len(expected)
+        assert [score for _, score in related] == sorted((score for _, score in related), reverse=True)
+        for other, score in related:
+            assert other in articles and other != title
+            assert abs(score - similarity(title, other)) < 0.1
+        if len(expected) >= 5:
+            # 上位の記事は、全体を計算し直したときの上位5件と同じくらい似ている
+            assert all(similarity(title, other) > expected[4][1] - 0.1 for other, _ in related[:5])
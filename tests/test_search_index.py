@@ -0,0 +1,94 @@
+import json
+import random
+
+import codec
+import search_index
+from search_index import SearchIndex, tokenize
+
+
+def article(content):
+    return {"category": ["未分類"], "content": content, "images": []}
+
+
+def test_tokenize_splits_japanese_into_bigrams_and_words():
+    assert tokenize("東京タワーとPython3") == ["東京", "京タ", "タワ", "ワー", "ーと", "python3"]
+    # 全角・半角をそろえて小文字にし、1文字の日本語はそのまま残す
+    assert tokenize("ＰＹＴＨＯＮ ｶﾀｶﾅ 山") == ["python", "カタ", "タカ", "カナ", "山"]
+    assert tokenize("、。!?") == []
+
+
+def test_bm25_ranking():
+    index = SearchIndex.build({
+        "多い": article("りんご りんご りんご みかん"),
+        "少ない": article("りんご みかん ぶどう もも なし"),
+        "長い": article("りんご " + "みかん " * 40),
+        "なし": article("みかん ぶどう"),
+        "りんご": article("果物"),
+    })
+
+    # タイトルの語は重く数え、同じ出現回数なら短い記事が上位になる
+    assert [title for title, _ in index.search("りんご")] == ["りんご", "多い", "少ない", "長い"]
+    # すべての検索語を含む記事だけを返し、少ない記事にしか出てこない語を重く見る
+    assert [title for title, _ in index.search("ぶどう みかん")] == ["なし", "少ない"]
+    assert index.search("すいか") == []
+    assert len(index.search("みかん", limit=2)) == 2
+
+
+def test_containing_finds_substrings_of_longer_terms():
+    index = SearchIndex.build({
+        "A": article("concatenate strings"),
+        "B": article("a cat sat"),
+        "C": article("東京都の話"),
+        "D": article("dog"),
+    })
+
+    assert index.containing("cat") >= {"A", "B"}
+    assert "D" not in index.containing("cat")
+    assert index.containing("at") >= {"A", "B"}
+    assert index.containing("京") == {"C"}
+    assert index.containing("京都") == {"C"}
+    assert index.containing("、") is None
+
+
+def test_merged_index_matches_full_build(monkeypatch):
+    monkeypatch.setattr(search_index, "MERGE_MIN_DOCS", 5)
+    rng = random.Random(0)
+    words = ["東京", "大阪", "電車", "歴史", "river", "city", "料理", "山"]
+    articles = {f"記事{i}": article(" ".join(rng.choices(words, k=8))) for i in range(20)}
+    index = SearchIndex.build(articles)
+    for step in range(60):
+        title = f"記事{rng.randrange(30)}"
+        if title in articles and rng.random() < 0.3:
+            del articles[title]
+            index.apply_changes({}, {title})
+        else:
+            articles[title] = article(" ".join(rng.choices(words, k=rng.randint(1, 12))))
+            index.apply_changes({title: articles[title]}, set())
+
+    full = SearchIndex.build(articles)
+    for query in words + ["東京 電車", "i"]:
+        assert sorted(index.search(query)) == sorted(full.search(query))
+        assert index.containing(query) == full.containing(query)
+    # まとめ直すと、どの記事にも含まれなくなった検索語は残らない
+    index.optimize()
+    assert sorted(index.term_list) == sorted(full.term_list)
+    assert sorted(index.search("東京")) == sorted(full.search("東京"))
+
+
+def test_loads_saved_and_legacy_files(tmp_path, monkeypatch):
+    articles = {"東京": article("首都の東京"), "大阪": article("大阪と東京")}
+    index = SearchIndex.build(articles)
+    index.apply_changes({"京都": article("古都")}, {"大阪"})
+    path = str(tmp_path / "search_index.json")
+    for storage_format in ("binary", "json"):
+        monkeypatch.setattr(codec, "STORAGE_FORMAT", storage_format)
+        index.save(path)
+        assert SearchIndex.load(path).search("東京") == index.search("東京")
+
+    # 検索語 → {タイトル: 出現回数} の辞書で保存していた形式
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"version": 4, "postings": {"東京": {"東京": 4, "大阪": 1}, "大阪": {"大阪": 4}},
+                   "lengths": {"東京": 6, "大阪": 6}, "doc_terms": {"東京": ["東京"], "大阪": ["東京", "大阪"]}}, f)
+    legacy = SearchIndex.load(path)
+    assert legacy.version == 4
+    assert [title for title, _ in legacy.search("東京")] == ["東京", "大阪"]
@@ -0,0 +1,244 @@
+import base64
+import json
+import os
+import re
+
+import storage
+from storage import commit_changes, get_user_encyclopedia, save_user_encyclopedia
+
+
+def article(content, category="未分類"):
+    return {"category": [category], "content": content, "images": [], "created": "2026-01-01 00:00:00"}
+
+
+def reload(username):
+    storage._shared.clear()
+    return get_user_encyclopedia(username)
+
+
+def test_rebase_keeps_changes_of_queued_batches(user):
+    enc = get_user_encyclopedia(user)
+    enc["A"] = article("a")
+    first = enc.pop_changes()
+    enc["B"] = article("b")
+    second = enc.pop_changes()
+
+    # 1つ目のまとまりを保存しても、保存待ちの2つ目の変更は手元に残る
+    assert commit_changes(user, enc, first).status == "saved"
+    assert enc["B"]["content"] == "b"
+    assert "B" in enc.titles and len(enc) == 2
+
+    assert commit_changes(user, enc, second).status == "saved"
+    assert reload(user)["B"]["content"] == "b"
+
+
+def test_failed_queued_batch_is_resent_as_put(user):
+    enc = get_user_encyclopedia(user)
+    enc["A"] = article("a")
+    first = enc.pop_changes()
+    enc["B"] = article("b")
+    second = enc.pop_changes()
+
+    commit_changes(user, enc, first)
+    # 2つ目のまとまりの書き込みが失敗した場合（書き込みキューと同じ戻し方）
+    enc.restore_changes(second)
+    assert enc.has_changes()
+    assert save_user_encyclopedia(user, enc).status == "saved"
+
+    saved = reload(user)
+    assert sorted(saved) == ["A", "B"]
+    assert saved["B"]["content"] == "b"
+
+
+def test_committed_titles_are_dropped_from_session(user):
+    enc = get_user_encyclopedia(user)
+    enc["A"] = article("a")
+    save_user_encyclopedia(user, enc)
+    assert enc._local == {} and enc._queued == {}
+
+
+def test_old_session_reads_bodies_after_compaction(user, monkeypatch):
+    enc = get_user_encyclopedia(user)
+    for i in range(5):
+        enc[f"記事{i}"] = article(f"最初の本文{i}" * 50)
+    save_user_encyclopedia(user, enc)
+    storage.compact(user)
+    old = reload(user)
+    old_store = old["記事0"].store.path
+
+    # 本文を短く書き換えて、本文ファイルの書き直しと古いファイルの削除が起きるようにする
+    writer = reload(user)
+    for i in range(5):
+        writer[f"記事{i}"] = article(f"新しい本文{i}")
+    save_user_encyclopedia(user, writer)
+    monkeypatch.setattr(storage, "COMPACT_MIN_BYTES", 0)
+    monkeypatch.setattr(storage, "BODIES_GRACE_SECONDS", -1)
+    storage.compact(user)
+    storage.BodyStore._memory.clear()
+
+    assert not storage.os.path.exists(old_store)
+    assert [old[f"記事{i}"]["content"] for i in range(5)] == [f"最初の本文{i}" * 50 for i in range(5)]
+    assert reload(user)["記事3"]["content"] == "新しい本文3"
+
+
+def test_history_records_previous_version_without_shared_cache(user):
+    enc = get_user_encyclopedia(user)
+    enc["A"] = article("一版")
+    save_user_encyclopedia(user, enc)
+    other = reload(user)
+    other["B"] = article("b")
+    save_user_encyclopedia(user, other)
+
+    # 共有データが追い出された後の保存（他のセッションの変更も取り込む）
+    storage._shared.clear()
+    enc["A"] = article("二版")
+    assert save_user_encyclopedia(user, enc).status == "merged"
+    storage._shared.clear()
+    storage._commit(user, [{"op": "put", "title": "A", "article": article("三版")}])
+
+    revisions = storage.article_history(user, "A")
+    contents = [storage.get_revision(user, "A", item["version"])["content"] for item in revisions]
+    assert sorted(contents) == ["一版", "二版"]
+
+
+def test_advance_matches_rebuilt_shared_articles(monkeypatch):
+    import random
+
+    monkeypatch.setattr(storage, "SHARED_FLATTEN_MIN", 8)
+    rng = random.Random(0)
+    expected = {f"記事{i}": article(str(i), f"カテゴリー{i % 5}") for i in range(100)}
+    shared = storage.SharedArticles(dict(expected), 0)
+    for version in range(1, 120):
+        ops = []
+        for _ in range(rng.randint(1, 3)):
+            title = f"記事{rng.randrange(130)}"
+            if rng.random() < 0.3:
+                ops.append({"op": "delete", "title": title})
+            else:
+                ops.append({"op": "put", "title": title, "article": article(str(version), f"カテゴリー{rng.randrange(7)}")})
+        storage.wal.apply_ops(expected, ops)
+        shared = shared.advance(ops, version)
+
+        rebuilt = storage.SharedArticles(dict(expected), version)
+        assert dict(shared.articles) == expected and len(shared.articles) == len(expected)
+        assert list(shared.titles) == rebuilt.titles
+        assert dict(shared.categories.counts()) == dict(rebuilt.categories.counts())
+        assert all(shared.categories.titles(cat) == rebuilt.categories.titles(cat)
+                   for cat in rebuilt.categories.names())
+    # セッションの索引は共有の変更を1段だけ重ねる
+    enc = storage.Encyclopedia(shared)
+    enc["新しい記事"] = article("x", "カテゴリー0")
+    assert "新しい記事" in enc.categories.titles("カテゴリー0")
+    assert "新しい記事" not in shared.categories.titles("カテゴリー0")
+
+
+def test_save_after_compaction_conflicts_only_on_changed_titles(user):
+    enc = get_user_encyclopedia(user)
+    enc["A"] = article("a")
+    enc["B"] = article("b")
+    save_user_encyclopedia(user, enc)
+    stale = reload(user)
+    stale_too = reload(user)
+    other = reload(user)
+    other["A"] = article("他のセッション")
+    save_user_encyclopedia(user, other)
+    # 読み込み後のログをスナップショットに畳み込む
+    storage.compact(user)
+
+    # 誰も変更していない記事の保存は取り込まれる
+    stale["B"] = article("b2")
+    assert save_user_encyclopedia(user, stale).status == "merged"
+    assert stale["A"]["content"] == "他のセッション"
+
+    # 他のセッションが変更した記事だけが競合になる
+    storage.compact(user)
+    stale_too["A"] = article("古い版からの変更")
+    stale_too["C"] = article("c")
+    result = save_user_encyclopedia(user, stale_too)
+    assert (result.status, result.conflicts) == ("conflict", ["A"])
+    saved = reload(user)
+    assert (saved["A"]["content"], saved["B"]["content"]) == ("他のセッション", "b2")
+
+
+def test_compaction_keeps_live_and_history_blobs(user):
+    store = storage.get_blob_store(user)
+    old, current, orphan, recent = (store.put(data) for data in (b"old", b"current", b"orphan", b"recent"))
+    enc = get_user_encyclopedia(user)
+    enc["A"] = dict(article("a"), images=[old])
+    save_user_encyclopedia(user, enc)
+    enc["A"] = dict(article("a"), images=[current])
+    save_user_encyclopedia(user, enc)
+    # 猶予期間より前に作成されたことにする（recentは保存前のアップロード）
+    for ref in (old, current, orphan):
+        os.utime(store.path(ref), (0, 0))
+
+    storage.compact(user)
+
+    # 記事と変更履歴から参照されているblobと作成直後のblobは残り、参照のないblobだけが消える
+    assert set(store.refs()) == {old, current, recent}
+
+
+def test_compaction_finds_live_blobs_without_reading_bodies(user, monkeypatch):
+    store = storage.get_blob_store(user)
+    image = store.put(b"image")
+    enc = get_user_encyclopedia(user)
+    enc["画像あり"] = dict(article("a"), images=[image])
+    enc["画像なし"] = article("b")
+    save_user_encyclopedia(user, enc)
+    storage.compact(user)
+    os.utime(store.path(image), (0, 0))
+
+    # スナップショットに保存した画像の参照を使い、本文ファイルは読まない
+    def fail(*args):
+        raise AssertionError("本文を読み込みました")
+    monkeypatch.setattr(storage.BodyStore, "read_raw", fail)
+    storage.compact(user)
+    assert set(store.refs()) == {image}
+
+
+def test_title_set_key_changes_only_with_the_titles(user):
+    enc = get_user_encyclopedia(user)
+    enc["A"] = article("a")
+    save_user_encyclopedia(user, enc)
+    key = enc.title_set_key()
+
+    # 本文の変更ではタイトルの集合は変わらない
+    enc["A"] = article("a2")
+    assert enc.title_set_key() == key
+    enc["B"] = article("b")
+    assert enc.title_set_key() != key
+    del enc["B"]
+    assert enc.title_set_key() == key
+    del enc["A"]
+    assert enc.title_set_key() != key
+
+
+def test_load_users_migrates_legacy_file(data_dir):
+    image = b"\x89PNG legacy image"
+    legacy = {"alice": {"password": "hash", "created": "2026-01-01 00:00:00", "encyclopedia": {
+        "記事": {"category": "歴史", "content": "本文", "images": [base64.b64encode(image).decode("ascii")],
+                 "created": "2026-01-02 00:00:00"}}}}
+    with open(storage.USERS_FILE, "w", encoding="utf-8") as f:
+        json.dump(legacy, f, ensure_ascii=False)
+
+    # 最初の読み込みで自動的に移行し、記事データを含まない認証情報だけを返す
+    assert storage.load_users() == {"alice": {"password": "hash", "created": "2026-01-01 00:00:00"}}
+    assert not os.path.exists(storage.USERS_FILE)
+    assert os.path.exists(storage.USERS_FILE + ".migrated")
+
+    migrated = get_user_encyclopedia("alice")["記事"]
+    assert migrated["category"] == ["歴史"]
+    assert migrated["content"] == "本文"
+    ref, = migrated["images"]
+    assert storage.get_blob_store("alice").read(ref) == image
+
+
+def test_user_dirs_are_hashed_usernames():
+    paths = {name: storage.user_dir(name) for name in ("alice", "Alice", "山田/太郎", "../etc")}
+
+    # 記号や日本語を含むユーザー名も、ユーザーごとに別の1階層のディレクトリになる
+    assert len(set(paths.values())) == len(paths)
+    for name, path in paths.items():
+        assert os.path.dirname(path) == storage.USERS_DIR
+        assert re.fullmatch(r"[0-9a-f]{32}", os.path.basename(path))
+        assert storage.user_dir(name) == path
@@ -0,0 +1,58 @@
+from title_suggest import TitleSuggester, _prefix_distance, normalize_title
+
+
+def titles(results):
+    return [title for title, _ in results]
+
+
+def test_normalize_title_folds_width_case_and_kana():
+    assert normalize_title("Ｐｙｔｈｏｎとﾊﾟｲｿﾝとパイソン") == "pythonとぱいそんとぱいそん"
+    assert normalize_title(" Ｔｏｋｙｏ ") == "tokyo"
+
+
+def test_prefix_distance_compares_with_the_head_of_the_title():
+    assert _prefix_distance("tokyo", "tokyo tower", 1) == 0
+    assert _prefix_distance("tokio", "tokyo tower", 1) == 1
+    assert _prefix_distance("tkyo", "tokyo", 1) == 1
+    # 許す距離を超える場合はlimit+1を返す
+    assert _prefix_distance("osaka", "tokyo", 2) == 3
+
+
+def test_width_and_kana_variants_find_the_same_title():
+    suggester = TitleSuggester(["Python入門", "ぱいそん", "カタカナ"])
+
+    # 全角の検索語で半角のタイトル、カタカナの検索語でひらがなのタイトルが見つかる
+    assert titles(suggester.suggest("ＰＹＴＨＯＮ")) == ["Python入門"]
+    assert titles(suggester.suggest("パイソン")) == ["ぱいそん"]
+    assert titles(suggester.suggest("ｶﾀｶﾅ")) == ["カタカナ"]
+    assert titles(suggester.suggest("かたかな")) == ["カタカナ"]
+
+
+def test_prefix_matches_come_before_substring_and_fuzzy_matches():
+    suggester = TitleSuggester(["東京タワー", "東京", "旧東京駅", "tokyo", "tokyo tower", "kyoto", "tokoyo"])
+
+    # 完全一致 → 前方一致 → 部分一致（位置の早い順）
+    assert suggester.suggest("東京") == [("東京", 0), ("東京タワー", 0), ("旧東京駅", 0)]
+    results = suggester.suggest("tokyo")
+    assert titles(results)[:2] == ["tokyo", "tokyo tower"]
+    # 誤字を許す一致は最後に、編集距離と一緒に返す
+    assert ("tokoyo", 1) in results
+    assert titles(results).index("tokoyo") > 1
+
+
+def test_one_character_typo_is_suggested():
+    suggester = TitleSuggester([f"記事{i}" for i in range(200)] + ["Encyclopedia", "Encyclopedic"])
+
+    assert titles(suggester.suggest("Encyclpedia", limit=3))[0] == "Encyclopedia"
+    assert ("Encyclopedia", 1) in suggester.suggest("Encyclopadia", limit=3)
+    # 誤字が多すぎる検索語は候補にしない
+    assert suggester.suggest("Xnxyxlopedia", limit=3) == []
+
+
+def test_within_and_incremental_updates():
+    suggester = TitleSuggester(["りんご", "りんごジュース", "みかん"])
+    suggester.apply_changes({"りんご飴": {}}, {"りんご"})
+
+    assert titles(suggester.suggest("リンゴ")) == ["りんごジュース", "りんご飴"]
+    assert titles(suggester.suggest("りんご", within={"りんご飴"})) == ["りんご飴"]
+    assert suggester.suggest("りんご", limit=1) == [("りんごジュース", 0)]
@@ -0,0 +1,104 @@
+import base64
+import json
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import storage
+import transfer
+from storage import SaveResult, get_user_encyclopedia
+
+
+def jsonl(*records):
+    return BytesIO(b"".join(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n" for record in records))
+
+
+def png():
+    buffer = BytesIO()
+    Image.new("RGB", (40, 30), (0, 120, 200)).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def test_import_skips_broken_image_and_continues(user):
+    broken = base64.b64encode(b"not an image at all").decode("ascii")
+    summary = transfer.import_archive(user, jsonl(
+        {"title": "壊れた画像", "category": ["a"], "content": "x", "images": [broken, png()]},
+        {"title": "普通の記事", "category": ["a"], "content": "y", "images": [png()]},
+    ))
+
+    assert summary["imported"] == 2
+    assert summary["images"] == 2
+    assert summary["error_count"] == 1 and summary["errors"][0].startswith("1行目")
+    encyclopedia = get_user_encyclopedia(user)
+    assert len(encyclopedia["壊れた画像"]["images"]) == 1
+    assert encyclopedia["普通の記事"]["content"] == "y"
+
+
+def test_import_skips_truncated_image(user):
+    truncated = base64.b64encode(base64.b64decode(png())[:60]).decode("ascii")
+    summary = transfer.import_archive(user, jsonl({"title": "記事", "content": "x", "images": [truncated]}))
+
+    assert summary["imported"] == 1 and summary["images"] == 0
+    assert summary["error_count"] == 1
+
+
+def test_import_stops_when_images_cannot_be_written(user, monkeypatch):
+    def disk_full(self, data):
+        raise OSError(28, "No space left on device")
+    monkeypatch.setattr(storage.BlobStore, "put", disk_full)
+
+    with pytest.raises(OSError):
+        transfer.import_archive(user, jsonl({"title": "記事", "content": "x", "images": [png()]},
+                                            {"title": "記事2", "content": "y", "images": [png()]}))
+    assert "記事" not in get_user_encyclopedia(user)
+
+
+def test_import_reports_batch_that_still_conflicts(user, monkeypatch):
+    monkeypatch.setattr(transfer, "save_user_encyclopedia",
+                        lambda username, encyclopedia, check_user=True: SaveResult("conflict", 0, ["記事"]))
+    summary = transfer.import_archive(user, jsonl({"title": "記事", "content": "x"}))
+
+    assert summary["imported"] == 0
+    assert summary["error_count"] == 1
+    assert "記事" not in get_user_encyclopedia(user)
+
+
+def test_export_and_import_keep_updated_time(user):
+    encyclopedia = get_user_encyclopedia(user)
+    encyclopedia["更新した記事"] = {"category": ["a"], "content": "x", "images": [],
+                                 "created": "2026-01-01 00:00:00", "updated": "2026-02-03 04:05:06"}
+    encyclopedia["新しい記事"] = {"category": ["a"], "content": "y", "images": [], "created": "2026-01-02 00:00:00"}
+    storage.save_user_encyclopedia(user, encyclopedia)
+    storage.create_user("bob", "hash", "2026-01-01 00:00:00")
+    for export in (transfer.export_jsonl, transfer.export_zip):
+        archive = BytesIO()
+        export(user, archive)
+        transfer.import_archive("bob", archive)
+
+        imported = get_user_encyclopedia("bob")
+        assert imported["更新した記事"]["updated"] == "2026-02-03 04:05:06"
+        assert "updated" not in imported["新しい記事"]
+
+
+def test_import_reports_compaction_that_never_starts(user, monkeypatch):
+    # 他のプロセスがコンパクションのロックを持ったままの場合
+    monkeypatch.setattr(storage, "compact", lambda username: False)
+    monkeypatch.setattr(storage, "BULK_COMPACT_TIMEOUT", 0.1)
+    summary = transfer.import_archive(user, jsonl({"title": "記事", "content": "x"}))
+
+    assert summary["imported"] == 1
+    assert summary["error_count"] == 1 and "コンパクション" in summary["errors"][0]
+    assert get_user_encyclopedia(user)["記事"]["content"] == "x"
+
+
+def test_import_reports_images_that_are_not_a_list(user):
+    summary = transfer.import_archive(user, jsonl(
+        {"title": "文字列の画像", "content": "x", "images": png(), "created": 20260101},
+    ))
+
+    # 文字列を1文字ずつ画像として読まず、その行のエラーを1件だけ報告する
+    assert summary["imported"] == 1 and summary["error_count"] == 1
+    assert summary["errors"] == ["1行目: 画像の項目がリストではありません"]
+    article = get_user_encyclopedia(user)["文字列の画像"]
+    assert article["images"] == [] and article["created"] == "20260101"
@@ -0,0 +1,70 @@
+import os
+
+import storage
+import wal
+from storage import get_user_encyclopedia, save_user_encyclopedia
+
+
+def article(content):
+    return {"category": ["未分類"], "content": content, "images": [], "created": "2026-01-01 00:00:00"}
+
+
+def reload(username):
+    storage._shared.clear()
+    storage._derived.clear()
+    return get_user_encyclopedia(username)
+
+
+def crash_while_appending(username):
+    # 書き込みの途中で止まった行（改行がなく、JSONとしても途中まで）を残す
+    with open(storage.wal_path(username), "ab") as f:
+        f.write(b'{"version":99,"ops":[{"op":"put","title":"\xe6\x9b\xb8')
+
+
+def test_replay_after_crash_ignores_torn_tail(user):
+    enc = get_user_encyclopedia(user)
+    for i in range(3):
+        enc[f"記事{i}"] = article(f"本文{i}")
+        save_user_encyclopedia(user, enc)
+    del enc["記事1"]
+    save_user_encyclopedia(user, enc)
+    crash_while_appending(user)
+
+    version, articles = storage._load_state(user)
+    assert version == 4
+    assert sorted(articles) == ["記事0", "記事2"]
+    assert storage.current_version(user) == 4
+    assert reload(user)["記事2"]["content"] == "本文2"
+
+
+def test_commit_after_crash_is_not_lost(user):
+    enc = get_user_encyclopedia(user)
+    enc["記事"] = article("一版")
+    save_user_encyclopedia(user, enc)
+    crash_while_appending(user)
+
+    enc = reload(user)
+    enc["記事"] = article("二版")
+    assert save_user_encyclopedia(user, enc).status == "saved"
+
+    assert [entry["version"] for entry, _ in wal.read_entries(storage.wal_path(user)) if "ops" in entry] == [1, 2]
+    assert reload(user)["記事"]["content"] == "二版"
+    # コンパクションの後も同じ内容になる
+    storage.compact(user)
+    assert os.path.getsize(storage.wal_path(user)) > 0
+    assert reload(user)["記事"]["content"] == "二版"
+
+
+def test_history_after_crash_keeps_new_revisions(user):
+    enc = get_user_encyclopedia(user)
+    for content in ("一版", "二版"):
+        enc["記事"] = article(content)
+        save_user_encyclopedia(user, enc)
+    with open(os.path.join(storage.user_dir(user), "history", "history.jsonl"), "ab") as f:
+        f.write(b'{"title":"\xe8\xa8\x98')
+    enc["記事"] = article("三版")
+    save_user_encyclopedia(user, enc)
+
+    storage._histories.clear()
+    revisions = storage.article_history(user, "記事")
+    assert sorted(storage.get_revision(user, "記事", item["version"])["content"] for item in revisions) == ["一版", "二版"]
@@ -0,0 +1,125 @@
+import storage
+import writer
+from storage import article_history, get_user_encyclopedia, save_user_encyclopedia
+from writer import WriteBehindQueue
+
+
+def article(content):
+    return {"category": ["未分類"], "content": content, "images": [], "created": "2026-01-01 00:00:00"}
+
+
+def paused_queue(monkeypatch):
+    """書き込みスレッドを起動しないキュー（start()で書き込みを始める）"""
+    queue = WriteBehindQueue()
+    monkeypatch.setattr(queue, "_start", lambda: None)
+    queue.start = lambda: WriteBehindQueue._start(queue)
+    return queue
+
+
+def test_submits_of_one_session_are_coalesced_into_one_commit(user, monkeypatch):
+    queue = paused_queue(monkeypatch)
+    enc = get_user_encyclopedia(user)
+    enc["A"] = article("a0")
+    save_user_encyclopedia(user, enc)
+    enc["A"] = article("a1")
+    queue.submit(user, enc)
+    enc["A"] = article("a2")
+    enc["B"] = article("b")
+    queue.submit(user, enc)
+    enc.rename("B", "C", article("c"))
+    queue.submit(user, enc)
+
+    # 同じ記事への操作は1つにまとめられる
+    (_, _, ops), = queue._pending.values()
+    assert sorted((op["op"], op.get("title", op.get("to"))) for op in ops) == [("put", "A"), ("rename", "C")]
+    assert queue._pending_ops == len(ops)
+    assert queue.status(enc) == "pending"
+
+    queue.start()
+    assert queue.flush(user, 5)
+    assert queue.status(enc) == "saved"
+    assert storage.current_version(user) == 2
+    # 履歴には置き換えられた版が1つだけ残る
+    assert [revision["version"] for revision in article_history(user, "A")] == [2]
+    assert storage.get_revision(user, "A", 2)["content"] == "a0"
+    storage._shared.clear()
+    assert get_user_encyclopedia(user)["A"]["content"] == "a2"
+
+
+def test_failed_commit_restores_changes_and_reports_error(user, monkeypatch):
+    queue = WriteBehindQueue()
+    enc = get_user_encyclopedia(user)
+    enc["A"] = article("a")
+
+    def fail(username, encyclopedia, ops):
+        raise OSError("disk full")
+    monkeypatch.setattr(writer, "commit_changes", fail)
+    queue.submit(user, enc)
+    assert queue.flush(user, 5)
+    assert queue.status(enc) == "error"
+    # 書き込めなかった変更は未保存に戻り、次の保存で再送される
+    assert enc.has_changes() and not enc._queued
+    assert storage.current_version(user) == 0
+
+    monkeypatch.setattr(writer, "commit_changes", storage.commit_changes)
+    queue.submit(user, enc)
+    assert queue.flush(user, 5)
+    assert queue.status(enc) == "saved"
+    storage._shared.clear()
+    assert get_user_encyclopedia(user)["A"]["content"] == "a"
+
+
+def test_flush_waits_only_for_the_given_user(user, monkeypatch):
+    queue = paused_queue(monkeypatch)
+    enc = get_user_encyclopedia(user)
+    enc["A"] = article("a")
+    queue.submit(user, enc)
+
+    # 書き込みが終わらなければタイムアウトでFalseを返す
+    assert not queue.flush(user, 0.05)
+    assert not queue.flush(None, 0.05)
+    assert queue.flush("bob", 0.05)
+
+    queue.start()
+    assert queue.flush(user, 5)
+    assert queue.flush()
+    assert storage.current_version(user) == 1
+
+
+def test_indexes_use_committed_articles_not_later_local_edits(user, monkeypatch):
+    queue = paused_queue(monkeypatch)
+    enc = get_user_encyclopedia(user)
+    enc["B"] = article("mentions Alpha here")
+    save_user_encyclopedia(user, enc)
+    storage.get_index(user, "links")
+
+    enc["Alpha"] = article("alpha")
+    queue.submit(user, enc)
+    # 保存を待つ間にセッションが続けた、未保存の編集
+    enc["B"] = article("plain")
+    queue.start()
+    assert queue.flush(user, 5)
+    assert enc.has_changes()
+    assert storage.get_index(user, "links").backlinks("Alpha") == ["B"]
+
+
+def test_writer_keeps_running_when_restoring_changes_fails(user, monkeypatch):
+    queue = WriteBehindQueue()
+    enc = get_user_encyclopedia(user)
+    enc["A"] = article("a")
+
+    def fail(*args):
+        raise OSError("disk full")
+    monkeypatch.setattr(writer, "commit_changes", fail)
+    monkeypatch.setattr(enc, "restore_changes", fail)
+    queue.submit(user, enc)
+    assert queue.flush(user, 5)
+
+    # 同じスレッドが次の保存も書き込む
+    monkeypatch.setattr(writer, "commit_changes", storage.commit_changes)
+    other = get_user_encyclopedia(user)
+    other["B"] = article("b")
+    queue.submit(user, other)
+    assert queue.flush(user, 5)
+    assert queue._thread.is_alive()
+    assert storage.current_version(user) == 1
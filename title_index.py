@@ -0,0 +1,89 @@
+import heapq
+from bisect import bisect_left, bisect_right, insort
+
+
+class SortedTitles:
+    """共有のソート済みタイトルのリストにセッション内の追加・削除を重ねた索引
+
+    共有のリストは書き換えず、追加・削除されたタイトルだけを持つ。スライスで取り出すと
+    先頭から数え直さずにその範囲だけを返すので、一覧のページ表示の手間はページの件数に比例する。
+    """
+
+    def __init__(self, base):
+        self.base = base      # 共有のソート済みタイトルのリスト
+        self._added = []      # 追加したタイトル（ソート済み）
+        self._removed = set() # 共有のリストから取り除いたタイトル
+
+    @classmethod
+    def over(cls, titles):
+        """ソート済みのリストか、それに重ねたSortedTitlesの上に変更を重ねる（重ねは1段にする）"""
+        return titles.copy() if isinstance(titles, cls) else cls(titles)
+
+    def copy(self):
+        """共有のリストはそのまま使い、変更分だけをコピーする"""
+        titles = SortedTitles(self.base)
+        titles._added = list(self._added)
+        titles._removed = set(self._removed)
+        return titles
+
+    def add(self, title):
+        if title in self._removed:
+            self._removed.discard(title)
+        else:
+            insort(self._added, title)
+
+    def remove(self, title):
+        i = bisect_left(self._added, title)
+        if i < len(self._added) and self._added[i] == title:
+            del self._added[i]
+        else:
+            self._removed.add(title)
+
+    def __len__(self):
+        return len(self.base) - len(self._removed) + len(self._added)
+
+    def __iter__(self):
+        return self._iter_from(0)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return list(self)[key]
+            return self.page(start, stop - start)
+        if key < 0:
+            key += len(self)
+        page = self.page(key, 1)
+        if not page:
+            raise IndexError(key)
+        return page[0]
+
+    def page(self, start, count):
+        """start番目からcount件のタイトルを返す"""
+        if count <= 0:
+            return []
+        # 共有のリストのこの位置より前には、start件以下のタイトルしかない
+        base_start = min(max(0, start - len(self._added)), len(self.base))
+        skip = start - self._rank(base_start)
+        items = self._iter_from(base_start)
+        for _ in range(skip):
+            next(items, None)
+        return [title for _, title in zip(range(count), items)]
+
+    def _rank(self, base_index):
+        """共有のリストのbase_index番目より前にあるタイトルの数"""
+        if base_index == 0:
+            return 0
+        last = self.base[base_index - 1]
+        removed = sum(1 for t in self._removed if t <= last)
+        return base_index - removed + bisect_right(self._added, last)
+
+    def _iter_from(self, base_index):
+        """共有のリストのbase_index番目以降のタイトルを順に返す"""
+        base = self.base
+        removed = self._removed
+        base_titles = (base[i] for i in range(base_index, len(base)) if base[i] not in removed)
+        added = self._added
+        if base_index > 0:
+            added = added[bisect_right(added, base[base_index - 1]):]
+        return heapq.merge(base_titles, added)
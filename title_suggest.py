@@ -0,0 +1,201 @@
+import heapq
+from collections import Counter
+from itertools import accumulate
+from bisect import bisect_left, bisect_right, insort
+import perf
+import codec
+from search_index import normalize_text
+
+# 候補を出すのに必要な検索語の長さと、許す編集距離（誤字の数）
+FUZZY_MIN_LENGTH = 3
+LONG_QUERY_LENGTH = 6  # これ以上の長さなら2文字までの誤字を許す
+
+# 誤字を許す候補として編集距離を計算する記事の最大数
+MAX_FUZZY_CANDIDATES = 50
+
+# 誤字を許す候補を探すときに、これより多くのタイトルに現れるトライグラムは数えない
+# （「city」の先頭のようにありふれたトライグラムは候補を絞る役に立たず、数える手間だけかかる）
+MAX_FUZZY_POSTING = 1000
+
+_PAD = "\x00"  # 先頭・末尾を表す文字（トライグラムでタイトルの始まりと終わりを区別する）
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(ord("ァ"), ord("ヶ") + 1)}
+
+
+# 候補の検索用にタイトルを正規化（全角・半角、大文字・小文字、カタカナ・ひらがなを同一視）
+def normalize_title(title):
+    return normalize_text(title).translate(_KATAKANA_TO_HIRAGANA).strip()
+
+
+def _trigrams(text, pad_end=True):
+    padded = _PAD + text + (_PAD if pad_end else "")
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _prefix_distance(query, text, limit):
+    """queryとtextの先頭部分との編集距離の最小値（limitを超える場合はlimit+1）
+
+    入力途中の検索語でも誤字を許して候補を出せるよう、text全体ではなく先頭部分と比べる。
+    距離がlimit以下になりうる対角線の近くだけを計算する。
+    """
+    text = text[:len(query) + limit]  # これより長い先頭部分は、距離がlimitを超える
+    over = limit + 1
+    previous = {j: j for j in range(min(len(text), limit) + 1)}
+    for i, q in enumerate(query, 1):
+        low = max(0, i - limit)
+        current = {}
+        for j in range(low, min(len(text), i + limit) + 1):
+            if j == 0:
+                current[0] = i
+                continue
+            current[j] = min(previous.get(j, over) + 1, current.get(j - 1, over) + 1,
+                             previous.get(j - 1, over) + (q != text[j - 1]))
+        if min(current.values(), default=over) > limit:
+            return over
+        previous = current
+    return min(min(previous.values(), default=over), over)
+
+
+class TitleSuggester:
+    """記事タイトルの入力候補の索引
+
+    正規化したタイトルのソート済みリスト（前方一致）とトライグラムの転置インデックス
+    （部分一致・誤字を許す一致）を持ち、記事の作成・名前の変更・削除のたびに差分で更新する。
+    """
+
+    def __init__(self, titles=(), version=0):
+        self.version = version  # 反映済みのコミット番号
+        self.keys = []          # (正規化したタイトル, タイトル) のソート済みリスト
+        self.normalized = {}    # タイトル → 正規化したタイトル
+        self.trigrams = {}      # トライグラム → タイトルの集合
+        self._joined = None     # 短い検索語の部分一致用に、正規化したタイトルをつなげた文字列と各タイトルの開始位置
+        for title in titles:
+            key = normalize_title(title)
+            self.normalized[title] = key
+            for trigram in _trigrams(key):
+                self.trigrams.setdefault(trigram, set()).add(title)
+        # まとめて作るときは1件ずつ挿入せずに最後に1回だけ並べ替える
+        self.keys = sorted((key, title) for title, key in self.normalized.items())
+
+    @classmethod
+    def build(cls, encyclopedia, context=None):
+        return cls(encyclopedia.keys())
+
+    @classmethod
+    def load(cls, path):
+        # タイトルから作り直すほうが、トライグラムの集合を読み込むより速い
+        data = codec.load_file(path)
+        return cls(data["titles"], data["version"])
+
+    def save(self, path):
+        data = codec.dumps({"version": self.version, "titles": list(self.normalized)})
+        codec.replace_file(path, lambda f: f.write(data))
+
+    def add(self, title):
+        if title in self.normalized:
+            return
+        key = normalize_title(title)
+        self.normalized[title] = key
+        insort(self.keys, (key, title))
+        self._joined = None
+        for trigram in _trigrams(key):
+            self.trigrams.setdefault(trigram, set()).add(title)
+
+    def remove(self, title):
+        key = self.normalized.pop(title, None)
+        if key is None:
+            return
+        del self.keys[bisect_left(self.keys, (key, title))]
+        self._joined = None
+        for trigram in _trigrams(key):
+            titles = self.trigrams[trigram]
+            titles.discard(title)
+            if not titles:
+                del self.trigrams[trigram]
+
+    def apply_changes(self, updated, deleted, context=None):
+        """保存時の差分を反映する（本文の変更はタイトルが変わらないので何もしない）"""
+        for title in deleted:
+            self.remove(title)
+        for title in updated:
+            self.add(title)
+
+    def _short_matches(self, query, limit, results, accept):
+        """トライグラムを作れない短い検索語の部分一致（タイトルの順に）"""
+        if self._joined is None:
+            keys = [key for key, _ in self.keys]
+            self._joined = (_PAD.join(keys), list(accumulate((len(key) + 1 for key in keys), initial=0)))
+        joined, starts = self._joined
+        position = joined.find(query)
+        while position >= 0 and len(results) < limit:
+            index = bisect_right(starts, position) - 1
+            title = self.keys[index][1]
+            if accept(title):
+                results[title] = 0
+            # 同じタイトルの中の2つ目以降の出現は飛ばす
+            position = joined.find(query, starts[index + 1])
+
+    @perf.timed("titles.suggest")
+    def suggest(self, query, limit=10, within=None):
+        """queryに合うタイトルを [(タイトル, 編集距離)] で良い順に最大limit件返す
+
+        完全一致、前方一致、部分一致、誤字を許す一致の順に並べる。
+        withinを渡すと、その集合に含まれるタイトルだけを返す（カテゴリーでの絞り込みなど）。
+        """
+        query = normalize_title(query)
+        if not query or limit <= 0:
+            return []
+        results = {}
+
+        def accept(title):
+            return title not in results and (within is None or title in within)
+
+        # 前方一致（ソート済みリストの範囲を順に取り出す。完全一致が最初に来る）
+        i = bisect_left(self.keys, (query,))
+        while i < len(self.keys) and len(results) < limit:
+            key, title = self.keys[i]
+            if not key.startswith(query):
+                break
+            if accept(title):
+                results[title] = 0
+            i += 1
+        if len(results) >= limit:
+            return list(results.items())
+        if len(query) < FUZZY_MIN_LENGTH:
+            self._short_matches(query, limit, results, accept)
+            return list(results.items())
+
+        # 部分一致（検索語のトライグラムをすべて含むタイトルに絞ってから確かめる）
+        inner = sorted((self.trigrams.get(query[i:i + 3], ()) for i in range(len(query) - 2)), key=len)
+        candidates = set(inner[0]).intersection(*inner[1:]) if inner and inner[0] else set()
+        matches = [(self.normalized[title].find(query), len(self.normalized[title]), title)
+                   for title in candidates if accept(title) and query in self.normalized[title]]
+        for _, _, title in heapq.nsmallest(limit - len(results), matches):
+            results[title] = 0
+        if len(results) >= limit:
+            return list(results.items())
+
+        # 誤字を許す一致（編集1回で変わるトライグラムは最大3つなので、共有するトライグラムの数で候補を絞る）
+        max_distance = 1 if len(query) < LONG_QUERY_LENGTH else 2
+        postings = [self.trigrams.get(trigram, ()) for trigram in _trigrams(query, pad_end=False)]
+        rare = [posting for posting in postings if len(posting) <= MAX_FUZZY_POSTING]
+        if not rare:
+            rare = [min(postings, key=len)]
+        # ありふれたトライグラムを数えない分だけ、必要な共有数も減らす
+        required = max(1, len(postings) - 3 * max_distance - (len(postings) - len(rare)))
+        shared = Counter()
+        for posting in rare:
+            shared.update(posting)
+        scored = []
+        needed = limit - len(results)
+        # 共有するトライグラムの多い順に確かめ、必要な件数が見つかったら打ち切る
+        for title, count in shared.most_common(MAX_FUZZY_CANDIDATES):
+            if count < required or len(scored) >= needed:
+                break
+            if not accept(title):
+                continue
+            distance = _prefix_distance(query, self.normalized[title], max_distance)
+            if distance <= max_distance:
+                scored.append((distance, -count, len(self.normalized[title]), title))
+        for distance, _, _, title in sorted(scored):
+            results[title] = distance
+        return list(results.items())
@@ -0,0 +1,325 @@
+import io
+import json
+import base64
+import hashlib
+import shutil
+import zipfile
+from datetime import datetime
+from PIL import Image
+import storage
+from storage import get_user_encyclopedia, save_user_encyclopedia, get_blob_store, get_thumbnail_cache
+from blobstore import is_blob_ref
+from categories import normalize_categories
+from images import encode_image_data
+
+# ZIPアーカイブ内の記事データのファイル名と画像のディレクトリ
+ARTICLES_ENTRY = "articles.jsonl"
+IMAGES_DIR = "images/"
+
+# 取り込むときに1回の保存にまとめる記事数
+IMPORT_BATCH_ARTICLES = 500
+
+# 1回の保存にまとめる画像の合計サイズ（バイト）。超えたら記事数が少なくても保存する
+IMPORT_BATCH_IMAGE_BYTES = 64 * 1024 * 1024
+
+# この記事数を取り込むごとにコンパクションを行い、メモリに残る本文を手放す
+IMPORT_COMPACT_ARTICLES = 5000
+
+# 結果に含めるエラーの最大件数（それ以上は件数だけ数える）
+MAX_REPORTED_ERRORS = 100
+
+# ファイルをコピーするときの読み込み単位（バイト）
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# 画像として読み込めないデータを変換しようとしたときの例外
+# （blobの書き込みに失敗したときのOSErrorは含めず、取り込みを中断する）
+IMAGE_ERRORS = (ValueError, Image.DecompressionBombError)
+
+
+# 画像の先頭のバイト列から拡張子を決める
+def _image_extension(head):
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return ".webp"
+    if head.startswith(b"\x89PNG"):
+        return ".png"
+    if head.startswith(b"\xff\xd8"):
+        return ".jpg"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return ".gif"
+    return ""
+
+
+def _article_record(title, article):
+    record = {"title": title, "category": article.get("category", []), "content": article.get("content", ""),
+              "created": article.get("created", "")}
+    if article.get("updated"):
+        record["updated"] = article["updated"]
+    return record
+
+
+# 記事を1行ずつJSON Lines形式で書き出す
+def export_jsonl(username, fileobj, progress=None):
+    """画像はBase64の文字列として各行に埋め込む（記事1件分ずつ書き込むのでメモリは一定）
+
+    fileobjはバイナリモードで開いたファイル。書き出した記事数を返す。
+    """
+    encyclopedia = get_user_encyclopedia(username)
+    store = get_blob_store(username)
+    total = len(encyclopedia)
+    for done, title in enumerate(encyclopedia.titles, 1):
+        article = encyclopedia[title]
+        record = _article_record(title, article)
+        record["images"] = [base64.b64encode(store.read(ref)).decode("ascii")
+                            for ref in article.get("images", []) if store.exists(ref)]
+        fileobj.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        if progress:
+            progress(done, done / total)
+    return total
+
+
+# 記事と画像をZIPアーカイブに書き出す
+def export_zip(username, fileobj, progress=None):
+    """記事はarticles.jsonlに1行ずつ、画像はimages/以下に1ファイルずつ書き込む
+
+    アーカイブ全体をメモリに作らず、記事1件・画像1枚ずつfileobjに書き込んでいく。
+    書き出した記事数を返す。
+    """
+    encyclopedia = get_user_encyclopedia(username)
+    store = get_blob_store(username)
+    total = len(encyclopedia)
+    image_names = {}  # 参照 → アーカイブ内のファイル名
+    with zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(ARTICLES_ENTRY, "w", force_zip64=True) as entry:
+            for done, title in enumerate(encyclopedia.titles, 1):
+                article = encyclopedia[title]
+                record = _article_record(title, article)
+                names = []
+                for ref in article.get("images", []):
+                    if ref not in image_names:
+                        if not store.exists(ref):
+                            continue
+                        with open(store.path(ref), "rb") as f:
+                            image_names[ref] = IMAGES_DIR + ref + _image_extension(f.read(12))
+                    names.append(image_names[ref])
+                record["images"] = names
+                entry.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+                if progress:
+                    progress(done, done / total * 0.5)
+        # 画像は圧縮済みなので、ZIPでは圧縮せずにそのまま格納する
+        for done, (ref, name) in enumerate(image_names.items(), 1):
+            info = zipfile.ZipInfo(name, date_time=datetime.now().timetuple()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            with open(store.path(ref), "rb") as src, archive.open(info, "w", force_zip64=True) as dst:
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+            if progress:
+                progress(total, 0.5 + done / len(image_names) * 0.5)
+    return total
+
+
+class _Importer:
+    """読み込んだ記事を一定数ずつまとめて保存する"""
+
+    def __init__(self, username, read_image, overwrite, progress):
+        self.username = username
+        self.read_image = read_image   # 記事の画像の項目 → バイト列（見つからなければNone）
+        self.overwrite = overwrite
+        self.progress = progress
+        self.store = get_blob_store(username)
+        self.thumbnails = get_thumbnail_cache(username)
+        self.encyclopedia = get_user_encyclopedia(username)
+        self.batch = []                # [(行番号, タイトル, 記事, 画像のハッシュのリスト)]
+        self.batch_images = {}         # バッチ内のまだ変換していない画像のハッシュ → バイト列
+        self.encoded = {}              # 元の画像のハッシュ → 保存した参照（同じ画像は1回だけ変換する）
+        self.batch_image_bytes = 0
+        self.since_compact = 0
+        self.summary = {"imported": 0, "skipped": 0, "images": 0, "error_count": 0, "errors": []}
+
+    def error(self, message):
+        self.summary["error_count"] += 1
+        if len(self.summary["errors"]) < MAX_REPORTED_ERRORS:
+            self.summary["errors"].append(message)
+
+    def add(self, line_number, line, fraction):
+        try:
+            record = json.loads(line)
+            title = str(record["title"]).strip()
+        except (ValueError, KeyError, TypeError):
+            self.error(f"{line_number}行目: 記事として読み込めません")
+            return
+        if not title or (not self.overwrite and title in self.encyclopedia):
+            self.summary["skipped"] += 1
+            return
+        items = record.get("images") or []
+        if not isinstance(items, list):
+            # 文字列などを1文字ずつ画像として扱わないよう、画像を持たない記事として取り込む
+            self.error(f"{line_number}行目: 画像の項目がリストではありません")
+            items = []
+        images = []
+        for item in items:
+            data = self.read_image(item)
+            if data is None:
+                self.error(f"{line_number}行目: 画像「{str(item)[:40]}」が見つかりません")
+                continue
+            digest = hashlib.sha256(data).digest()
+            images.append(digest)
+            if digest not in self.encoded and digest not in self.batch_images:
+                self.batch_images[digest] = data
+                self.batch_image_bytes += len(data)
+        article = {
+            "category": normalize_categories(record.get("category")),
+            "content": str(record.get("content", "")),
+            "created": str(record.get("created") or datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+        }
+        if record.get("updated"):
+            article["updated"] = str(record["updated"])
+        self.batch.append((line_number, title, article, images))
+        if len(self.batch) >= IMPORT_BATCH_ARTICLES or self.batch_image_bytes >= IMPORT_BATCH_IMAGE_BYTES:
+            self.flush()
+        if self.progress:
+            self.progress(self.summary["imported"] + len(self.batch), fraction)
+
+    def flush(self):
+        if not self.batch:
+            return
+        self._encode_images()
+        image_count = 0
+        for line_number, title, article, images in self.batch:
+            # 変換できなかった画像は除いて、記事は取り込む
+            if any(digest not in self.encoded for digest in images):
+                self.error(f"{line_number}行目: 画像として読み込めないデータがあります")
+            article["images"] = [self.encoded[digest] for digest in images if digest in self.encoded]
+            image_count += len(article["images"])
+            self.encyclopedia[title] = article
+        result = save_user_encyclopedia(self.username, self.encyclopedia, check_user=False)
+        if result.status == "conflict":
+            # 他のセッションが同じ記事を変更していた場合は、最新の状態に取り込んだ内容を上書きする
+            self.encyclopedia = get_user_encyclopedia(self.username)
+            for _, title, article, _ in self.batch:
+                self.encyclopedia[title] = article
+            result = save_user_encyclopedia(self.username, self.encyclopedia, check_user=False)
+        if result.status == "conflict":
+            # 続けて変更されている場合はこのバッチを取り込まず、次のバッチに持ち越さない
+            first, last = self.batch[0][0], self.batch[-1][0]
+            self.error(f"{first}〜{last}行目: 他のセッションと同じ記事を変更していたため、{len(self.batch)}件を保存できませんでした")
+            self.encyclopedia = get_user_encyclopedia(self.username)
+        else:
+            self.summary["imported"] += len(self.batch)
+            self.summary["images"] += image_count
+            self.since_compact += len(self.batch)
+        self.batch = []
+        self.batch_images = {}
+        self.batch_image_bytes = 0
+        if self.since_compact >= IMPORT_COMPACT_ARTICLES:
+            self._release_bodies()
+
+    def _encode_images(self):
+        """バッチ内のまだ変換していない画像をまとめて並列に変換する（変換できない画像はself.encodedに入らない）"""
+        try:
+            refs = encode_image_data(list(self.batch_images.values()), self.store, self.thumbnails, keep_webp=True)
+            self.encoded.update(zip(self.batch_images, refs))
+        except IMAGE_ERRORS:
+            # 壊れた画像が含まれていたので、1枚ずつ変換し直してその画像だけを除く
+            for digest, data in self.batch_images.items():
+                try:
+                    self.encoded[digest] = encode_image_data([data], self.store, self.thumbnails, keep_webp=True)[0]
+                except IMAGE_ERRORS:
+                    pass
+
+    def _release_bodies(self):
+        # 本文を本文ファイルに移し、保存したばかりの本文をメモリから手放す
+        # （バックグラウンドのコンパクションが動いていれば、次の機会に行う）
+        if storage.compact(self.username):
+            storage.release_shared(self.username)
+            self.encyclopedia = get_user_encyclopedia(self.username)
+            self.since_compact = 0
+
+
+# JSON LinesまたはZIPアーカイブから記事を取り込む
+def import_archive(username, fileobj, overwrite=True, progress=None):
+    """形式はファイルの内容から判定する。記事を1行ずつ読み込み、一定数ずつまとめて保存する
+
+    overwriteがFalseの場合、同じタイトルの記事がすでにあれば取り込まない。
+    progressには (取り込んだ記事数, 進み具合0〜1) が渡される。
+    {"imported", "skipped", "images", "error_count", "errors"} の辞書を返す。
+    """
+    summary = None
+    try:
+        with storage.bulk_changes(username):
+            summary = _import(username, fileobj, overwrite, progress)
+    except TimeoutError as e:
+        # 記事は取り込めていて、最後のコンパクションだけができなかった
+        if summary is None:
+            raise
+        summary["error_count"] += 1
+        summary["errors"].append(str(e))
+    # 取り込んだ記事の本文をメモリから手放し、本文ファイルから読み込むようにする
+    storage.release_shared(username)
+    return summary
+
+
+def _import(username, fileobj, overwrite, progress):
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        with zipfile.ZipFile(fileobj) as archive:
+            names = set(archive.namelist())
+
+            def read_image(item):
+                if isinstance(item, str) and item in names:
+                    return archive.read(item)
+                return _read_embedded_image(item, importer.store)
+
+            if ARTICLES_ENTRY not in names:
+                raise ValueError(f"アーカイブに{ARTICLES_ENTRY}がありません")
+            importer = _Importer(username, read_image, overwrite, progress)
+            total = archive.getinfo(ARTICLES_ENTRY).file_size or 1
+            with archive.open(ARTICLES_ENTRY) as entry:
+                _import_lines(importer, entry, total)
+    else:
+        fileobj.seek(0, io.SEEK_END)
+        total = fileobj.tell() or 1
+        fileobj.seek(0)
+        importer = _Importer(username, lambda item: _read_embedded_image(item, importer.store), overwrite, progress)
+        _import_lines(importer, fileobj, total)
+    return importer.summary
+
+
+def _import_lines(importer, lines, total):
+    read = 0
+    for line_number, line in enumerate(lines, 1):
+        read += len(line)
+        if line.strip():
+            importer.add(line_number, line, min(read / total, 1.0))
+    importer.flush()
+    if importer.progress:
+        importer.progress(importer.summary["imported"], 1.0)
+
+
+def _read_embedded_image(item, store):
+    """Base64で埋め込まれた画像か、同じユーザーのblobストアにある画像の参照を読み込む"""
+    if not isinstance(item, str) or not item:
+        return None
+    if is_blob_ref(item):
+        return store.read(item) if store.exists(item) else None
+    try:
+        return base64.b64decode(item, validate=True)
+    except ValueError:
+        return None
+
+
+if __name__ == "__main__":
+    # 書き出し: python transfer.py export ユーザー名 出力ファイル(.zip / .jsonl)
+    # 取り込み: python transfer.py import ユーザー名 入力ファイル
+    import sys
+    command, username, path = sys.argv[1:4]
+    if command == "export":
+        with open(path, "wb") as f:
+            count = (export_zip if path.endswith(".zip") else export_jsonl)(username, f)
+        print(f"{count}件の記事を書き出しました")
+    else:
+        with open(path, "rb") as f:
+            summary = import_archive(username, f)
+        print(f"{summary['imported']}件の記事と{summary['images']}枚の画像を取り込みました")
+        for error in summary["errors"]:
+            print(error)
+        if summary["error_count"] > len(summary["errors"]):
+            print(f"ほか{summary['error_count'] - len(summary['errors'])}件のエラー")
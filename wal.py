@@ -0,0 +1,113 @@
+import json
+import os
+import perf
+
+
+# 1コミット分の操作をログに追記（コミットごとに1回だけfsyncする）
+@perf.timed("wal.append")
+def append(path, entry):
+    # 本文を後から読み込む記事（LazyArticle）は通常の辞書にしてから書き込む
+    line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=dict) + "\n"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a+b") as f:
+        truncate_torn_tail(f)
+        f.write(line.encode("utf-8"))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# 書き込み途中でクラッシュした末尾の不完全な行を切り詰める
+def truncate_torn_tail(f, chunk_size=65536):
+    """残したまま追記すると、次のコミットの行が不完全な行とつながって読み込めなくなる"""
+    end = f.seek(0, os.SEEK_END)
+    if end == 0:
+        return
+    f.seek(end - 1)
+    if f.read(1) == b"\n":
+        return
+    position = end
+    while position > 0:
+        start = max(0, position - chunk_size)
+        f.seek(start)
+        newline = f.read(position - start).rfind(b"\n")
+        if newline >= 0:
+            f.truncate(start + newline + 1)
+            return
+        position = start
+    f.truncate(0)
+
+
+# ログのエントリーを先頭から順に読み込む
+@perf.timed("wal.read_entries")
+def read_entries(path, offset=0):
+    """(エントリー, 次のエントリーの位置) を順に返す
+
+    書き込み途中でクラッシュした末尾の不完全な行は無視する。
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            offset += len(line)
+            yield entry, offset
+
+
+# ログの最後のエントリーを読み込む（ファイル全体は読まない）
+def last_entry(path, chunk_size=65536):
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        size = chunk_size
+        while True:
+            start = max(0, end - size)
+            f.seek(start)
+            lines = f.read(end - start).split(b"\n")
+            # 最後の要素は改行の後ろ（空か書き込み途中の行）、先頭は途中から始まる行の可能性がある
+            candidates = lines[:-1] if start == 0 else lines[1:-1]
+            for line in reversed(candidates):
+                try:
+                    return json.loads(line)
+                except ValueError:
+                    continue
+            if start == 0:
+                return None
+            size *= 2
+
+
+# 記事の操作を辞書に適用する（同じ操作を何度適用しても結果は変わらない）
+def apply_ops(articles, ops):
+    for op in ops:
+        kind = op["op"]
+        if kind == "put":
+            articles[op["title"]] = op["article"]
+        elif kind == "delete":
+            articles.pop(op["title"], None)
+        elif kind == "rename":
+            articles.pop(op["from"], None)
+            articles[op["to"]] = op["article"]
+    return articles
+
+
+# 操作の影響を (追加・更新された記事の辞書, 削除されたタイトルの集合) にまとめる
+def summarize_ops(ops):
+    updated = {}
+    deleted = set()
+    for op in ops:
+        kind = op["op"]
+        if kind == "delete" or kind == "rename":
+            title = op["title"] if kind == "delete" else op["from"]
+            updated.pop(title, None)
+            deleted.add(title)
+        if kind == "put" or kind == "rename":
+            title = op["title"] if kind == "put" else op["to"]
+            deleted.discard(title)
+            updated[title] = op["article"]
+    return updated, deleted
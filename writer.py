@@ -0,0 +1,132 @@
+import atexit
+import threading
+import traceback
+from collections import OrderedDict
+from storage import SaveResult, commit_changes
+
+# 保存待ちの操作がこの数を超えたら、書き込みが追いつくまで呼び出し元を待たせる
+MAX_PENDING_OPS = 256
+# 終了時に保存待ちの書き込みを待つ最大の秒数（書き込みが止まっていても終了できるように）
+EXIT_FLUSH_TIMEOUT = 30
+
+
+class WriteBehindQueue:
+    """記事の保存をバックグラウンドのスレッドで行うキュー
+
+    画面の処理はディスクへの書き込みを待たずに進められる。同じユーザーの保存待ちの
+    変更は、書き込みスレッドが取り出すときに1回の書き込みにまとめられる。
+    """
+
+    def __init__(self, max_pending_ops=MAX_PENDING_OPS):
+        self.max_pending_ops = max_pending_ops
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()  # id(encyclopedia) → [ユーザー名, encyclopedia, 操作のリスト]
+        self._pending_ops = 0
+        self._in_flight = {}           # 書き込み中のユーザー名 → encyclopediaのidの集合
+        self._thread = None
+
+    def submit(self, username, encyclopedia):
+        """未保存の変更を取り出して保存待ちにする（すぐに戻る）"""
+        if not encyclopedia.has_changes():
+            return
+        with self._cond:
+            while self._pending_ops >= self.max_pending_ops:
+                self._cond.wait()
+            key = id(encyclopedia)
+            item = self._pending.get(key)
+            with encyclopedia.lock:
+                if item is not None:
+                    # まだ書き込まれていない変更を未保存に戻して取り出し直し、同じ記事への操作を1つにまとめる
+                    # （同じ記事の操作が1回の書き込みに2つあると、履歴に同じ版が2つできる）
+                    encyclopedia.restore_changes(item[2])
+                    self._pending_ops -= len(item[2])
+                ops = encyclopedia.pop_changes()
+            if item is not None:
+                item[2] = ops
+            else:
+                self._pending[key] = [username, encyclopedia, ops]
+            self._pending_ops += len(ops)
+            self._start()
+            self._cond.notify_all()
+
+    def flush(self, username=None, timeout=None):
+        """保存待ちの変更がすべて書き込まれるまで待つ（usernameを指定するとそのユーザーのみ）"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._has_pending(username), timeout)
+
+    def status(self, encyclopedia):
+        """"pending"（保存待ち・書き込み中）か、最後の保存結果の状態を返す"""
+        key = id(encyclopedia)
+        with self._cond:
+            if key in self._pending or any(key in keys for keys in self._in_flight.values()):
+                return "pending"
+        if encyclopedia.last_result is None:
+            return "saved"
+        return encyclopedia.last_result.status
+
+    def _has_pending(self, username):
+        if username is None:
+            return bool(self._pending or self._in_flight)
+        return username in self._in_flight or any(item[0] == username for item in self._pending.values())
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def _take_batch(self):
+        """先頭のユーザーの保存待ちをすべて取り出す"""
+        username = next(iter(self._pending.values()))[0]
+        batch = [self._pending.pop(key) for key, item in list(self._pending.items()) if item[0] == username]
+        self._in_flight[username] = {id(item[1]) for item in batch}
+        return username, batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                username, batch = self._take_batch()
+            try:
+                for _, encyclopedia, ops in batch:
+                    self._commit(username, encyclopedia, ops)
+            finally:
+                # 予期しないエラーでも書き込み中の印を消し、スレッドは次の保存待ちに進む
+                with self._cond:
+                    del self._in_flight[username]
+                    self._pending_ops -= sum(len(item[2]) for item in batch)
+                    self._cond.notify_all()
+
+    def _commit(self, username, encyclopedia, ops):
+        try:
+            commit_changes(username, encyclopedia, ops)
+        except Exception:
+            # 書き込みに失敗した変更は未保存として戻し、次の保存で再送する
+            traceback.print_exc()
+            try:
+                with encyclopedia.lock:
+                    encyclopedia.restore_changes(ops)
+                    encyclopedia.last_result = SaveResult("error", encyclopedia.version, [])
+            except Exception:
+                traceback.print_exc()
+
+
+_queue = WriteBehindQueue()
+
+
+# 変更をバックグラウンドで保存する
+def save_in_background(username, encyclopedia):
+    _queue.submit(username, encyclopedia)
+
+
+# 保存待ちの変更がディスクに書き込まれるまで待つ（ログアウト時・終了時）
+def flush(username=None, timeout=None):
+    return _queue.flush(username, timeout)
+
+
+# 保存の状態（"saved" / "pending" / "merged" / "conflict" / "error" など）
+def save_status(encyclopedia):
+    return _queue.status(encyclopedia)
+
+
+atexit.register(lambda: flush(timeout=EXIT_FLUSH_TIMEOUT))